@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, bulk module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.bulk
+:synopsis: Provides helpers shared by the modules that make many Valence calls.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, \
+    ALL_COMPLETED
+import datetime
+import threading
+import time
+
+import requests
+
+# Statuses the service answers with when it is busy; calls answered with them
+# are worth retrying
+RETRY_STATUSES = (429, 503)
+
+# Format of the UTCDateTime strings the service takes and gives
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+def to_utc_string(when):
+    """Format a datetime (taken as UTC) as a Valence UTCDateTime string."""
+    return when.strftime(DATE_FORMAT)
+
+
+def parse_utc_string(s):
+    """Parse a Valence UTCDateTime string into a naive UTC datetime."""
+    s = s.rstrip('Z')
+    if '.' in s:
+        (s, fraction) = s.split('.', 1)
+        micro = int((fraction + '000000')[:6])
+    else:
+        micro = 0
+    return datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S').replace(
+        microsecond=micro)
+
+
+def copy_kwargs(kwargs):
+    """Retrieve a copy of the keyword arguments for a service call.
+
+    The service functions update the `params` and `headers` dicts they are
+    passed, so each call made with the same keyword arguments needs copies of
+    them.
+    """
+    kwargs = dict(kwargs)
+    for k in ('params', 'headers'):
+        if kwargs.get(k) is not None:
+            kwargs[k] = dict(kwargs[k])
+    return kwargs
+
+
+def iter_paged(fetch, *args, **kwargs):
+    """Retrieve every item of a paged route, page by page.
+
+    :param fetch:
+        Service function returning a `d2lvalence.data.PagedResultSet`, and
+        taking a `bookmark` keyword parameter, such as
+        `d2lvalence.service.get_users`.
+
+    The remaining positional and keyword arguments are passed to `fetch` for
+    each page. Items are yielded as the route provides them.
+    """
+    bookmark = None
+    while True:
+        page = fetch(*args, bookmark=bookmark, **copy_kwargs(kwargs))
+        for item in page.Items:
+            yield item
+        if not page.HasMoreItems or not page.Bookmark:
+            break
+        bookmark = page.Bookmark
+
+
+def map_concurrently(fn, items, max_workers=8, window=None):
+    """Call a function on every item of an iterable with a pool of threads.
+
+    :param fn: Function taking one item.
+    :param items: Iterable of items; it is read lazily.
+    :param max_workers: Number of calls made at once.
+    :param window:
+        Largest number of items read but not yet yielded; defaults to twice
+        `max_workers`, which keeps memory flat however long `items` is.
+
+    Yields an `(item, result, exception)` tuple for each item as its call
+    finishes, with `exception` None if the call succeeded and `result` None
+    if it did not.
+    """
+    window = window or max_workers * 2
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for item in items:
+            if len(pending) >= window:
+                for done in _drain(pending, FIRST_COMPLETED):
+                    yield done
+            pending[pool.submit(fn, item)] = item
+        for done in _drain(pending, ALL_COMPLETED):
+            yield done
+
+
+def _drain(pending, return_when):
+    done = wait(pending, return_when=return_when)[0]
+    results = []
+    for future in done:
+        item = pending.pop(future)
+        exc = future.exception()
+        results.append((item, None if exc else future.result(), exc))
+    return results
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of calls made from any number of
+    threads.
+    """
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Calls allowed per second, on average.
+        :param burst: Calls allowed at once after a quiet spell.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a call is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def call(fn, *args, **kwargs):
+    """Make a service call, waiting for a rate limiter and retrying while the
+    service reports it is busy.
+
+    :param fn: Service function to call.
+    :param limiter: Keyword only; `RateLimiter` to wait for before each try,
+        or None.
+    :param retries: Keyword only; number of times to retry after the service
+        answers with one of `RETRY_STATUSES`, waiting for its Retry-After
+        time or, failing that, a doubling delay.
+
+    The remaining positional and keyword arguments are passed to `fn`, with
+    the keyword arguments copied for each try.
+    """
+    limiter = kwargs.pop('limiter', None)
+    retries = kwargs.pop('retries', 0)
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return fn(*args, **copy_kwargs(kwargs))
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code if e.response is not None \
+                else None
+            if status not in RETRY_STATUSES or attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(_retry_after(e.response, attempt))
+
+
+def _retry_after(response, attempt):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 2.0 ** attempt
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, completions module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.completions
+:synopsis: Provides a crawler and expiry date index of course completions.
+
+A range of expiry dates is split into shards, and the completions of each
+shard are paged through concurrently with the other shards. The results are
+merged into an index sorted by expiry date, which answers range queries with
+a binary search. Each shard records when it was crawled, so later runs can
+re-crawl only the shards that may still change, and the index can be saved
+to and loaded from a JSON file between runs.
+"""
+import bisect
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.data as d2ldata
+import d2lvalence.service as d2lservice
+
+def shard_range(start, end, days=30):
+    """Split the range of datetimes from `start` up to `end` into shards of
+    at most `days` days, and retrieve them as a list of `(start, end)`
+    pairs.
+    """
+    step = datetime.timedelta(days=days)
+    shards = []
+    while start < end:
+        shards.append((start, min(start + step, end)))
+        start += step
+    return shards
+
+
+class CompletionIndex(object):
+    """Course completions indexed by CompletionId and sorted by expiry date.
+
+    Every shard of the crawled range owns the completions expiring from its
+    start up to, but not including, its end.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completions = {}
+        self._expiry = {}
+        # sorted (expiry datetime, CompletionId) pairs
+        self._sorted = []
+        # (start, end) -> time crawled, all as datetimes
+        self.shards = {}
+
+    def __len__(self):
+        return len(self.completions)
+
+    def replace_shard(self, start, end, items, crawled):
+        """Replace the completions of a shard with those crawled for it;
+        items expiring outside the shard are left to their own shards.
+        """
+        with self._lock:
+            lo = bisect.bisect_left(self._sorted, (start,))
+            hi = bisect.bisect_left(self._sorted, (end,))
+            for (expiry, completion_id) in self._sorted[lo:hi]:
+                del self.completions[completion_id]
+                del self._expiry[completion_id]
+            kept = self._sorted[:lo] + self._sorted[hi:]
+            added = []
+            for item in items:
+                expiry = d2lbulk.parse_utc_string(item['ExpiryDate'])
+                if not start <= expiry < end:
+                    continue
+                completion_id = int(item['CompletionId'])
+                if completion_id in self.completions:
+                    # indexed under another shard before its expiry date
+                    # changed
+                    entry = (self._expiry[completion_id], completion_id)
+                    i = bisect.bisect_left(kept, entry)
+                    if i < len(kept) and kept[i] == entry:
+                        del kept[i]
+                self.completions[completion_id] = item
+                self._expiry[completion_id] = expiry
+                added.append((expiry, completion_id))
+            kept.extend(added)
+            kept.sort()
+            self._sorted = kept
+            self.shards[(start, end)] = crawled
+
+    def expiring_between(self, start, end):
+        """Retrieve the `CourseCompletion`s expiring from `start` up to, but
+        not including, `end`, in order of expiry date.
+        """
+        with self._lock:
+            lo = bisect.bisect_left(self._sorted, (start,))
+            hi = bisect.bisect_left(self._sorted, (end,))
+            return [d2ldata.CourseCompletion(self.completions[c])
+                    for (expiry, c) in self._sorted[lo:hi]]
+
+    def expiring_within(self, days, now=None):
+        """Retrieve the `CourseCompletion`s expiring in the next `days`
+        days, in order of expiry date.
+        """
+        now = now or datetime.datetime.utcnow()
+        return self.expiring_between(now, now + datetime.timedelta(days=days))
+
+    def save(self, path):
+        """Write the index to a JSON file."""
+        with self._lock:
+            data = {'Shards': [[d2lbulk.to_utc_string(s),
+                                d2lbulk.to_utc_string(e),
+                                d2lbulk.to_utc_string(c)]
+                               for ((s, e), c) in sorted(self.shards.items())],
+                    'Completions': list(self.completions.values())}
+        directory = os.path.dirname(os.path.abspath(path))
+        (fd, temp) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(temp, path)
+
+    @staticmethod
+    def load(path):
+        """Read an index written by `save`."""
+        index = CompletionIndex()
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for item in data['Completions']:
+            completion_id = int(item['CompletionId'])
+            index.completions[completion_id] = item
+            index._expiry[completion_id] = d2lbulk.parse_utc_string(
+                item['ExpiryDate'])
+            index._sorted.append((index._expiry[completion_id],
+                                  completion_id))
+        index._sorted.sort()
+        for (s, e, c) in data['Shards']:
+            index.shards[(d2lbulk.parse_utc_string(s),
+                          d2lbulk.parse_utc_string(e))] = \
+                d2lbulk.parse_utc_string(c)
+        return index
+
+
+class CompletionCrawler(object):
+    """Crawls the course completions of an org unit, or of a user, into a
+    `CompletionIndex`, paging through shards of the expiry date range
+    concurrently.
+    """
+    def __init__(self, uc, org_unit_id=None, user_id=None, index=None,
+                 ver='1.1', max_workers=8, shard_days=30, **kwargs):
+        """
+        :param uc: User context used for the crawl.
+        :param org_unit_id: Org unit whose completions are crawled.
+        :param user_id: User whose completions are crawled, if no org unit
+            is given; with an org unit, only this user's completions in it.
+        :param index: `CompletionIndex` to crawl into; a new one by default.
+        :param ver: Learning Environment API version as a string.
+        :param max_workers: Number of shards crawled at once.
+        :param shard_days: Length of each shard of the expiry date range.
+
+        Other keyword arguments are passed to each service call.
+        """
+        if org_unit_id is None and user_id is None:
+            raise ValueError('An org unit or a user to crawl is required')
+        self.uc = uc
+        self.org_unit_id = org_unit_id
+        self.user_id = user_id
+        self.index = index if index is not None else CompletionIndex()
+        self.ver = ver
+        self.max_workers = max_workers
+        self.shard_days = shard_days
+        self.kwargs = kwargs
+
+    def crawl(self, start, end):
+        """Crawl the completions expiring from `start` up to `end`
+        (datetimes, taken as UTC), replacing those indexed before. Returns
+        the number of completions indexed.
+        """
+        self._crawl(shard_range(start, end, self.shard_days))
+        return len(self.index)
+
+    def refresh(self, recent_days=30, now=None):
+        """Re-crawl only the indexed shards that may have changed: those
+        ending less than `recent_days` days before now, or later. Returns the
+        list of shards re-crawled.
+        """
+        now = now or datetime.datetime.utcnow()
+        since = now - datetime.timedelta(days=recent_days)
+        shards = sorted(s for s in self.index.shards if s[1] > since)
+        self._crawl(shards)
+        return shards
+
+    def _crawl(self, shards):
+        for (shard, items, exc) in d2lbulk.map_concurrently(
+                self._fetch, shards, self.max_workers):
+            if exc is not None:
+                raise exc
+            self.index.replace_shard(shard[0], shard[1], items[1], items[0])
+
+    def _fetch(self, shard):
+        crawled = datetime.datetime.utcnow()
+        (start, end) = (d2lbulk.to_utc_string(shard[0]),
+                        d2lbulk.to_utc_string(shard[1]))
+        if self.org_unit_id is not None:
+            items = d2lbulk.iter_paged(
+                d2lservice.get_all_course_completions_for_org, self.uc,
+                self.org_unit_id, user_id=self.user_id, start_expiry=start,
+                end_expiry=end, ver=self.ver, **self.kwargs)
+        else:
+            items = d2lbulk.iter_paged(
+                d2lservice.get_all_course_completions_for_user, self.uc,
+                self.user_id, start_expiry=start, end_expiry=end,
+                ver=self.ver, **self.kwargs)
+        return (crawled, [i for i in items if i.get('ExpiryDate')])
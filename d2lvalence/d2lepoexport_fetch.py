@@ -0,0 +1,160 @@
+"""
+Provides a concurrent asset downloader for ePortfolio exports. Pages, CSS
+files, formatting images and embedded files are fetched by a bounded pool of
+worker threads over one pooled requests session, which can be signed with a
+D2LUserContext. Requests for the same URL are only made once, and bytes and
+time spent are reported per asset class.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# Asset classes used by the presentation exporter
+ASSET_T = {
+    'page': 'page',
+    'content': 'content',
+    'css': 'css',
+    'formatting': 'formatting', }
+
+
+def make_session(uc=None, pool_size=8):
+    """
+    Returns a requests session with a connection pool large enough for
+     pool_size concurrent requests. If a user context is given, every request
+     made through the session is signed by it.
+
+    Parameters:
+        uc (optional): user context, from d2lvalence.auth.fashion_user_context
+        pool_size (optional): number of connections kept open per host
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if uc is not None:
+        session.auth = uc
+    return session
+
+
+class AssetFetcher(object):
+    """
+    Fetches batches of URLs concurrently over a shared session.
+
+    Assets of the classes in cache_classes (by default CSS and formatting
+    images, which D2L shares between presentations) are kept after they are
+    fetched, so later batches, such as other presentations exported through the
+    same fetcher, reuse them instead of downloading them again.
+    """
+    def __init__(self, uc=None, max_workers=8, session=None, timeout=60,
+                 cache_classes=(ASSET_T['css'], ASSET_T['formatting'])):
+        """
+        Parameters:
+            uc (optional): user context used to sign requests
+            max_workers (optional): maximum number of requests made at once
+            session (optional): requests session to use instead of a new one
+            timeout (optional): seconds to wait for each response
+            cache_classes (optional): asset classes kept between batches
+        """
+        self.max_workers = max_workers
+        self.session = session or make_session(uc, max_workers)
+        self.timeout = timeout
+        self.cache_classes = frozenset(cache_classes)
+        self.stats = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+        # bounds the requests in flight across every batch using this fetcher
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    def fetch(self, urls, errors=None):
+        """
+        Fetches a batch of assets and returns a dict of their contents, as
+         bytes, keyed by URL. Each URL is requested once, however often it is
+         listed. Raises the first error met once the batch is complete, unless
+         an errors dict is given.
+
+        Parameters:
+            urls: iterable of (url, asset class) pairs
+            errors (optional): dict to record the exception of each URL that
+             could not be fetched in, keyed by URL; such URLs are left out of
+             the result instead of raising
+        """
+        results = {}
+        queued = {}
+        with self._lock:
+            for (url, assetClass) in urls:
+                if url in self._cache:
+                    results[url] = self._cache[url]
+                elif url not in queued:
+                    queued[url] = assetClass
+        if queued:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = dict((url, pool.submit(self._fetch_one, url,
+                                                 assetClass))
+                               for (url, assetClass) in queued.items())
+            for (url, future) in futures.items():
+                if errors is None:
+                    results[url] = future.result()
+                elif future.exception() is not None:
+                    errors[url] = future.exception()
+                else:
+                    results[url] = future.result()
+        return results
+
+    def get(self, url, assetClass=ASSET_T['content']):
+        """
+        Returns the contents of one asset as bytes, fetched in the calling
+         thread unless it is already cached.
+
+        Parameters:
+            url: web address of the asset as a string
+            assetClass (optional): asset class to count the request under
+        """
+        with self._lock:
+            if url in self._cache:
+                return self._cache[url]
+        return self._fetch_one(url, assetClass)
+
+    def report(self):
+        """
+        Returns a dict keyed by asset class of dicts with the number of assets
+         fetched ('count'), how many of them were unchanged since an earlier
+         download and reused ('reused'), the bytes received ('bytes') and the
+         seconds spent waiting for them ('seconds').
+        """
+        with self._lock:
+            return dict((k, dict(v)) for (k, v) in self.stats.items())
+
+    def _fetch_one(self, url, assetClass):
+        with self._slots:
+            start = time.time()
+            (data, reused) = self._download(url)
+            self._record(url, assetClass, data, time.time() - start, reused)
+        return data
+
+    def _download(self, url):
+        """
+        Requests url and returns its contents and whether they were reused
+        from an earlier download rather than received.
+        """
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return (response.content, False)
+
+    def _record(self, url, assetClass, data, seconds, reused=False):
+        with self._lock:
+            stats = self.stats.setdefault(assetClass, {'count': 0,
+                                                       'bytes': 0,
+                                                       'reused': 0,
+                                                       'seconds': 0.0})
+            stats['count'] += 1
+            if reused:
+                stats['reused'] += 1
+            else:
+                stats['bytes'] += len(data)
+            stats['seconds'] += seconds
+            if assetClass in self.cache_classes:
+                self._cache[url] = data
@@ -0,0 +1,222 @@
+"""
+Provides an archiver for exporting a user's whole ePortfolio (collections,
+artifacts and presentations) into a directory or archive. Objects are fetched
+by a pool of worker threads, each object exactly once, and objects shared by
+several collections are only archived once. A single manifest describing every
+object is written at the end.
+
+Archive layout:
+    manifest.json (properties of every object, plus its ArchivePath)
+    Files/<ObjectId>_<FileName> (file artifact contents)
+    Presentations/<ObjectId>_<Name>/ (exported presentations, laid out as by
+     d2lepoexport_presentation.download_presentation)
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import datetime
+import json
+import threading
+
+import eportfolio
+import d2lepoexport_fetch
+import d2lepoexport_presentation
+import d2lepoexport_target
+
+
+MANIFEST_NAME = 'manifest.json'
+FILES_DIR = 'Files'
+PRESENTATIONS_DIR = 'Presentations'
+# Size of the chunks file artifacts are streamed in
+CHUNK_SIZE = 64 * 1024
+
+
+class epArchiver(object):
+    """
+    Walks a user's ePortfolio with a worker pool and archives every object
+    into an output target from d2lepoexport_target.
+    """
+    def __init__(self, uc, target, ver='2.3', c=False, max_workers=8,
+                 presentations=True, **kwargs):
+        """
+        Parameters:
+            uc: user context, from d2lvalence.auth.fashion_user_context
+            target: output target, or a path for d2lepoexport_target.open_target;
+             a target opened from a path is closed once archive has written
+             the manifest, or by close
+            ver (optional): ePortfolio API version as a String
+            c (optional): include comments attached to objects if true
+            max_workers (optional): number of objects fetched at once
+            presentations (optional): set to False to only list presentations
+             in the manifest instead of exporting their HTML
+        """
+        self.uc = uc
+        self.target = d2lepoexport_target.open_target(target)
+        # only a target opened here is closed here
+        self._owns_target = self.target is not target
+        self.ver = ver
+        self.c = c
+        self.max_workers = max_workers
+        self.presentations = presentations
+        # shared by all presentation exports, so common formatting files are
+        # fetched once per portfolio
+        self.fetcher = d2lepoexport_fetch.AssetFetcher(uc, max_workers)
+        self.kwargs = kwargs
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes the target if it was opened from a path."""
+        if self._owns_target:
+            self.target.close()
+
+    def archive(self, object_ids=None, pagesize=None):
+        """
+        Archives the objects in object_ids and everything they contain, or the
+        whole portfolio of the user context if object_ids is None. Writes the
+        manifest and returns it as a dict; a target opened from a path is then
+        closed, finishing the archive.
+
+        Parameters:
+            object_ids (optional): iterable of ePortfolio object identifiers
+            pagesize (optional): int number of entries per listing data segment
+        """
+        seen = set()
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+
+            def schedule(object_id, listed=None):
+                object_id = int(object_id)
+                if object_id not in seen:
+                    seen.add(object_id)
+                    future = pool.submit(self._archive_object, object_id,
+                                         listed)
+                    pending[future] = object_id
+
+            if object_ids is None:
+                for item in eportfolio.iter_ep_objects(
+                        self.uc, self.ver, self.c, pagesize=pagesize,
+                        **self.kwargs):
+                    schedule(item['ObjectId'], item)
+            else:
+                for object_id in object_ids:
+                    schedule(object_id)
+
+            while pending:
+                done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    object_id = pending.pop(future)
+                    try:
+                        item_ids = future.result()
+                    except Exception as e:
+                        with self._lock:
+                            self.entries[object_id] = {'ObjectId': object_id,
+                                                       'Error': str(e)}
+                        continue
+                    for item_id in item_ids:
+                        schedule(item_id)
+
+        manifest = self.manifest()
+        try:
+            self.target.write_bytes(
+                MANIFEST_NAME, json.dumps(manifest, indent=1).encode('utf-8'))
+        finally:
+            self.close()
+        return manifest
+
+    def manifest(self):
+        """Returns the manifest of the objects archived so far as a dict."""
+        with self._lock:
+            objects = [self.entries[k] for k in sorted(self.entries)]
+        return {'Created': datetime.datetime.now().isoformat(),
+                'ObjectCount': len(objects),
+                'Objects': objects}
+
+    def _fetch(self, object_id, listed):
+        """
+        Returns the properties of an object. Listing entries are used as they
+        are unless the object type has a type-specific route.
+        """
+        if listed is not None and \
+                not eportfolio.has_typed_properties(listed['ObjectTypeId']):
+            return eportfolio.epObject(listed)
+        return eportfolio.get_ep_object_properties(
+            self.uc, object_id, self.ver, self.c,
+            **eportfolio._copy_kwargs(self.kwargs))
+
+    def _archive_object(self, object_id, listed=None):
+        """
+        Archives one object. Runs on a worker thread; returns the ids of the
+        items it contains, if it is a collection.
+        """
+        obj = self._fetch(object_id, listed)
+        entry = obj.as_dict()
+        entry['ObjectType'] = obj.descriptive_object_type_id()
+        entry['ArchivePath'] = None
+        item_ids = []
+
+        type_id = obj.ObjectTypeId
+        if type_id == eportfolio.EPOBJ_T['file_artifact']:
+            entry['ArchivePath'] = self._archive_file(obj)
+        elif type_id == eportfolio.EPOBJ_T['collection']:
+            item_ids = obj.ItemIds
+        elif type_id == eportfolio.EPOBJ_T['presentation'] and \
+                self.presentations:
+            entry['ArchivePath'] = self._archive_presentation(obj)
+
+        with self._lock:
+            self.entries[obj.ObjectId] = entry
+        return item_ids
+
+    def _archive_file(self, obj):
+        """Streams a file artifact's content into the target."""
+        path = '{0}/{1}'.format(FILES_DIR, d2lepoexport_target.safe_filename(
+            '{0}_{1}'.format(obj.ObjectId, obj.FileName)))
+        response = eportfolio.get_ep_object_content_stream(
+            self.uc, obj.ObjectId, self.ver,
+            **eportfolio._copy_kwargs(self.kwargs))
+        try:
+            self.target.write_chunks(path, response.iter_content(CHUNK_SIZE))
+        finally:
+            response.close()
+        return path
+
+    def _archive_presentation(self, obj):
+        """Exports a presentation's pages and files into the target."""
+        root = '{0}/{1}'.format(PRESENTATIONS_DIR,
+                                d2lepoexport_target.safe_filename(
+                                    '{0}_{1}'.format(obj.ObjectId, obj.Name)))
+        d2lepoexport_presentation.export_presentation(obj, self.uc,
+                                                      self.target, root,
+                                                      self.fetcher)
+        return root + '/index.html'
+
+
+def archive_ep_portfolio(uc, destination, object_ids=None, ver='2.3', c=False,
+                         max_workers=8, presentations=True, **kwargs):
+    """
+    Archives a user's whole ePortfolio, or the objects in object_ids and
+    everything they contain, and returns the manifest as a dict.
+
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        destination: output target, or a directory, .zip or .tar(.gz) path
+        object_ids (optional): iterable of ePortfolio object identifiers
+        ver (optional): ePortfolio API version as a String
+        c (optional): include comments attached to objects if true
+        max_workers (optional): number of objects fetched at once
+        presentations (optional): set to False to only list presentations
+         in the manifest instead of exporting their HTML
+    """
+    target = d2lepoexport_target.open_target(destination)
+    try:
+        archiver = epArchiver(uc, target, ver, c, max_workers, presentations,
+                              **kwargs)
+        return archiver.archive(object_ids)
+    finally:
+        if target is not destination:
+            target.close()
@@ -2,16 +2,22 @@
 Provides functions for processing ePortfolio presentation objects
 into downloadable HTML files.
 """
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 import eportfolio
+import d2lepoexport_fetch
+import d2lepoexport_store
+import d2lepoexport_target
 
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import urllib.request
 import urllib.parse
 import os
+import re
 import sys
 import datetime
-import tempfile
+import threading
 
 
 ###############
@@ -24,6 +30,30 @@ For use in getting files from links in the first page of the presentation.
 Will need to be customized to your domain.
 """
 
+# Folders of an exported presentation, relative to its index.html
+PAGES_DIR = "Pages"
+CONTENT_DIR = "Content"
+FORMATTING_DIR = "Formatting"
+
+# BeautifulSoup tree builder used to parse pages unless a parser is passed.
+# "html.parser" needs nothing installed; "lxml" is several times faster where
+# lxml is available.
+HTML_PARSER = "html.parser"
+# Start method of the worker processes pages are rewritten in. Forking a process
+# whose threads may hold locks, such as those of requests' connection pools, is
+# unsafe, so workers are forked from a clean server process, or spawned where
+# that is not available.
+PROCESS_START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# Tags read from a page while populating the fileDict
+DISCOVERY_TAGS = ['a', 'link', 'img']
+
+# Identifier of an ePortfolio object linked from a presentation page
+CONTEXT_ID_RE = re.compile(r'contextId=(\d*)')
+# Compiled page identifier patterns, keyed by presentation ObjectId
+_PAGE_ID_PATTERNS = {}
+_PAGE_ID_PATTERNS_LOCK = threading.Lock()
+
 """
 The fileDict is a foundational tool for collecting information on files and
 objects that need to be downloaded into the presentation files. Its structure
@@ -61,24 +91,124 @@ def make_file_dict():
     return fileDict
 
 
-def make_soup(url):
+def make_soup(url, cache=None, parser=None):
     """
     Makes a BeautifulSoup object from a url.
-    
+
     Parameters:
         url: string url for webpage to parse
+        cache (optional): PageCache to fetch and parse the page through, so it
+         is only downloaded and parsed once per export
+        parser (optional): BeautifulSoup tree builder, defaults to HTML_PARSER
     """
+    if cache is not None:
+        return cache.get_soup(url)
     htmlFile = urllib.request.urlopen(url).read()
-    soup = BeautifulSoup(htmlFile)
+    soup = parse_html(htmlFile, parser)
     return soup
 
 
+def parse_html(html, parser=None, discovery=False):
+    """
+    Returns html parsed into a BeautifulSoup object.
+
+    Parameters:
+        html: page as bytes or a string
+        parser (optional): BeautifulSoup tree builder, such as "lxml";
+         defaults to HTML_PARSER
+        discovery (optional): only build the tags in DISCOVERY_TAGS, which is
+         enough to populate a fileDict but not to rewrite the page
+    """
+    parseOnly = SoupStrainer(DISCOVERY_TAGS) if discovery else None
+    return BeautifulSoup(html, parser or HTML_PARSER, parse_only=parseOnly)
+
+
+class PageCache(object):
+    """
+    Keeps the pages of one presentation export, as downloaded and optionally
+    as parsed, so the pages read while populating the fileDict are reused when
+    they are rewritten instead of being downloaded and parsed again.
+    """
+    def __init__(self, fetcher, keep_trees=True, parser=None):
+        """
+        Parameters:
+            fetcher: AssetFetcher to download pages with
+            keep_trees (optional): keep the parsed BeautifulSoup objects as
+             well as the raw bytes; set to False to save memory on very large
+             presentations, or when pages are rewritten in other processes.
+             Pages are then only partly parsed during discovery.
+            parser (optional): BeautifulSoup tree builder, defaults to
+             HTML_PARSER
+        """
+        self.fetcher = fetcher
+        self.keep_trees = keep_trees
+        self.parser = parser
+        self._pages = {}
+        self._soups = {}
+
+    def __contains__(self, url):
+        return url in self._pages
+
+    def prefetch(self, urls):
+        """
+        Downloads the pages in urls that are not cached yet, concurrently.
+
+        Parameters:
+            urls: iterable of page web addresses
+        """
+        missing = [(url, d2lepoexport_fetch.ASSET_T['page'])
+                   for url in urls if url not in self._pages]
+        if missing:
+            self._pages.update(self.fetcher.fetch(missing))
+
+    def get_bytes(self, url):
+        """Returns a page as downloaded, as bytes."""
+        if url not in self._pages:
+            self._pages[url] = self.fetcher.get(
+                url, d2lepoexport_fetch.ASSET_T['page'])
+        return self._pages[url]
+
+    def get_soup(self, url):
+        """
+        Returns a page as a BeautifulSoup object. The same object is returned
+         every time while keep_trees is set, so callers must not change it
+         until discovery is complete; see take_soup.
+        """
+        if url in self._soups:
+            return self._soups[url]
+        soup = parse_html(self.get_bytes(url), self.parser,
+                          discovery=not self.keep_trees)
+        if self.keep_trees:
+            self._soups[url] = soup
+        return soup
+
+    def take_soup(self, url):
+        """
+        Returns a page as a BeautifulSoup object for rewriting and drops it,
+         and the page's bytes, from the cache.
+        """
+        soup = self._soups.pop(url, None)
+        if soup is None:
+            soup = parse_html(self.get_bytes(url), self.parser)
+        self._pages.pop(url, None)
+        return soup
+
+    def take_bytes(self, url):
+        """
+        Returns a page as downloaded, as bytes, and drops it from the cache.
+        """
+        html = self.get_bytes(url)
+        self._pages.pop(url, None)
+        self._soups.pop(url, None)
+        return html
+
+
 ##########################
 # Functions to get files #
 ##########################
 
 
-def get_pages(epObject, fileDict):
+def get_pages(epObject, fileDict, cache=None):
     """
     Populates the 'pages' list in the fileDict with a dictionary containing
      static addresses, file names, and unique object IDs for pages in a
@@ -88,16 +218,17 @@ def get_pages(epObject, fileDict):
         epObject: an ePortfolio presentation object from
          eportfolio.get_ep_object_properties or
          eportfolio.get_ep_presentation.
+        cache (optional): PageCache to read the home page through
     """
     homePage = DOMAIN + epObject.ViewLink
-    soup = make_soup(homePage)
+    soup = make_soup(homePage, cache)
     fileDict['pageUrls'].append(homePage)
     fileDict['pageFileNames'].append('index.html')
     fileDict['pageIds'].append(str(epObject.ObjectId))
     for a in soup.find_all('a', {'href': 'javascript://'}):
         if a['onclick'].find('GotoPage') > 0:
             pageId = get_page_id(str(a['onclick']), str(epObject.ObjectId))
-            if pageId not in fileDict['pageIds']:
+            if pageId and pageId not in fileDict['pageIds']:
                 address = homePage + "&pageId={0}".format(pageId)
                 fileName = a.string.replace(' ', '').lower() + ".html"
                 fileDict['pageUrls'].append(address)
@@ -108,34 +239,44 @@ def get_pages(epObject, fileDict):
 
 def get_page_id(onclick, objectId):
     """
+    Returns the identifier of the page a navigation link's onclick handler
+     goes to, or an empty string if it has none.
+
+    Parameters:
+        onclick: 'onclick' attribute of a navigation <a> tag as a string
+        objectId: unique identifier for ePortfolio presentation as a string
+    """
+    match = page_id_pattern(objectId).search(onclick)
+    return match.group(1) if match else ''
+
+
+def page_id_pattern(objectId):
+    """
+    Returns the compiled pattern matching the page identifier that follows the
+     presentation's objectId in navigation onclick handlers, such as
+     GotoPage(<objectId>,<pageId>).
+
+    Parameters:
+        objectId: unique identifier for ePortfolio presentation as a string
     """
-    beginIndex = onclick.find(objectId) + len(objectId) + 1
-    pageId = onclick[beginIndex:]
-    endIndex = 0
-    nextCharacter = pageId[endIndex]
-    while nextCharacter.isdigit():
-        endIndex += 1
-        nextCharacter = pageId[endIndex]
-    pageId = pageId[:endIndex]
-    return pageId
+    objectId = str(objectId)
+    with _PAGE_ID_PATTERNS_LOCK:
+        if objectId not in _PAGE_ID_PATTERNS:
+            _PAGE_ID_PATTERNS[objectId] = re.compile(
+                r'(?<!\d)' + re.escape(objectId) + r'\D+(\d+)')
+        return _PAGE_ID_PATTERNS[objectId]
+
 
 def get_epo_id(href):
     """
-    Returns unique identifier for an ePortfolio element in a presentation.
+    Returns unique identifier for an ePortfolio element in a presentation, or
+     an empty string if href has none.
 
     Parameters:
         href: web address from <a> tag attribute 'href' as a string
-        objectId: unique identifier for ePortfolio presentation as a string
     """
-    beginIndex = href.find("contextId=") + len("contextId=")
-    epoId = href[beginIndex:]
-    endIndex = 0
-    nextCharacter = epoId[endIndex]
-    while nextCharacter.isdigit():
-        endIndex += 1
-        nextCharacter = epoId[endIndex]
-    epoId = epoId[:endIndex]
-    return epoId
+    match = CONTEXT_ID_RE.search(href)
+    return match.group(1) if match else ''
 
 
 def get_embedded_object(soup, fileDict, uc):
@@ -152,12 +293,13 @@ def get_embedded_object(soup, fileDict, uc):
         href = str(a['href'])
         if href.find('d2lfile') > 0:
             epoId = get_epo_id(href)
-            if epoId not in fileDict['fileIds']:
+            if epoId and epoId not in fileDict['fileIds']:
                 fileDict['fileIds'].append(epoId)
                 fileDict['fileUrls'].append(DOMAIN + href)
                 fileName = eportfolio.get_ep_object_properties(uc, epoId).\
-                    FileName.strip()
-                fileDict['fileNames'].append(fileName)
+                    FileName
+                fileDict['fileNames'].append(
+                    d2lepoexport_target.safe_filename(fileName))
     return fileDict
 
 
@@ -199,19 +341,34 @@ def get_img(soup, fileDict, uc):
             img = DOMAIN + img['src']
             if img not in fileDict['imgUrls']:
                 fileDict['imgUrls'].append(img)
+                fileDict['imgFileNames'].append(get_img_file_name(img))
         else:
             address = DOMAIN + img['src']
             epoId = get_epo_id(img['src'])
-            if epoId not in fileDict['fileIds']:
+            if epoId and epoId not in fileDict['fileIds']:
                 fileDict['fileIds'].append(epoId)
                 fileDict['fileUrls'].append(address)
                 fileName = eportfolio.get_ep_object_properties(uc, epoId).\
-                    FileName.strip()
-                fileDict['fileNames'].append(fileName)
+                    FileName
+                fileDict['fileNames'].append(
+                    d2lepoexport_target.safe_filename(fileName))
     return fileDict
 
 
-def populate_file_dict(epObject, uc, fileDict):
+def get_img_file_name(imgUrl):
+    """
+    Returns the file name a formatting image is saved under.
+
+    Parameters:
+        imgUrl: web address of the image as a string
+    """
+    fileName = imgUrl[imgUrl.rfind("/") + 1:]
+    if fileName.find("?") > 0:
+        fileName = fileName[: fileName.find("?")]
+    return fileName
+
+
+def populate_file_dict(epObject, uc, fileDict, cache=None):
     """
     Returns fileDict populated with information from all pages of an ePortfolio
      presentation.
@@ -220,17 +377,21 @@ def populate_file_dict(epObject, uc, fileDict):
         epObject: an ePortfolio presentation object from
          eportfolio.get_ep_object_properties or
          eportfolio.get_ep_presentation.
+        cache (optional): PageCache to keep the pages in for the rewrite;
+         pages other than the home page are then downloaded concurrently
     """
-    fileDict = get_pages(epObject, fileDict)
+    fileDict = get_pages(epObject, fileDict, cache)
+    if cache is not None:
+        cache.prefetch(fileDict['pageUrls'])
     for url in fileDict['pageUrls']:
-        soup = make_soup(url)
+        soup = make_soup(url, cache)
         fileDict = get_embedded_object(soup, fileDict, uc)
         fileDict = get_css(soup, fileDict)
         fileDict = get_img(soup, fileDict, uc)
     return fileDict
 
 
-def download_presentation(epObject, uc):
+def download_presentation(epObject, uc, directory='', incremental=False):
     """
     Creates and populates a fileDict and downloads files it references. Creates
      a directory named after the presentation containing individual folders for
@@ -239,71 +400,194 @@ def download_presentation(epObject, uc):
         |___Pages (HTML files)
         |___Content (user images, docs, and other files)
         |___Formatting (css and image files for layout and formatting)
-     Returns the fileDict.
+     Returns the fileDict. The current working directory is never changed.
 
     Parameters:
-        fileDict: dict of all files linked to in a presentation
+        epObject: an ePortfolio presentation object from
+         eportfolio.get_ep_object_properties or
+         eportfolio.get_ep_presentation.
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        directory (optional): directory to create the presentation folder in,
+         instead of the current working directory
+        incremental (optional): keep the files of every export made into
+         directory in a shared content store (see d2lepoexport_store); files
+         unchanged since an earlier export are revalidated with conditional
+         requests rather than downloaded, and hard linked rather than copied
     """
-    fileDict = make_file_dict()
-    fileDict = populate_file_dict(epObject, uc, fileDict)
     now = str(datetime.datetime.now().hour) + \
         str(datetime.datetime.now().minute) + \
         str(datetime.datetime.now().second)
     directoryName = epObject.Name.replace(" ", "") + "_presentation_" + now
-    os.mkdir(directoryName)
-    os.chdir(directoryName)
-    temp = tempfile.TemporaryFile()
-    temp.write(urllib.request.urlopen(fileDict['pageUrls'][0]).read())
-    temp.seek(0)
-    update_page(temp, fileDict, "index.html", index=True)
-    temp.close()
-    os.mkdir("Pages")
-    os.chdir("Pages")
-    for (pageUrl, pageFileName) in zip(fileDict['pageUrls'][1:], 
-                                       fileDict['pageFileNames'][1:]):
-        temp = tempfile.TemporaryFile()
-        temp.write(urllib.request.urlopen(pageUrl).read())
-        update_page(temp, fileDict, pageFileName)
-        temp.close()
-    os.chdir("../")
-    os.mkdir("Content")
-    os.chdir("Content")
-    for (fileUrl, fileId) in zip(fileDict['fileUrls'], fileDict['fileIds']):
-        fileName = eportfolio.get_ep_object_properties(uc, fileId).\
-            FileName.strip()
-        urllib.request.urlretrieve(fileUrl, fileName)
-    os.chdir("../")
-    os.mkdir("Formatting")
-    os.chdir("Formatting")
-    for (cssUrl, cssFileName) in zip(fileDict['cssUrls'],
-                                  fileDict['cssFileNames']):
-        temp = tempfile.TemporaryFile()
-        temp.write(urllib.request.urlopen(cssUrl).read())
-        temp.seek(0)
-        update_css_file(cssUrl, temp, cssFileName)
-        temp.close()
-    for imgUrl in fileDict['imgUrls']:
-        fileName = imgUrl[imgUrl.rfind("/"): ]
-        if fileName.find("?") > 0:
-            fileName = fileName[: fileName.find("?")]
-        urllib.request.urlretrieve(imgUrl, fileName)
-    os.chdir("../")
-    print(str(fileDict))
+    target = d2lepoexport_target.DirectoryTarget(os.path.join(directory,
+                                                              directoryName))
+    if not incremental:
+        return export_presentation(epObject, uc, target)
+    (store, manifest) = d2lepoexport_store.open_state(directory or '.')
+    fetcher = d2lepoexport_store.IncrementalFetcher(uc, store, manifest)
+    try:
+        return export_presentation(
+            epObject, uc, d2lepoexport_store.StoreTarget(target, store),
+            fetcher=fetcher)
+    finally:
+        manifest.save()
+
+
+def export_presentation(epObject, uc, target, root='', fetcher=None,
+                        keep_trees=True, parser=None, pool=None):
+    """
+    Creates and populates a fileDict and writes the presentation and the files
+     it references into an output target, laid out as for
+     download_presentation. Nothing depends on the current working directory,
+     so several presentations can be exported at once from different threads.
+     Pages, content and formatting files are fetched concurrently by an
+     d2lepoexport_fetch.AssetFetcher. Pages are downloaded and parsed once,
+     while populating the fileDict, and kept in a PageCache for the rewrite.
+     Given a process pool, pages are instead parsed and rewritten in its
+     worker processes. Returns the fileDict.
+
+    Parameters:
+        epObject: an ePortfolio presentation object from
+         eportfolio.get_ep_object_properties or
+         eportfolio.get_ep_presentation.
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        target: output target, or a directory, .zip or .tar(.gz) path (see
+         d2lepoexport_target.open_target)
+        root (optional): folder within the target to export into
+        fetcher (optional): AssetFetcher to share a session, cached formatting
+         files and statistics with other exports
+        keep_trees (optional): keep parsed pages between discovery and the
+         rewrite, see PageCache
+        parser (optional): BeautifulSoup tree builder, defaults to HTML_PARSER
+        pool (optional): concurrent.futures.ProcessPoolExecutor to parse and
+         rewrite pages in
+    """
+    def path(*parts):
+        return '/'.join(((root,) if root else ()) + parts)
+
+    target = d2lepoexport_target.open_target(target)
+    if fetcher is None:
+        fetcher = d2lepoexport_fetch.AssetFetcher(uc)
+    # trees parsed here cannot be handed to other processes, so with a pool
+    # only the bytes are kept
+    cache = PageCache(fetcher, keep_trees and pool is None, parser)
+    fileDict = make_file_dict()
+    fileDict = populate_file_dict(epObject, uc, fileDict, cache)
+    assets = fetcher.fetch(list_assets(fileDict, pages=False))
+    links = LinkIndex(fileDict, str(epObject.ObjectId), DOMAIN)
+
+    pagePaths = [path('index.html')] + \
+        [path(PAGES_DIR, pageFileName)
+         for pageFileName in fileDict['pageFileNames'][1:]]
+    if pool is None:
+        for (i, (pageUrl, pagePath)) in enumerate(zip(fileDict['pageUrls'],
+                                                      pagePaths)):
+            target.write_bytes(pagePath,
+                               rewrite_soup(cache.take_soup(pageUrl),
+                                            fileDict, i == 0, links))
+    else:
+        # worker processes may not share this process's module globals, so
+        # the parser is resolved here, as the domain is in the LinkIndex
+        futures = [pool.submit(rewrite_page, cache.take_bytes(pageUrl),
+                               fileDict, i == 0, links, parser or HTML_PARSER)
+                   for (i, pageUrl) in enumerate(fileDict['pageUrls'])]
+        for (pagePath, future) in zip(pagePaths, futures):
+            target.write_bytes(pagePath, future.result())
+    for (fileUrl, fileName) in zip(fileDict['fileUrls'],
+                                   fileDict['fileNames']):
+        target.write_bytes(path(CONTENT_DIR, fileName), assets[fileUrl])
+    css = CssRewriter(fetcher)
+    for (imgUrl, imgFileName) in zip(fileDict['imgUrls'],
+                                     fileDict['imgFileNames']):
+        css.add_file(imgUrl, imgFileName)
+    css.export([(cssUrl, cssFileName, assets[cssUrl])
+                for (cssUrl, cssFileName) in zip(fileDict['cssUrls'],
+                                                 fileDict['cssFileNames'])],
+               target, path(FORMATTING_DIR))
+    for (imgUrl, imgFileName) in zip(fileDict['imgUrls'],
+                                     fileDict['imgFileNames']):
+        target.write_bytes(path(FORMATTING_DIR, imgFileName), assets[imgUrl])
     return fileDict
 
 
-def write_page(soup, fileName):
+def list_assets(fileDict, pages=True):
+    """
+    Returns a list of (url, asset class) pairs for every file a populated
+     fileDict references, for passing to AssetFetcher.fetch.
+
+    Parameters:
+        fileDict: dict of all files linked to in a presentation
+        pages (optional): set to False to leave out the pages, such as when
+         they are already held in a PageCache
+    """
+    asset_t = d2lepoexport_fetch.ASSET_T
+    pageUrls = fileDict['pageUrls'] if pages else []
+    return [(url, asset_t['page']) for url in pageUrls] + \
+        [(url, asset_t['content']) for url in fileDict['fileUrls']] + \
+        [(url, asset_t['css']) for url in fileDict['cssUrls']] + \
+        [(url, asset_t['formatting']) for url in fileDict['imgUrls']]
+
+
+def export_presentations(epObjects, uc, destination, max_workers=8,
+                         processes=None, parser=None, mp_context=None):
+    """
+    Exports many presentations at once with a pool of worker threads, each
+     into its own '<ObjectId>_<Name>' folder of one output target. All exports
+     share one AssetFetcher, so formatting files common to the presentations
+     are only downloaded once. Returns a dict of fileDicts keyed by ObjectId.
+
+    Parameters:
+        epObjects: iterable of ePortfolio presentation objects
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        destination: output target, or a directory, .zip or .tar(.gz) path
+        max_workers (optional): number of presentations exported at once
+        processes (optional): number of worker processes to parse and rewrite
+         pages in, so large batches use every core; pages are handled in the
+         exporting threads if None
+        parser (optional): BeautifulSoup tree builder, defaults to HTML_PARSER
+        mp_context (optional): multiprocessing context the worker processes
+         are started with, defaults to one using PROCESS_START_METHOD
+    """
+    # made before any thread of the export starts
+    processPool = ProcessPoolExecutor(
+        processes, mp_context or multiprocessing.get_context(
+            PROCESS_START_METHOD)) if processes else None
+    target = d2lepoexport_target.open_target(destination)
+    fetcher = d2lepoexport_fetch.AssetFetcher(uc, max_workers)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for epObject in epObjects:
+                root = d2lepoexport_target.safe_filename(
+                    '{0}_{1}'.format(epObject.ObjectId, epObject.Name))
+                futures[epObject.ObjectId] = pool.submit(
+                    export_presentation, epObject, uc, target, root, fetcher,
+                    parser=parser, pool=processPool)
+            return dict((objectId, future.result())
+                        for (objectId, future) in futures.items())
+    finally:
+        if processPool is not None:
+            processPool.shutdown()
+        if target is not destination:
+            target.close()
+
+
+def write_page(soup, fileName, target=None):
     """
     Writes a BeautifulSoup object to an html file.
 
     Parameters:
         soup: BeautifulSoup object
         fileName: name of the file as a string
+        target (optional): output target to write fileName into, instead of
+         the current working directory
     """
     soup.prettify(formatter='html')
 
-    with open(fileName, 'wb') as f:
-        f.write(str(soup).encode('utf-8'))
+    if target is not None:
+        target.write_bytes(fileName, str(soup).encode('utf-8'))
+    else:
+        with open(fileName, 'wb') as f:
+            f.write(str(soup).encode('utf-8'))
 
 
 ##########################
@@ -311,7 +595,8 @@ def write_page(soup, fileName):
 ##########################
 
 
-def update_page(temp, fileDict, fileName, index=False):
+def update_page(temp, fileDict, fileName, index=False, target=None,
+                parser=None):
     """
     Updates the links in an html file to match the new file locations.
 
@@ -319,15 +604,152 @@ def update_page(temp, fileDict, fileName, index=False):
         temp: tempfile object
         fileDict: dict of all files linked to in a presentation
         index: list index of page to be processed
+        target (optional): output target to write fileName into, instead of
+         the current working directory
+        parser (optional): BeautifulSoup tree builder, defaults to HTML_PARSER
     """
     temp.seek(0)
-    soup = BeautifulSoup(temp.read())
-    update_file_urls(soup, fileDict, index)
-    update_css_urls(soup, fileDict, index)
-    update_image_urls(soup, fileDict, index)
-    update_page_urls(soup, fileDict, index)
-    strip_script(soup)
-    write_page(soup, fileName)
+    soup = parse_html(temp.read(), parser)
+    update_soup(soup, fileDict, index)
+    write_page(soup, fileName, target)
+
+
+def rewrite_page(html, fileDict, index=False, links=None, parser=None):
+    """
+    Returns the html of a presentation page, as bytes, with its links updated
+     to match the new file locations. Its arguments and result can be pickled,
+     so it can be run in a process pool.
+
+    Parameters:
+        html: the page as downloaded, as bytes
+        fileDict: dict of all files linked to in a presentation
+        index: True if the page is the presentation's index.html
+        links (optional): LinkIndex of fileDict, to share between pages
+        parser (optional): BeautifulSoup tree builder, defaults to HTML_PARSER
+    """
+    return rewrite_soup(parse_html(html, parser), fileDict, index, links)
+
+
+def rewrite_soup(soup, fileDict, index=False, links=None):
+    """
+    Updates the links of an already parsed presentation page and returns its
+     html as bytes.
+
+    Parameters:
+        soup: BeautifulSoup object, which is changed in place
+        fileDict: dict of all files linked to in a presentation
+        index: True if the page is the presentation's index.html
+        links (optional): LinkIndex of fileDict, to share between pages
+    """
+    update_soup(soup, fileDict, index, links)
+    return str(soup).encode('utf-8')
+
+
+def update_soup(soup, fileDict, index=False, links=None):
+    """
+    Updates all links of a parsed presentation page and removes its scripts,
+     in a single walk over the page's tags.
+
+    Parameters:
+        soup: BeautifulSoup object
+        fileDict: dict of all files linked to in a presentation
+        index: True if the page is the presentation's index.html
+        links (optional): LinkIndex of fileDict, to share between pages
+    """
+    if links is None:
+        links = LinkIndex(fileDict)
+    links.rewrite(soup, index)
+
+
+class LinkIndex(object):
+    """
+    Maps the links found in the pages of a presentation to the files they are
+    exported as. The maps are built once per export from a populated fileDict,
+    so each link is rewritten with a dict lookup on its exact identifier or
+    address rather than by searching every entry of the fileDict for it.
+    """
+    def __init__(self, fileDict, objectId=None, domain=None):
+        """
+        Parameters:
+            fileDict: dict of all files linked to in a presentation
+            objectId (optional): unique identifier for the presentation;
+             defaults to the first of fileDict['pageIds']
+            domain (optional): domain relative links are resolved against,
+             defaults to DOMAIN as it is when the index is built; it is kept
+             with the index, so pages rewritten in other processes use it
+        """
+        self.domain = domain or DOMAIN
+        if objectId is None:
+            objectId = fileDict['pageIds'][0] if fileDict['pageIds'] else ''
+        self.files = dict(zip(fileDict['fileIds'], fileDict['fileNames']))
+        self.css = dict(zip(fileDict['cssUrls'], fileDict['cssFileNames']))
+        self.images = dict(zip(fileDict['imgUrls'],
+                               fileDict['imgFileNames']))
+        self.pages = dict(zip(fileDict['pageIds'],
+                              fileDict['pageFileNames']))
+        self.pageIdPattern = page_id_pattern(objectId)
+
+    def rewrite(self, soup, index=False):
+        """
+        Updates the links of a parsed presentation page and removes its
+         scripts.
+
+        Parameters:
+            soup: BeautifulSoup object
+            index: True if the page is the presentation's index.html
+        """
+        up = './' if index else '../'
+        for tag in soup.find_all(['a', 'img', 'link', 'div', 'script']):
+            if tag.name == 'script':
+                tag.decompose()
+            elif tag.name == 'div':
+                if 'd_t_nav_current_page' in tag.get('class', ()):
+                    current = tag.find('a')
+                    if current is not None:
+                        current['href'] = '#'
+            elif tag.name == 'link':
+                if tag.get('type') == 'text/css':
+                    cssFileName = self.css.get(self.domain +
+                                               tag.get('href', ''))
+                    if cssFileName is not None:
+                        tag['href'] = up + FORMATTING_DIR + '/' + cssFileName
+            else:
+                self._rewrite_file_link(tag, 'href', up)
+                if tag.name == 'img':
+                    self._rewrite_image(tag, up)
+                elif tag.get('href') == 'javascript://':
+                    self._rewrite_page_link(tag, index)
+
+    def _rewrite_file_link(self, tag, attribute, up):
+        value = tag.get(attribute)
+        if value:
+            match = CONTEXT_ID_RE.search(value)
+            if match and match.group(1) in self.files:
+                tag[attribute] = up + CONTENT_DIR + '/' + \
+                    self.files[match.group(1)]
+                return True
+        return False
+
+    def _rewrite_image(self, img, up):
+        if self._rewrite_file_link(img, 'src', up):
+            return
+        src = img.get('src', '')
+        if src.find('d2lFile') < 0:
+            imgFileName = self.images.get(self.domain + src)
+            if imgFileName is not None:
+                img['src'] = up + FORMATTING_DIR + '/' + imgFileName
+
+    def _rewrite_page_link(self, a, index):
+        match = self.pageIdPattern.search(a.get('onclick', ''))
+        pageFileName = self.pages.get(match.group(1)) if match else None
+        if pageFileName is None:
+            return
+        if pageFileName == 'index.html':
+            a['href'] = './index.html' if index else '../index.html'
+        elif index:
+            a['href'] = './' + PAGES_DIR + '/' + pageFileName
+        else:
+            a['href'] = pageFileName
 
 
 def update_file_urls(soup, fileDict, index=False):
@@ -343,14 +765,14 @@ def update_file_urls(soup, fileDict, index=False):
                                       fileDict['fileNames']):
             if item.has_attr('href') and item['href'].find(fileId) > 0:
                 if index == True:
-                    item['href'] = './content/' + fileName
+                    item['href'] = './' + CONTENT_DIR + '/' + fileName
                 else:
-                    item['href'] = '../content/' + fileName
+                    item['href'] = '../' + CONTENT_DIR + '/' + fileName
             if item.has_attr('src') and item['src'].find(fileId) > 0:
                 if index == True:
-                    item['src'] = './content/' + fileName
+                    item['src'] = './' + CONTENT_DIR + '/' + fileName
                 else:
-                    item['src'] = '../content/' + fileName
+                    item['src'] = '../' + CONTENT_DIR + '/' + fileName
 
 
 def update_css_urls(soup, fileDict, index=False):
@@ -367,9 +789,9 @@ def update_css_urls(soup, fileDict, index=False):
             if cssUrl.find(a['href']) > 0:
             #if a['href'] == urllib.parse.urlparse(cssUrl).path:
                 if index == True:
-                    a['href'] = './formatting/' + cssFileName
+                    a['href'] = './' + FORMATTING_DIR + '/' + cssFileName
                 else:
-                    a['href'] = '../formatting/' + cssFileName
+                    a['href'] = '../' + FORMATTING_DIR + '/' + cssFileName
 
 
 def update_image_urls(soup, fileDict, index=False):
@@ -386,9 +808,9 @@ def update_image_urls(soup, fileDict, index=False):
             if img['src'].find('d2lFile') < 0:
                 if img['src'] == urllib.parse.urlparse(imgUrl).path:
                     if index == True:
-                        img['src'] = './formatting/' + imgFileName
+                        img['src'] = './' + FORMATTING_DIR + '/' + imgFileName
                     else:
-                        img['src'] = '../formatting/' + imgFileName
+                        img['src'] = '../' + FORMATTING_DIR + '/' + imgFileName
 
 
 def update_page_urls(soup, fileDict, index=False):
@@ -406,7 +828,7 @@ def update_page_urls(soup, fileDict, index=False):
                                            fileDict['pageFileNames']):
             if a['onclick'].find(str(pageId)) > 0:
                 if index == True:
-                    a['href'] = './pages/' + pageFileName
+                    a['href'] = './' + PAGES_DIR + '/' + pageFileName
                 elif (index == False) and (pageFileName != 'index.html'):
                     a['href'] = pageFileName
                 else:
@@ -428,39 +850,189 @@ def strip_script(soup):
 #########################
 
 
-def update_css_file(cssUrl, temp, fileName):
+# References to other files in a stylesheet: url(...) in its double quoted,
+# single quoted and unquoted forms, and @import of a quoted address
+CSS_REF_RE = re.compile(
+    rb'url\(\s*(?:"(?P<dq>[^"]*)"|\'(?P<sq>[^\']*)\'|(?P<bare>[^)\'"\s]*))\s*\)'
+    rb'|@import\s+(?:"(?P<idq>[^"]*)"|\'(?P<isq>[^\']*)\')')
+_CSS_IMPORT_GROUPS = ('idq', 'isq')
+
+
+def update_css_file(cssUrl, temp, fileName, target=None, directory='',
+                    fetcher=None):
     """
-    Updates the links in CSS files and downloads the files linked.
+    Updates the links in CSS files and downloads the files linked. Returns a
+     dict of the exceptions the files that could not be downloaded failed
+     with, keyed by address.
 
     Parameters:
+        cssUrl: web address the css file was downloaded from
         temp: css file as a tempfile.TemporaryFile object
         fileName: name of the css file
+        target (optional): output target to write the css file and the files
+         it links to into, instead of the current working directory
+        directory (optional): folder within the target to write into
+        fetcher (optional): AssetFetcher to download the linked files with
     """
-    with open(fileName, 'wb') as f:
-        for line in temp:
-            contains_link = line.find(b"url(")
-            if contains_link != -1:
-                beginIndex = contains_link + 4
-                endIndex = line.find(b")", beginIndex)
-                url = line[beginIndex: endIndex].decode()
-                if url[0] == "/":
-                    address = DOMAIN + url
-                elif url[0].isalnum():
-                    url = "/" + url
-                    address = cssUrl[: cssUrl.rfind("/")] + url
-                else:
-                    count = 0
-                    while url[count] != "/":
-                        count += 1
-                    address = DOMAIN + url[count:]
-                    while not address[-1].isalnum():
-                        address = address[: -1]
-                newAddress = address[address.rfind("/") + 1:]
-                if newAddress.find("?") > 0:
-                    newAddress = newAddress[: newAddress.find("?")]
-                try:
-                    urllib.request.urlretrieve(address, newAddress)
-                except urllib.error.HTTPError:
-                    print(urllib.error.HTTPError)
-                line = (line[:beginIndex].decode() + newAddress + line[endIndex:].decode()).encode('UTF-8')
-            f.write(line)
+    if target is None:
+        target = d2lepoexport_target.DirectoryTarget(directory or '.')
+        directory = ''
+    if fetcher is None:
+        fetcher = d2lepoexport_fetch.AssetFetcher()
+    temp.seek(0)
+    rewriter = CssRewriter(fetcher)
+    rewriter.export([(cssUrl, fileName, temp.read())], target, directory)
+    return rewriter.errors
+
+
+class CssRewriter(object):
+    """
+    Rewrites the stylesheets of a presentation export so they refer to local
+    copies of the files they use. The references of every stylesheet,
+    including stylesheets they @import, are collected first; the files are
+    then downloaded concurrently, each once, and each stylesheet is rewritten
+    in a single pass. Every file is written to the same folder as the
+    stylesheets, under its own file name, numbered if two addresses share one.
+    """
+    def __init__(self, fetcher):
+        """
+        Parameters:
+            fetcher: AssetFetcher to download the referenced files with
+        """
+        self.fetcher = fetcher
+        self.names = {}
+        # exceptions of the files that could not be downloaded, by address;
+        # references to them are left unchanged
+        self.errors = {}
+        self._taken = set()
+        self._external = set()
+
+    def add_file(self, url, fileName):
+        """
+        Records a file that is written to the stylesheets' folder by other
+         means, such as formatting images from fileDict['imgUrls'], so it is
+         referred to by that name and not downloaded again.
+
+        Parameters:
+            url: web address of the file
+            fileName: name the file is written under
+        """
+        if url not in self.names:
+            self.names[url] = fileName
+            self._taken.add(fileName)
+        self._external.add(url)
+
+    def local_name(self, url):
+        """Returns the file name the file at url is written under."""
+        if url not in self.names:
+            baseName = d2lepoexport_target.safe_filename(
+                get_img_file_name(url))
+            name = baseName
+            count = 1
+            while name in self._taken:
+                name = '{0}_{1}'.format(count, baseName)
+                count += 1
+            self._taken.add(name)
+            self.names[url] = name
+        return self.names[url]
+
+    def references(self, cssUrl, css):
+        """
+        Returns a list of (address, is stylesheet) pairs, one for each file
+         referred to by a stylesheet.
+
+        Parameters:
+            cssUrl: web address of the stylesheet, to resolve references by
+            css: the stylesheet as bytes
+        """
+        references = []
+        for match in CSS_REF_RE.finditer(css):
+            (address, group) = self._resolve(cssUrl, match)
+            if address is not None:
+                references.append((address, self._is_stylesheet(address,
+                                                                group)))
+        return references
+
+    def rewrite(self, cssUrl, css):
+        """
+        Returns a stylesheet, as bytes, with every reference to a file that
+         has a local name replaced by that name.
+
+        Parameters:
+            cssUrl: web address of the stylesheet, to resolve references by
+            css: the stylesheet as bytes
+        """
+        def replace(match):
+            (address, group) = self._resolve(cssUrl, match)
+            if address is None or address not in self.names:
+                return match.group(0)
+            offset = match.start()
+            (begin, end) = match.span(group)
+            whole = match.group(0)
+            return whole[:begin - offset] + \
+                self.names[address].encode('utf-8') + whole[end - offset:]
+        return CSS_REF_RE.sub(replace, css)
+
+    def export(self, stylesheets, target, directory=''):
+        """
+        Downloads every file the stylesheets refer to and writes them, and the
+         rewritten stylesheets, into an output target.
+
+        Parameters:
+            stylesheets: iterable of (web address, file name, bytes) triples
+            target: output target to write into
+            directory (optional): folder within the target to write into
+        """
+        def path(name):
+            return directory + '/' + name if directory else name
+
+        asset_t = d2lepoexport_fetch.ASSET_T
+        sheets = []
+        queue = []
+        for (cssUrl, fileName, css) in stylesheets:
+            self.names.setdefault(cssUrl, fileName)
+            self._taken.add(fileName)
+            queue.append((cssUrl, css))
+        seen = set(cssUrl for (cssUrl, css) in queue)
+        assets = set()
+        while queue:
+            imports = set()
+            for (cssUrl, css) in queue:
+                sheets.append((cssUrl, css))
+                for (address, isStylesheet) in self.references(cssUrl, css):
+                    if not isStylesheet:
+                        assets.add(address)
+                    elif address not in seen:
+                        seen.add(address)
+                        imports.add(address)
+            fetched = self.fetcher.fetch([(address, asset_t['css'])
+                                          for address in imports],
+                                         self.errors)
+            queue = [(address, fetched[address]) for address in imports
+                     if address in fetched]
+            for (address, css) in queue:
+                self.local_name(address)
+
+        assets -= self._external
+        fetched = self.fetcher.fetch([(address, asset_t['formatting'])
+                                      for address in assets], self.errors)
+        for address in sorted(fetched):
+            target.write_bytes(path(self.local_name(address)),
+                               fetched[address])
+        for (cssUrl, css) in sheets:
+            target.write_bytes(path(self.local_name(cssUrl)),
+                               self.rewrite(cssUrl, css))
+
+    def _resolve(self, cssUrl, match):
+        group = match.lastgroup
+        reference = match.group(group).decode('utf-8', 'replace').strip()
+        if not reference or reference.startswith('#'):
+            return (None, group)
+        address = urllib.parse.urljoin(cssUrl, reference)
+        if urllib.parse.urlparse(address).scheme not in ('http', 'https'):
+            return (None, group)
+        return (address, group)
+
+    def _is_stylesheet(self, address, group):
+        return group in _CSS_IMPORT_GROUPS or \
+            urllib.parse.urlparse(address).path.lower().endswith('.css')
@@ -0,0 +1,233 @@
+"""
+Provides incremental re-export of ePortfolio presentations. Every file an
+export writes is kept once in a content-addressed store, named by its SHA-256
+hash, and exported files are hard links into the store where the file system
+allows, so identical formatting images and CSS take the space of one copy
+however many presentations and exports use them. A manifest records the ETag,
+Last-Modified date and hash of every asset URL, so later exports make
+conditional requests and reuse the stored copy of anything unchanged.
+
+State layout, below the export directory:
+    .d2lepoexport/manifest.json (validators and hash of each asset URL)
+    .d2lepoexport/objects/<first 2 hex digits>/<SHA-256 hex digest>
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import d2lepoexport_fetch
+
+
+STORE_DIR = '.d2lepoexport'
+MANIFEST_NAME = 'manifest.json'
+OBJECTS_DIR = 'objects'
+
+
+class ContentStore(object):
+    """
+    Keeps files by the SHA-256 hash of their contents. Stored files are made
+    read-only, as exports may hard link to them.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path: directory to keep the stored files in
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def path_of(self, digest):
+        """Returns the path of the stored file with the given hex digest."""
+        return os.path.join(self.path, digest[:2], digest)
+
+    def has(self, digest):
+        """Returns True if a file with the given hex digest is stored."""
+        return os.path.exists(self.path_of(digest))
+
+    def get(self, digest):
+        """Returns the contents of a stored file as bytes."""
+        with open(self.path_of(digest), 'rb') as f:
+            return f.read()
+
+    def put(self, data):
+        """
+        Stores data, a bytes object, unless it is already stored, and returns
+         its hex digest.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.has(digest):
+            self._add(digest, [data])
+        return digest
+
+    def put_chunks(self, chunks):
+        """
+        Stores an iterable of bytes chunks as one file, unless it is already
+         stored, and returns its hex digest.
+        """
+        sha = hashlib.sha256()
+        (fd, temp) = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    f.write(chunk)
+            digest = sha.hexdigest()
+            if not self.has(digest):
+                self._install(temp, digest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return digest
+
+    def _add(self, digest, chunks):
+        (fd, temp) = tempfile.mkstemp(dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            self._install(temp, digest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def _install(self, temp, digest):
+        # written under a temporary name and renamed into place, so readers
+        # never see a partly written file
+        os.chmod(temp, 0o444)
+        os.makedirs(os.path.dirname(self.path_of(digest)), exist_ok=True)
+        os.replace(temp, self.path_of(digest))
+
+
+class AssetManifest(object):
+    """
+    Records, for each asset URL, the validators the server sent with it and
+    the hash it is stored under, as a JSON file of
+    {url: {'ETag', 'LastModified', 'Sha256', 'Size'}}.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path: path of the manifest file; it is created by save
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def get(self, url):
+        """Returns the entry recorded for url, or None."""
+        with self._lock:
+            return self.entries.get(url)
+
+    def set(self, url, entry):
+        """Records the entry for url."""
+        with self._lock:
+            self.entries[url] = entry
+
+    def save(self):
+        """Writes the manifest to its file."""
+        with self._lock:
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        (fd, temp) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp, self.path)
+
+
+class IncrementalFetcher(d2lepoexport_fetch.AssetFetcher):
+    """
+    An AssetFetcher that stores everything it downloads in a ContentStore and
+    revalidates assets it has downloaded before with conditional requests. An
+    asset the server reports as unchanged is read from the store instead.
+    """
+    def __init__(self, uc, store, manifest, **kwargs):
+        """
+        Parameters:
+            uc: user context used to sign requests
+            store: ContentStore to keep downloaded assets in
+            manifest: AssetManifest of the assets downloaded before
+            kwargs: passed on to AssetFetcher
+        """
+        d2lepoexport_fetch.AssetFetcher.__init__(self, uc, **kwargs)
+        self.store = store
+        self.manifest = manifest
+
+    def _download(self, url):
+        entry = self.manifest.get(url)
+        headers = {}
+        if entry is not None and self.store.has(entry['Sha256']):
+            if entry.get('ETag'):
+                headers['If-None-Match'] = entry['ETag']
+            if entry.get('LastModified'):
+                headers['If-Modified-Since'] = entry['LastModified']
+        response = self.session.get(url, timeout=self.timeout,
+                                    headers=headers)
+        if response.status_code == 304 and headers:
+            return (self.store.get(entry['Sha256']), True)
+        response.raise_for_status()
+        data = response.content
+        self.manifest.set(url, {
+            'ETag': response.headers.get('ETag'),
+            'LastModified': response.headers.get('Last-Modified'),
+            'Sha256': self.store.put(data),
+            'Size': len(data)})
+        return (data, False)
+
+
+class StoreTarget(object):
+    """
+    Wraps an output target so every file written through it is put in a
+    ContentStore first and then linked, or copied, into the target from
+    there.
+    """
+    def __init__(self, target, store):
+        """
+        Parameters:
+            target: output target from d2lepoexport_target
+            store: ContentStore to keep the files in
+        """
+        self.target = target
+        self.store = store
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_bytes(self, relpath, data):
+        """Writes data, a bytes object, to relpath."""
+        digest = self.store.put(data)
+        self.target.write_file(relpath, self.store.path_of(digest), True)
+
+    def write_chunks(self, relpath, chunks):
+        """Writes an iterable of bytes chunks to relpath."""
+        digest = self.store.put_chunks(chunks)
+        self.target.write_file(relpath, self.store.path_of(digest), True)
+
+    def write_file(self, relpath, source, link=False):
+        """Writes the file at path source to relpath."""
+        with open(source, 'rb') as f:
+            self.write_chunks(relpath, iter(lambda: f.read(64 * 1024), b''))
+
+    def close(self):
+        self.target.close()
+
+
+def open_state(directory):
+    """
+    Returns the (ContentStore, AssetManifest) pair kept below directory for
+     incremental exports into it.
+
+    Parameters:
+        directory: directory the exports are written in
+    """
+    stateDir = os.path.join(directory, STORE_DIR)
+    return (ContentStore(os.path.join(stateDir, OBJECTS_DIR)),
+            AssetManifest(os.path.join(stateDir, MANIFEST_NAME)))
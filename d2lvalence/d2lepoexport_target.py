@@ -0,0 +1,233 @@
+"""
+Provides output targets for ePortfolio exports. A target receives files by
+relative path and writes them into a directory, a zip archive or a tar
+archive, so exporters never need to change the current working directory and
+can safely be run from several threads at once.
+"""
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+
+# Files larger than this are spooled to disk, rather than memory, while they
+# wait for their turn to be written into an archive
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+def clean_relpath(relpath):
+    """
+    Returns relpath as a normalized, '/'-separated relative path. Raises
+    ValueError for paths that would escape the target.
+
+    Parameters:
+        relpath: relative path of a file within a target as a string
+    """
+    path = posixpath.normpath(relpath.replace('\\', '/'))
+    if path.startswith('/') or path == '.' or path == '..' or \
+            path.startswith('../'):
+        raise ValueError('Target path must stay inside the target: ' + relpath)
+    return path
+
+
+def safe_filename(name):
+    """
+    Returns name with path separators and other troublesome characters
+    replaced, for use as a single path component.
+
+    Parameters:
+        name: file name as a string, such as epFileArtifact.FileName
+    """
+    name = name.strip()
+    for character in '/\\:*?"<>|\0':
+        name = name.replace(character, '_')
+    if name in ('', '.', '..'):
+        name = '_'
+    return name
+
+
+class DirectoryTarget(object):
+    """
+    Writes exported files below a directory on disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _full_path(self, relpath):
+        full_path = os.path.join(self.path, *clean_relpath(relpath).split('/'))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        # files may be hard links into a content store, so they are replaced
+        # rather than written over
+        if os.path.lexists(full_path):
+            os.remove(full_path)
+        return full_path
+
+    def write_bytes(self, relpath, data):
+        """Writes data, a bytes object, to relpath."""
+        with open(self._full_path(relpath), 'wb') as f:
+            f.write(data)
+
+    def write_chunks(self, relpath, chunks):
+        """Writes an iterable of bytes chunks to relpath as they arrive."""
+        with open(self._full_path(relpath), 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def write_file(self, relpath, source, link=False):
+        """
+        Writes a copy of the file at path source to relpath, or a hard link to
+         it if link is true and the file system allows one.
+        """
+        full_path = self._full_path(relpath)
+        if link:
+            try:
+                os.link(source, full_path)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source, full_path)
+
+    def close(self):
+        pass
+
+
+class _ArchiveTarget(object):
+    """
+    Shared behaviour of the archive targets: archives can only take one member
+    at a time, so incoming chunks are spooled first and then written while
+    holding the target's lock. Writing a path twice keeps the first file.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_bytes(self, relpath, data):
+        """Writes data, a bytes object, to relpath."""
+        relpath = clean_relpath(relpath)
+        with self._lock:
+            if self._claim(relpath):
+                self._add_bytes(relpath, data)
+
+    def write_chunks(self, relpath, chunks):
+        """Writes an iterable of bytes chunks to relpath."""
+        relpath = clean_relpath(relpath)
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            for chunk in chunks:
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+            with self._lock:
+                if self._claim(relpath):
+                    self._add_file(relpath, spool, size)
+
+    def write_file(self, relpath, source, link=False):
+        """Writes a copy of the file at path source to relpath."""
+        relpath = clean_relpath(relpath)
+        with open(source, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            with self._lock:
+                if self._claim(relpath):
+                    self._add_file(relpath, f, size)
+
+    def _claim(self, relpath):
+        # archives cannot replace a member, so the first file written to a
+        # path wins and later writes to it are dropped
+        if relpath in self._names:
+            return False
+        self._names.add(relpath)
+        return True
+
+
+class ZipTarget(_ArchiveTarget):
+    """
+    Writes exported files into a zip archive, given as a path or as a writable
+    file object.
+    """
+    def __init__(self, path_or_file, compression=zipfile.ZIP_DEFLATED):
+        _ArchiveTarget.__init__(self)
+        self.archive = zipfile.ZipFile(path_or_file, 'w', compression)
+
+    def _add_bytes(self, relpath, data):
+        self.archive.writestr(relpath, data)
+
+    def _add_file(self, relpath, f, size):
+        info = zipfile.ZipInfo(relpath, time.localtime()[:6])
+        info.compress_type = self.archive.compression
+        info.file_size = size
+        with self.archive.open(info, 'w') as member:
+            shutil.copyfileobj(f, member)
+
+    def close(self):
+        with self._lock:
+            self.archive.close()
+
+
+class TarTarget(_ArchiveTarget):
+    """
+    Writes exported files into a tar archive, given as a path or as a writable
+    file object. mode is any tarfile write mode, such as 'w:gz', or a stream
+    mode such as 'w|gz' for non-seekable file objects.
+    """
+    def __init__(self, path_or_file, mode='w'):
+        _ArchiveTarget.__init__(self)
+        if isinstance(path_or_file, str):
+            self.archive = tarfile.open(path_or_file, mode)
+        else:
+            self.archive = tarfile.open(fileobj=path_or_file, mode=mode)
+
+    def _add_bytes(self, relpath, data):
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+            spool.write(data)
+            spool.seek(0)
+            self._add_file(relpath, spool, len(data))
+
+    def _add_file(self, relpath, f, size):
+        info = tarfile.TarInfo(relpath)
+        info.size = size
+        info.mtime = time.time()
+        self.archive.addfile(info, f)
+
+    def close(self):
+        with self._lock:
+            self.archive.close()
+
+
+def open_target(destination):
+    """
+    Returns an output target for destination. Existing targets are returned
+    unchanged; paths ending in .zip, .tar, .tar.gz, .tgz or .tar.bz2 open an
+    archive; any other path is treated as a directory.
+
+    Parameters:
+        destination: a target object or a path as a string
+    """
+    if not isinstance(destination, str):
+        return destination
+    lowered = destination.lower()
+    if lowered.endswith('.zip'):
+        return ZipTarget(destination)
+    elif lowered.endswith('.tar.gz') or lowered.endswith('.tgz'):
+        return TarTarget(destination, 'w:gz')
+    elif lowered.endswith('.tar.bz2'):
+        return TarTarget(destination, 'w:bz2')
+    elif lowered.endswith('.tar'):
+        return TarTarget(destination, 'w')
+    else:
+        return DirectoryTarget(destination)
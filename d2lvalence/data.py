@@ -880,6 +880,22 @@ class GroupCategoryDataFetch(D2LStructure):
     def Groups(self):
         return self.props['Groups']
 
+class GroupData(D2LStructure):
+    def __init__(self,json_dict):
+        D2LStructure.__init__(self,json_dict)
+
+    GroupId = property(_get_number_prop('GroupId'))
+    Name = property(_get_string_prop('Name'))
+    Code = property(_get_string_prop('Code'))
+
+    @property
+    def Description(self):
+        return self.props['Description']
+
+    @property
+    def Enrollments(self):
+        return self.props['Enrollments']
+
 ## Grades concrete classes
 class GradeObject(D2LStructure):
     def __init__(self,json_dict):
@@ -3,8 +3,10 @@ Provides functions for retrieving information from D2L Valence ePortfolio and
 support for handling ePortfolio data structures. This code does not support
 uploading to ePortfolio.
 """
-from xml.etree.ElementTree import Element, tostring
-import xml.dom.minidom
+import json
+import os
+from xml.etree.ElementTree import Element
+from xml.sax.saxutils import XMLGenerator
 # d2lvalence_util.data to build on abstract D2L structures
 import data as d2l_data
 # d2lvalence_util.service to build on abstract D2L functions
@@ -43,6 +45,59 @@ OBJRIGHT_T = {
     'AddAssessments': 5,
     'Edit': 6, }
 
+
+def _reverse(constants):
+    # value -> name lookup; the first name listed wins if values repeat
+    names = {}
+    for (k, v) in constants.items():
+        names.setdefault(v, k)
+    return names
+
+# Text labels for ObjectTypeId and permission values
+EPOBJ_NAMES = _reverse(EPOBJ_T)
+OBJRIGHT_NAMES = _reverse(OBJRIGHT_T)
+
+##########
+# Caches #
+##########
+
+# ObjectTypeId of every ePortfolio object seen so far, keyed by ObjectId. Used
+# by get_ep_object_properties to go straight to the type-specific route.
+_ep_object_type_cache = {}
+
+
+def cache_ep_object_type(object_id, object_type_id):
+    """Remember the ObjectTypeId of an ePortfolio object."""
+    _ep_object_type_cache[int(object_id)] = int(object_type_id)
+
+
+def get_cached_ep_object_type(object_id):
+    """Return the cached ObjectTypeId of an ePortfolio object, or None."""
+    return _ep_object_type_cache.get(int(object_id))
+
+
+def clear_ep_object_type_cache():
+    """Forget all cached ePortfolio object types."""
+    _ep_object_type_cache.clear()
+
+
+def _cache_ep_object_types(props_list):
+    """Fill the object type cache from a list of object property dicts."""
+    for props in props_list:
+        if 'ObjectId' in props and 'ObjectTypeId' in props:
+            cache_ep_object_type(props['ObjectId'], props['ObjectTypeId'])
+
+
+def _copy_kwargs(kwargs):
+    """
+    Return a copy of kwargs with its own params dict, so route functions that
+    update params (bookmark, c, ...) do not leak into the caller's dict.
+    """
+    copied = dict(kwargs)
+    copied['params'] = dict(kwargs.get('params') or {})
+    return copied
+
+
 ##############
 # Structures #
 ##############
@@ -65,6 +120,15 @@ def dict_to_xml(tag, d):
     return elem
 
 
+def descriptive_permissions(permission_codes):
+    """
+    Return list of text labels for a list of OBJRIGHT_T permission codes.
+    Unknown codes are left out.
+    """
+    return [OBJRIGHT_NAMES[code] for code in permission_codes
+            if code in OBJRIGHT_NAMES]
+
+
 class epObject(d2l_data.D2LStructure):
     """
     Structure of ePortfolio object properties returned from D2L.
@@ -107,18 +171,11 @@ class epObject(d2l_data.D2LStructure):
 
     def descriptive_object_type_id(self):
         """Return text labels for this instance's ObjectTypeId"""
-        for (k, v) in EPOBJ_T.items():
-            if v == self.ObjectTypeId:
-                return k
+        return EPOBJ_NAMES.get(self.ObjectTypeId)
 
     def descriptive_permissions(self):
         """Return list of text labels for this instance's Permssions list"""
-        perm_list = []
-        for permission in self.Permissions:
-            for (k, v) in OBJRIGHT_T.items():
-                if v == permission:
-                    perm_list.append(k)
-        return perm_list
+        return descriptive_permissions(self.Permissions)
 
 
 class epFileArtifact(epObject):
@@ -202,34 +259,53 @@ def get_ep_object_properties(uc,
     Return an ePortfolio object by ID. Checks whether this is a specific type
     of ePortfolio object and return appropriate data corresponding to type.
 
+    When the object's ObjectTypeId is already in the object type cache (filled
+    by get_ep_objects listings and earlier fetches), the type-specific route is
+    called directly, so the object costs a single request.
+
     Parameters:
         uc: user context, from d2lvalence.auth.fashion_user_context
         object_id: an ePortfolio object's unique identifier
         ver (optional): ePortfolio API version as a String
         c (optional): include comments attached to object if true
     """
-    kwargs.setdefault('params', {})
-    if c:
-        kwargs['params'].update({'c': c})
-    route = '/d2l/api/eP/{0}/object/{1}'.format(ver, object_id)
-    # Gets generic ePortfolio object properties
-    r = d2l_service._get(route, uc, **kwargs)
+    type_id = get_cached_ep_object_type(object_id)
+    if type_id is None:
+        # Gets generic ePortfolio object properties
+        generic = get_ep_object(uc, object_id, ver, c, **kwargs)
+        type_id = generic.ObjectTypeId
+        if type_id not in _EP_TYPED_GETTERS:
+            return generic
 
     # Gets specific object properties for unique epObject types
-    if r['ObjectTypeId'] == EPOBJ_T.get('file_artifact'):
-        return get_ep_file_artifact(uc, object_id, ver, c, **kwargs)
+    getter = _EP_TYPED_GETTERS.get(type_id, get_ep_object)
+    return getter(uc, object_id, ver, c, **kwargs)
 
-    elif r['ObjectTypeId'] == EPOBJ_T.get('url_artifact'):
-        return get_ep_url_artifact(uc, object_id, ver, c, **kwargs)
 
-    elif r['ObjectTypeId'] == EPOBJ_T.get('collection'):
-        return get_ep_collection(uc, object_id, ver, c, **kwargs)
-
-    elif r['ObjectTypeId'] == EPOBJ_T.get('presentation'):
-        return get_ep_presentation(uc, object_id, ver, c, **kwargs)
+def get_ep_objects_properties(uc,
+                              object_id_list,
+                              ver='2.3',
+                              c=False,
+                              **kwargs):
+    """
+    Return a dict of ePortfolio objects keyed by ObjectId. Object types are
+    resolved in bulk first with resolve_ep_object_types, so each object is then
+    fetched with a single request to its type-specific route.
 
-    else:
-        return epObject(r)
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        object_id_list: iterable of ePortfolio object unique identifiers
+        ver (optional): ePortfolio API version as a String
+        c (optional): include comments attached to object if true
+    """
+    object_ids = [int(object_id) for object_id in object_id_list]
+    resolve_ep_object_types(uc, object_ids, ver, **kwargs)
+    result = {}
+    for object_id in object_ids:
+        if object_id not in result:
+            result[object_id] = get_ep_object_properties(uc, object_id, ver,
+                                                         c, **kwargs)
+    return result
 
 
 def get_ep_object(uc,
@@ -251,6 +327,7 @@ def get_ep_object(uc,
         kwargs['params'].update({'c': c})
     route = '/d2l/api/eP/{0}/object/{1}'.format(ver, object_id)
     r = d2l_service._get(route, uc, **kwargs)
+    _cache_ep_object_types([r])
     return epObject(r)
 
 
@@ -273,6 +350,7 @@ def get_ep_file_artifact(uc,
         kwargs['params'].update({'c': c})
     route = '/d2l/api/eP/{0}/artifact/file/{1}'.format(ver, object_id)
     r = d2l_service._get(route, uc, **kwargs)
+    _cache_ep_object_types([r])
     return epFileArtifact(r)
 
 
@@ -295,6 +373,7 @@ def get_ep_url_artifact(uc,
         kwargs['params'].update({'c': c})
     route = '/d2l/api/eP/{0}/artifact/link/{1}'.format(ver, object_id)
     r = d2l_service._get(route, uc, **kwargs)
+    _cache_ep_object_types([r])
     return epUrlArtifact(r)
 
 
@@ -318,6 +397,8 @@ def get_ep_collection(uc,
     route = '/d2l/api/eP/{0}/collection/{1}/contents/'.format(ver,
                                                               object_id)
     r = d2l_service._get(route, uc, **kwargs)
+    _cache_ep_object_types([r])
+    _cache_ep_object_types(r.get('Items') or [])
     return epCollection(r)
 
 
@@ -340,9 +421,27 @@ def get_ep_presentation(uc,
         kwargs['params'].update({'c': c})
     route = '/d2l/api/eP/{0}/presentation/{1}'.format(ver, object_id)
     r = d2l_service._get(route, uc, **kwargs)
+    _cache_ep_object_types([r])
     return epPresentation(r)
 
 
+# Type-specific getters used by get_ep_object_properties, keyed by ObjectTypeId
+_EP_TYPED_GETTERS = {
+    EPOBJ_T['file_artifact']: get_ep_file_artifact,
+    EPOBJ_T['url_artifact']: get_ep_url_artifact,
+    EPOBJ_T['collection']: get_ep_collection,
+    EPOBJ_T['presentation']: get_ep_presentation, }
+
+
+def has_typed_properties(object_type_id):
+    """
+    Return True if objects of this ObjectTypeId have a type-specific route
+    with more properties than the generic object route (and the get_ep_objects
+    listing) provides.
+    """
+    return int(object_type_id) in _EP_TYPED_GETTERS
+
+
 def get_ep_object_content(uc,
                           object_id,
                           ver='2.3',
@@ -359,9 +458,28 @@ def get_ep_object_content(uc,
     return d2l_service._get(route, uc, **kwargs)
 
 
+def get_ep_object_content_stream(uc,
+                                 object_id,
+                                 ver='2.3',
+                                 **kwargs):
+    """
+    Return a streaming response for the associated file(s) of an ePortfolio
+    object. Read it in chunks with response.iter_content() and close it when
+    done; unlike get_ep_object_content, the file is never held in memory.
+
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        object_id: an ePortfolio object's unique identifier
+        ver (optional): ePortfolio API version as a String
+    """
+    route = '/d2l/api/eP/{0}/object/{1}/content'.format(ver, object_id)
+    return d2l_service._get_stream(route, uc, **kwargs)
+
+
 def get_ep_comment(uc,
                    object_id,
                    ver='2.3',
+                   bookmark='',
                    **kwargs):
     """
     Return the comments for an ePortfolio object identified by its ID.
@@ -370,6 +488,8 @@ def get_ep_comment(uc,
         uc: user context, from d2lvalence.auth.fashion_user_context
         object_id: an ePortfolio object's unique identifier
         ver (optional): ePortfolio API version as a String
+        bookmark (optional): Bookmark of the previous data segment, passed to
+         get the next data segment
 
     Return data includes two properties:
 
@@ -387,10 +507,37 @@ def get_ep_comment(uc,
         Body: string containing the comment body in HTML
     """
     route = '/d2l/api/eP/{0}/object/{1}/comments/'.format(ver, object_id)
+    if bookmark:
+        kwargs.setdefault('params', {})
+        kwargs['params'].update({'bookmark': bookmark})
     r = d2l_service._get(route, uc, **kwargs)
     return d2l_data.PagedResultSet(r)
 
 
+def iter_ep_comments(uc,
+                     object_id,
+                     ver='2.3',
+                     **kwargs):
+    """
+    Lazily yield every comment on an ePortfolio object, fetching the next data
+    segment of get_ep_comment only when the previous one has been consumed.
+
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        object_id: an ePortfolio object's unique identifier
+        ver (optional): ePortfolio API version as a String
+    """
+    bookmark = ''
+    while True:
+        page = get_ep_comment(uc, object_id, ver, bookmark,
+                              **_copy_kwargs(kwargs))
+        for comment in page.Items:
+            yield comment
+        if not page.has_more_items() or not page.Items:
+            break
+        bookmark = page.Bookmark
+
+
 def get_ep_tag(uc,
                object_id,
                ver='2.3',
@@ -451,9 +598,79 @@ def get_ep_objects(uc,
     if pagesize:
         kwargs['params'].update({'pagesize': pagesize})
     r = d2l_service._get(route, uc, **kwargs)
+    _cache_ep_object_types(r['Items'])
     return d2l_data.PagedResultSet(r)
 
 
+def iter_ep_objects(uc,
+                    ver='2.3',
+                    c=False,
+                    q='',
+                    pagesize=None,
+                    **kwargs):
+    """
+    Lazily yield the property dicts of all ePortfolio objects owned by the
+    current user context, fetching the next data segment of get_ep_objects only
+    when the previous one has been consumed.
+
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        ver (optional): ePortfolio API version as a String
+        c (optional): set to True to include comments
+        q (optional): query filter expression as a String to filter results
+        pagesize (optional): int number of entries to return per data segment
+    """
+    bookmark = ''
+    while True:
+        page = get_ep_objects(uc, ver, c, q, bookmark, pagesize,
+                              **_copy_kwargs(kwargs))
+        for item in page.Items:
+            yield item
+        if not page.has_more_items() or not page.Items:
+            break
+        bookmark = page.Bookmark
+
+
+def resolve_ep_object_types(uc,
+                            object_id_list,
+                            ver='2.3',
+                            use_listing=True,
+                            pagesize=None,
+                            **kwargs):
+    """
+    Return a dict of ObjectTypeId values keyed by ObjectId for many ePortfolio
+    objects at once, filling the object type cache along the way.
+
+    Ids already in the cache cost nothing. The rest are looked for in the
+    get_ep_objects listing of the current user context, one page at a time,
+    until all of them are found; any left over (such as objects shared with
+    the user) are fetched individually.
+
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        object_id_list: iterable of ePortfolio object unique identifiers
+        ver (optional): ePortfolio API version as a String
+        use_listing (optional): set to False to skip the get_ep_objects
+         listing and fetch uncached objects individually
+        pagesize (optional): int number of entries per listing data segment
+    """
+    object_ids = set(int(object_id) for object_id in object_id_list)
+    missing = set(object_id for object_id in object_ids
+                  if get_cached_ep_object_type(object_id) is None)
+
+    if missing and use_listing:
+        for item in iter_ep_objects(uc, ver, pagesize=pagesize, **kwargs):
+            missing.discard(int(item['ObjectId']))
+            if not missing:
+                break
+
+    for object_id in missing:
+        get_ep_object(uc, object_id, ver, **_copy_kwargs(kwargs))
+
+    return dict((object_id, get_cached_ep_object_type(object_id))
+                for object_id in object_ids)
+
+
 ##############
 # PROCESSING #
 ##############
@@ -470,31 +687,24 @@ def get_ep_properties_as_xml(uc, object_id, ver='2.3', c=False, **kwargs):
         c (optional): include comments attached to object if true
     """
     obj_props = get_ep_object_properties(uc, object_id, ver, c, **kwargs)
-    xml_element = Element(obj_props.descriptive_object_type_id())
-    for (key, val) in obj_props.as_dict().items():
-        if c:
-            if key == 'Comments':
-                comment_section = Element('Comments')
-                for comment in val:
-                    comment_element = dict_to_xml('Comment', comment)
-                    comment_section.append(comment_element)
-                xml_element.append(comment_section)
-        elif key == 'Tags':
-            if val is not None:
-                tag_section = Element('Tags')
-                for tag in val:
-                    tag_element = dict_to_xml('Tag', tag)
-                    tag_section.append(tag_element)
-                xml_element.append(tag_section)
-        elif key == 'Permissions':
-            perms_element = Element('Permissions')
-            perms = []
-            for permission_code in val:
-                for (k, v) in OBJRIGHT_T.items():
-                    if v == permission_code:
-                        perms.append(k)
-            perms_element.text = str(perms)
-            xml_element.append(perms_element)
+    return ep_properties_to_xml(obj_props, c)
+
+
+def ep_properties_to_xml(obj_props, c=False):
+    """
+    Returns already fetched ePortfolio object properties formatted in XML.
+
+    Parameters:
+        obj_props: an epObject, from get_ep_object_properties
+        c (optional): include comments attached to object if true
+    """
+    xml_element = Element(_xml_tag(obj_props))
+    for (key, val) in _ep_metadata_items(obj_props, c):
+        if key in ('Comments', 'Tags'):
+            section = Element(key)
+            for item in val:
+                section.append(dict_to_xml(key[:-1], item))
+            xml_element.append(section)
         else:
             child = Element(key)
             child.text = str(val)
@@ -502,7 +712,145 @@ def get_ep_properties_as_xml(uc, object_id, ver='2.3', c=False, **kwargs):
     return xml_element
 
 
-def get_ep_object_metadata(uc, object_id, ver='2.3', c=False, **kwargs):
+def _xml_tag(obj_props):
+    return obj_props.descriptive_object_type_id() or 'ep_object'
+
+
+def _ep_metadata_items(obj_props, c=False):
+    """
+    Yields the (key, value) pairs of an object's properties as they appear in
+    its metadata: comments only if c is true, tags only if there are any, and
+    permissions as a list of text labels.
+    """
+    for (key, val) in obj_props.as_dict().items():
+        if key == 'Comments':
+            if c and val is not None:
+                yield (key, val)
+        elif key == 'Tags':
+            if val is not None:
+                yield (key, val)
+        elif key == 'Permissions':
+            yield (key, descriptive_permissions(val or []))
+        else:
+            yield (key, val)
+
+
+class epXMLMetadataWriter(object):
+    """
+    Writes the metadata of any number of ePortfolio objects into one XML
+    document as they are fetched, without building a document tree. Objects
+    are written as by ep_properties_to_xml, inside one root element.
+    """
+    def __init__(self, f, c=False, root='ePortfolio', encoding='utf-8'):
+        """
+        Parameters:
+            f: binary file object to write to
+            c (optional): include comments attached to objects if true
+            root (optional): tag of the root element; None writes a single
+             object as the root element, as write_ep_object_metadata_xml does
+            encoding (optional): character encoding of the document
+        """
+        self.c = c
+        self.root = root
+        self.count = 0
+        self._xml = XMLGenerator(f, encoding, short_empty_elements=True)
+        self._xml.startDocument()
+        self._depth = 0
+        if root is not None:
+            self._xml.startElement(root, {})
+            self._depth = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, obj_props):
+        """Writes the metadata of an epObject."""
+        if self.root is None and self.count:
+            raise ValueError('Only one object can be written without a root')
+        depth = self._depth
+        tag = _xml_tag(obj_props)
+        if depth:
+            self._newline(depth)
+        self._xml.startElement(tag, {})
+        for (key, val) in _ep_metadata_items(obj_props, self.c):
+            self._newline(depth + 1)
+            if key in ('Comments', 'Tags'):
+                self._xml.startElement(key, {})
+                for item in val:
+                    self._newline(depth + 2)
+                    self._write_dict(key[:-1], item, depth + 3)
+                self._newline(depth + 1)
+                self._xml.endElement(key)
+            else:
+                self._text_element(key, val)
+        self._newline(depth)
+        self._xml.endElement(tag)
+        self.count += 1
+
+    def close(self):
+        """Ends the document. The file itself is left open."""
+        if self.root is not None:
+            self._newline(0)
+            self._xml.endElement(self.root)
+        self._xml.ignorableWhitespace('\n')
+        self._xml.endDocument()
+
+    def _write_dict(self, tag, d, depth):
+        self._xml.startElement(tag, {})
+        for (key, val) in d.items():
+            self._newline(depth)
+            self._text_element(key, val)
+        self._newline(depth - 1)
+        self._xml.endElement(tag)
+
+    def _text_element(self, key, val):
+        self._xml.startElement(key, {})
+        self._xml.characters(str(val))
+        self._xml.endElement(key)
+
+    def _newline(self, depth):
+        self._xml.ignorableWhitespace('\n' + '\t' * depth)
+
+
+class epJSONLMetadataWriter(object):
+    """
+    Writes the metadata of any number of ePortfolio objects into a JSON Lines
+    file, one JSON object per line, as they are fetched. Each line holds the
+    object's metadata, as for epXMLMetadataWriter, plus its ObjectType label.
+    """
+    def __init__(self, f, c=False):
+        """
+        Parameters:
+            f: text file object to write to
+            c (optional): include comments attached to objects if true
+        """
+        self.f = f
+        self.c = c
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, obj_props):
+        """Writes the metadata of an epObject."""
+        line = dict(_ep_metadata_items(obj_props, self.c))
+        line['ObjectType'] = obj_props.descriptive_object_type_id()
+        self.f.write(json.dumps(line) + '\n')
+        self.count += 1
+
+    def close(self):
+        """Flushes the file, which is left open."""
+        self.f.flush()
+
+
+def get_ep_object_metadata(uc, object_id, ver='2.3', c=False, directory='',
+                           **kwargs):
     """
     Downloads an ePortfolio object's properties into a .txt file.
 
@@ -511,13 +859,29 @@ def get_ep_object_metadata(uc, object_id, ver='2.3', c=False, **kwargs):
         object_id: an ePortfolio object's unique identifier
         ver (optional): ePortfolio API version as a String
         c (optional): include comments attached to object if true
+        directory (optional): directory to write into, instead of the current
+         working directory
     """
     metadata = get_ep_object_properties(uc, object_id, ver, c, **kwargs)
-    with open(metadata.Name + "_metadata.txt", 'wb+') as download:
+    write_ep_object_metadata(metadata, directory)
+
+
+def write_ep_object_metadata(metadata, directory=''):
+    """
+    Writes already fetched ePortfolio object properties into a .txt file.
+
+    Parameters:
+        metadata: an epObject, from get_ep_object_properties
+        directory (optional): directory to write into, instead of the current
+         working directory
+    """
+    filename = os.path.join(directory, metadata.Name + "_metadata.txt")
+    with open(filename, 'wb+') as download:
         download.write(str(metadata).encode('utf-8'))
 
 
-def get_ep_object_metadata_xml(uc, object_id, ver='2.3', c=False, **kwargs):
+def get_ep_object_metadata_xml(uc, object_id, ver='2.3', c=False,
+                               directory='', **kwargs):
     """
     Downloads an ePortfolio object's properties into a .xml file.
 
@@ -526,57 +890,99 @@ def get_ep_object_metadata_xml(uc, object_id, ver='2.3', c=False, **kwargs):
         object_id: an ePortfolio object's unique identifier
         ver (optional): ePortfolio API version as a String
         c (optional): include comments attached to object if true
+        directory (optional): directory to write into, instead of the current
+         working directory
     """
-    metadata = get_ep_properties_as_xml(uc, object_id, ver, c, **kwargs)
-    filename = str(tostring(metadata.find('Name')))[8:-8]
-    with open(filename + "_metadata.xml", 'w+') as download:
-        with xml.dom.minidom.parseString(tostring(metadata,
-                                                  encoding='utf-8'))as dom:
-            dom.writexml(download, addindent="\t", newl="\n")
+    metadata = get_ep_object_properties(uc, object_id, ver, c, **kwargs)
+    write_ep_object_metadata_xml(metadata, c, directory)
+
+
+def write_ep_object_metadata_xml(metadata, c=False, directory=''):
+    """
+    Writes already fetched ePortfolio object properties into a .xml file.
+
+    Parameters:
+        metadata: an epObject, from get_ep_object_properties
+        c (optional): include comments attached to object if true
+        directory (optional): directory to write into, instead of the current
+         working directory
+    """
+    filename = os.path.join(directory, metadata.Name + "_metadata.xml")
+    with open(filename, 'wb+') as download:
+        with epXMLMetadataWriter(download, c, root=None) as writer:
+            writer.write(metadata)
 
 
 def get_ep_object_with_metadata(uc, object_id, ver='2.3', c=False, xml=False,
-                                **kwargs):
+                                directory='', manifest=None, **kwargs):
     """
     Downloads an ePortfolio object and a .txt file of ePortfolio object
-    properties.
+    properties. Each object's properties are fetched once, and objects shared
+    by several collections are only downloaded once. To export a user's whole
+    portfolio in parallel, see d2lepoexport_portfolio.archive_ep_portfolio.
 
     Parameters:
         uc: user context, from d2lvalence.auth.fashion_user_context
         object_id: an ePortfolio object's unique identifier
         ver (optional): ePortfolio API version as a String
         c (optional): include comments attached to object if true
-    """
-    if xml:
-        get_ep_object_metadata_xml(uc, object_id, ver, c, **kwargs)
+        xml (optional): write metadata as .xml rather than .txt if true
+        directory (optional): directory to write into, instead of the current
+         working directory
+        manifest (optional): epXMLMetadataWriter or epJSONLMetadataWriter to
+         write the metadata of every object into, instead of one file each
+    """
+    seen = set()
+    pending = [object_id]
+    while pending:
+        object_id = int(pending.pop())
+        if object_id in seen:
+            continue
+        seen.add(object_id)
+        metadata = get_ep_object_properties(uc, object_id, ver, c, **kwargs)
+        pending.extend(_write_ep_object_with_metadata(uc, metadata, ver, c,
+                                                      xml, directory,
+                                                      manifest, **kwargs))
+
+
+def _write_ep_object_with_metadata(uc, metadata, ver, c, xml, directory,
+                                   manifest=None, **kwargs):
+    """
+    Writes one already fetched ePortfolio object and its metadata. Returns the
+    ids of the items it contains, if it is a collection.
+    """
+    if manifest is not None:
+        manifest.write(metadata)
+    elif xml:
+        write_ep_object_metadata_xml(metadata, c, directory)
     else:
-        get_ep_object_metadata(uc, object_id, ver, c, **kwargs)
+        write_ep_object_metadata(metadata, directory)
 
-    metadata = get_ep_object_properties(uc, object_id, ver, c, **kwargs)
     type = metadata.ObjectTypeId
 
     if type == EPOBJ_T.get('file_artifact'):
-        download_stream = get_ep_object_content(uc, object_id, ver, **kwargs)
-        with open(metadata.FileName, 'wb+') as file:
+        download_stream = get_ep_object_content(uc, metadata.ObjectId, ver,
+                                                **kwargs)
+        with open(os.path.join(directory, metadata.FileName), 'wb+') as file:
             file.write(download_stream)
 
     elif type == EPOBJ_T.get('url_artifact'):
-        with open(metadata.Name + ".txt", 'w+') as file:
+        with open(os.path.join(directory, metadata.Name + ".txt"),
+                  'w+') as file:
             file.write(metadata.Name + "\n")
             file.write(metadata.Url + "\n")
             file.write(metadata.Description)
 
     elif type == EPOBJ_T.get('collection'):
-        for item_id in metadata.ItemIds:
-            get_ep_object_with_metadata(uc, item_id, ver, c, xml, **kwargs)
+        return metadata.ItemIds
 
     elif type == EPOBJ_T.get('presentation'):
-        d2lepoexport_presentation.download_presentation(metadata, uc)
+        d2lepoexport_presentation.download_presentation(metadata, uc,
+                                                        directory)
 
     else:
-        with open(metadata.Name + ".txt", 'w+') as file:
+        with open(os.path.join(directory, metadata.Name + ".txt"),
+                  'w+') as file:
             file.write(metadata.Name + "\n")
             file.write(metadata.Description)
-
-
-# function to download all content with metadata
+    return []
@@ -0,0 +1,166 @@
+"""
+Provides a harvester that collects the comments and tags of many ePortfolio
+objects. Objects are handled by a bounded pool of worker threads, every page
+of each object's comments is read, and each object's record is handed to a
+sink as soon as it is complete, so memory use does not grow with the number
+of objects. Comments and tags already included in object properties fetched
+with c=True are used as they are, saving the separate requests.
+
+Records passed to the sink are dicts:
+    {'ObjectId': <int>, 'Tags': [<tag dicts>], 'Comments': [<comment dicts>]}
+or, for objects that could not be harvested:
+    {'ObjectId': <int>, 'Error': <message>}
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import threading
+
+import eportfolio
+
+
+class epJSONLSink(object):
+    """
+    Sink writing each harvested record as one line of JSON to a text file.
+    """
+    def __init__(self, f):
+        """
+        Parameters:
+            f: text file object to write to
+        """
+        self.f = f
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self.f.write(line)
+            self.count += 1
+
+
+class epHarvester(object):
+    """
+    Harvests the comments and tags of ePortfolio objects with a pool of worker
+    threads, writing a record per object to a sink.
+    """
+    def __init__(self, uc, sink, ver='2.3', max_workers=8, inline=True,
+                 **kwargs):
+        """
+        Parameters:
+            uc: user context, from d2lvalence.auth.fashion_user_context
+            sink: callable taking each record, such as an epJSONLSink
+            ver (optional): ePortfolio API version as a String
+            max_workers (optional): number of objects harvested at once
+            inline (optional): fetch each object's properties with c=True and
+             use the comments and tags they include, rather than requesting
+             comments and tags separately
+        """
+        self.uc = uc
+        self.sink = sink
+        self.ver = ver
+        self.max_workers = max_workers
+        self.inline = inline
+        self.kwargs = kwargs
+        self.errors = {}
+
+    def harvest(self, objects):
+        """
+        Harvests every object and returns the number of records written.
+         Objects that fail are written as error records and kept in errors.
+
+        Parameters:
+            objects: iterable of ePortfolio object identifiers, or of object
+             properties (dicts or epObjects) such as those listed by
+             eportfolio.iter_ep_objects with c=True, whose inline comments
+             and tags are then used
+        """
+        written = 0
+        pending = {}
+        # a bounded window of objects in flight keeps memory flat however
+        # long the iterable is
+        window = self.max_workers * 2
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for obj in objects:
+                if len(pending) >= window:
+                    written += self._drain(pending, FIRST_COMPLETED)
+                pending[pool.submit(self.harvest_one, obj)] = obj
+            written += self._drain(pending, None)
+        return written
+
+    def harvest_one(self, obj):
+        """
+        Returns the record of one object.
+
+        Parameters:
+            obj: an ePortfolio object identifier or object properties
+        """
+        if isinstance(obj, eportfolio.epObject):
+            props = obj.as_dict()
+        elif isinstance(obj, dict):
+            props = obj
+        elif self.inline:
+            props = eportfolio.get_ep_object_properties(
+                self.uc, obj, self.ver, True,
+                **eportfolio._copy_kwargs(self.kwargs)).as_dict()
+        else:
+            props = {'ObjectId': int(obj)}
+        object_id = int(props['ObjectId'])
+        return {'ObjectId': object_id,
+                'Tags': self._tags(object_id, props),
+                'Comments': self._comments(object_id, props)}
+
+    def _tags(self, object_id, props):
+        if props.get('Tags') is not None:
+            return props['Tags']
+        return eportfolio.get_ep_tag(self.uc, object_id, self.ver,
+                                     **eportfolio._copy_kwargs(self.kwargs))
+
+    def _comments(self, object_id, props):
+        comments = props.get('Comments')
+        # inline comments can be used if they are all there; CommentsCount
+        # says how many the object has
+        if comments is not None and \
+                len(comments) >= (props.get('CommentsCount') or 0):
+            return comments
+        if props.get('CommentsCount') == 0:
+            return []
+        return list(eportfolio.iter_ep_comments(self.uc, object_id, self.ver,
+                                                **self.kwargs))
+
+    def _drain(self, pending, return_when):
+        # writes the records of finished objects; waits for all of them if
+        # return_when is None
+        if return_when is None:
+            done = list(pending)
+        else:
+            done = wait(pending, return_when=return_when)[0]
+        for future in done:
+            obj = pending.pop(future)
+            try:
+                record = future.result()
+            except Exception as e:
+                object_id = obj.get('ObjectId') if isinstance(obj, dict) \
+                    else getattr(obj, 'ObjectId', obj)
+                self.errors[object_id] = e
+                record = {'ObjectId': object_id, 'Error': str(e)}
+            self.sink(record)
+        return len(done)
+
+
+def harvest_ep_comments_and_tags(uc, objects, sink, ver='2.3', max_workers=8,
+                                 inline=True, **kwargs):
+    """
+    Harvests the comments and tags of ePortfolio objects into a sink and
+    returns the number of records written. See epHarvester.
+
+    Parameters:
+        uc: user context, from d2lvalence.auth.fashion_user_context
+        objects: iterable of object identifiers or object properties
+        sink: callable taking each record, such as an epJSONLSink
+        ver (optional): ePortfolio API version as a String
+        max_workers (optional): number of objects harvested at once
+        inline (optional): use comments and tags included in object
+         properties fetched with c=True
+    """
+    harvester = epHarvester(uc, sink, ver, max_workers, inline, **kwargs)
+    return harvester.harvest(objects)
@@ -0,0 +1,207 @@
+"""
+Provides incremental synchronisation of ePortfolio object listings. A local
+index keeps, for each user, the properties of every object seen and a
+high-water mark of their modification times; later syncs only ask the service
+for objects modified since that mark, so their cost follows the number of
+changes rather than the size of the portfolio.
+
+Index file layout (JSON):
+    {<user key>: {'Watermark': <latest Modified seen>,
+                  'Synced': <time of the last sync>,
+                  'Objects': {<ObjectId>: <object properties>}}}
+"""
+import datetime
+import json
+import os
+import tempfile
+import threading
+
+import eportfolio
+
+
+# Query filter selecting objects modified since a date; {0} is replaced by the
+# watermark. It includes the watermark itself, since objects written in the same
+# time unit as the newest one seen, but after the listing was read, share its
+# Modified value; objects listed again unchanged are skipped by the index. See
+# docs.valence.desire2learn.com/res/epobject.html for the filters your LMS
+# version supports.
+MODIFIED_FILTER = 'Modified:>={0}'
+
+
+def modified_filter(watermark, filter_format=MODIFIED_FILTER):
+    """
+    Returns the q filter expression for objects modified at or after
+     watermark, or an empty string, which matches every object, if watermark is None.
+
+    Parameters:
+        watermark: latest Modified value seen, as a string, or None
+        filter_format (optional): filter expression with a {0} placeholder
+    """
+    if not watermark:
+        return ''
+    return filter_format.format(watermark)
+
+
+class epSyncIndex(object):
+    """
+    The local index of synchronised ePortfolio objects, kept in a JSON file.
+    """
+    def __init__(self, path):
+        """
+        Parameters:
+            path: path of the index file; it is created by save
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.users = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.users = json.load(f)
+
+    def _user(self, user_key):
+        return self.users.setdefault(str(user_key), {'Watermark': None,
+                                                     'Synced': None,
+                                                     'Objects': {}})
+
+    def watermark(self, user_key):
+        """Returns the latest Modified value seen for a user, or None."""
+        with self._lock:
+            return self._user(user_key)['Watermark']
+
+    def objects(self, user_key):
+        """Returns a dict of a user's indexed object properties by ObjectId."""
+        with self._lock:
+            return dict(self._user(user_key)['Objects'])
+
+    def get(self, user_key, object_id):
+        """Returns the indexed properties of an object, or None."""
+        with self._lock:
+            return self._user(user_key)['Objects'].get(str(object_id))
+
+    def update(self, user_key, item):
+        """
+        Records the properties of an object. Returns True if the object is new
+         or its Modified value has changed.
+
+        Parameters:
+            user_key: key of the user the object belongs to
+            item: dict of object properties, as listed by get_ep_objects
+        """
+        object_id = str(item['ObjectId'])
+        modified = item.get('Modified')
+        with self._lock:
+            user = self._user(user_key)
+            old = user['Objects'].get(object_id)
+            user['Objects'][object_id] = item
+        return old is None or old.get('Modified') != modified
+
+    def raise_watermark(self, user_key, modified):
+        """Raises a user's watermark to modified, if that is later."""
+        with self._lock:
+            user = self._user(user_key)
+            if modified and (user['Watermark'] is None or
+                             modified > user['Watermark']):
+                user['Watermark'] = modified
+
+    def remove(self, user_key, object_ids):
+        """Removes objects from a user's index."""
+        with self._lock:
+            objects = self._user(user_key)['Objects']
+            for object_id in object_ids:
+                objects.pop(str(object_id), None)
+
+    def mark_synced(self, user_key):
+        """Records the time of a user's last sync."""
+        with self._lock:
+            self._user(user_key)['Synced'] = \
+                datetime.datetime.utcnow().isoformat()
+
+    def save(self):
+        """Writes the index to its file."""
+        with self._lock:
+            data = json.dumps(self.users)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        (fd, temp) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp, self.path)
+
+
+class epSync(object):
+    """
+    Synchronises the ePortfolio objects of the user of a user context into an
+    epSyncIndex. Without a watermark, or with full=True, every object is
+    listed; otherwise only objects modified since the watermark are.
+    """
+    def __init__(self, uc, index, user_key=None, ver='2.3', c=False,
+                 pagesize=None, filter_format=MODIFIED_FILTER, **kwargs):
+        """
+        Parameters:
+            uc: user context, from d2lvalence.auth.fashion_user_context
+            index: epSyncIndex, or the path of its file
+            user_key (optional): key of the user in the index; defaults to
+             the user context's user_id
+            ver (optional): ePortfolio API version as a String
+            c (optional): include comments attached to objects if true
+            pagesize (optional): int number of entries per listing data segment
+            filter_format (optional): q filter with a {0} watermark placeholder
+        """
+        if not isinstance(index, epSyncIndex):
+            index = epSyncIndex(index)
+        self.uc = uc
+        self.index = index
+        self.user_key = user_key if user_key is not None else uc.user_id
+        self.ver = ver
+        self.c = c
+        self.pagesize = pagesize
+        self.filter_format = filter_format
+        self.kwargs = kwargs
+
+    def changes(self, full=False):
+        """
+        Lazily yields the objects that are new or modified since the last
+         sync, as epObjects, updating the index as they are consumed. The
+         watermark is only raised once the listing has been read to its end,
+         so the next sync after an interrupted one starts from the same mark.
+         The index file is only written by sync or epSyncIndex.save.
+
+        Parameters:
+            full (optional): list every object rather than only those modified
+             since the watermark; objects no longer listed are then removed
+             from the index
+        """
+        watermark = None if full else self.index.watermark(self.user_key)
+        q = modified_filter(watermark, self.filter_format)
+        seen = set()
+        newest = watermark
+        for item in eportfolio.iter_ep_objects(self.uc, self.ver, self.c, q,
+                                               self.pagesize, **self.kwargs):
+            seen.add(str(item['ObjectId']))
+            modified = item.get('Modified')
+            if modified and (newest is None or modified > newest):
+                newest = modified
+            if self.index.update(self.user_key, item):
+                yield eportfolio.epObject(item)
+        if not q:
+            gone = set(self.index.objects(self.user_key)) - seen
+            self.index.remove(self.user_key, gone)
+        self.index.raise_watermark(self.user_key, newest)
+        self.index.mark_synced(self.user_key)
+
+    def sync(self, callback=None, full=False):
+        """
+        Brings the index up to date, saves it and returns the list of new or
+         modified epObjects.
+
+        Parameters:
+            callback (optional): called with each new or modified epObject,
+             such as to fetch or archive it
+            full (optional): see changes
+        """
+        changed = []
+        for obj in self.changes(full):
+            if callback is not None:
+                callback(obj)
+            changed.append(obj)
+        self.index.save()
+        return changed
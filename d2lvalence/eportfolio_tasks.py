@@ -0,0 +1,406 @@
+"""
+Provides a tracker for ePortfolio export and import tasks. Any number of tasks
+are polled concurrently from one scheduler thread and a small worker pool,
+each backing off between polls while it stays pending. Every tracked task has
+a concurrent.futures.Future that completes with the task's final status, or
+with the path of its export package, which is streamed straight to disk.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+import heapq
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+import eportfolio
+import service as d2l_service
+
+
+##############
+# Constants  #
+##############
+
+# Status values reported by the eP export and import task status routes.
+# Values may be the numbers below or their names; pass a dict of your own to
+# epTaskTracker if your LMS version reports different ones.
+TASK_STATUS_T = {
+    'queued': 0,
+    'processing': 1,
+    'complete': 2,
+    'failed': 3, }
+
+# Kinds of task tracked
+TASK_T = {
+    'export': 'export',
+    'import': 'import', }
+
+# Keys the task status and start routes may report their values under
+STATUS_KEYS = ('Status', 'ExportStatus', 'ImportStatus', 'TaskStatus')
+TASK_ID_KEYS = ('TaskId', 'ExportTaskId', 'ImportTaskId', 'Id')
+
+# Size of the chunks export packages are streamed to disk in
+CHUNK_SIZE = 64 * 1024
+
+
+class epTaskError(Exception):
+    """
+    Raised through a task's future when the task fails on the server or cannot
+    be polled any more.
+    """
+    def __init__(self, message, task_id, status=None):
+        Exception.__init__(self, message)
+        self.task_id = task_id
+        self.status = status
+
+
+def task_id_of(result):
+    """
+    Returns the task identifier in the result of a start_ep_*_task route.
+
+    Parameters:
+        result: the route's result, a dict or the identifier itself
+    """
+    if isinstance(result, dict):
+        for key in TASK_ID_KEYS:
+            if key in result:
+                return result[key]
+        raise ValueError('No task identifier in task result: ' + str(result))
+    return result
+
+
+def task_state(status, statuses=TASK_STATUS_T):
+    """
+    Returns 'complete', 'failed' or 'pending' for the result of a task status
+     route.
+
+    Parameters:
+        status: the route's result, a dict or the status value itself
+        statuses (optional): status values dict, like TASK_STATUS_T
+    """
+    if isinstance(status, dict):
+        for key in STATUS_KEYS:
+            if key in status:
+                status = status[key]
+                break
+    for state in ('complete', 'failed'):
+        if status == statuses[state] or \
+                str(status).lower() == state:
+            return state
+    return 'pending'
+
+
+class _epTask(object):
+    """One tracked task and its polling state."""
+    def __init__(self, kind, task_id, destination, interval, deadline):
+        self.kind = kind
+        self.task_id = task_id
+        self.destination = destination
+        self.interval = interval
+        self.deadline = deadline
+        self.errors = 0
+        self.status = None
+        self.settled = False
+        self.future = Future()
+
+
+class epTaskTracker(object):
+    """
+    Polls ePortfolio export and import tasks until they finish. Each task is
+    polled first after min_interval seconds, and its interval grows by the
+    backoff factor after every poll that finds it still pending, up to
+    max_interval, so thousands of long-running tasks cost few requests.
+    """
+    def __init__(self, uc, ver='2.0', max_workers=8, min_interval=2.0,
+                 max_interval=60.0, backoff=1.5, timeout=None, max_errors=5,
+                 statuses=None, **kwargs):
+        """
+        Parameters:
+            uc: user context, from d2lvalence.auth.fashion_user_context
+            ver (optional): ePortfolio API version as a String
+            max_workers (optional): number of requests made at once
+            min_interval (optional): seconds before a task is first polled
+            max_interval (optional): longest wait between polls, in seconds
+            backoff (optional): factor the wait grows by after each poll
+            timeout (optional): seconds after which a task that is still
+             pending fails with epTaskError; tasks are polled until they
+             finish if None
+            max_errors (optional): number of consecutive failed polls after
+             which a task fails with epTaskError
+            statuses (optional): status values dict, like TASK_STATUS_T; it
+             must give the 'complete' and 'failed' values
+        """
+        statuses = statuses or TASK_STATUS_T
+        missing = [state for state in ('complete', 'failed')
+                   if state not in statuses]
+        if missing:
+            raise ValueError('Task statuses lack values for: ' +
+                             ', '.join(missing))
+        self.uc = uc
+        self.ver = ver
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_errors = max_errors
+        self.statuses = statuses
+        self.kwargs = kwargs
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._queue = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._active = 0
+        self._scheduler = threading.Thread(target=self._run, daemon=True)
+        self._scheduler.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start_export(self, object_id_list, destination=None, callback=None,
+                     **options):
+        """
+        Starts an export task for the objects in object_id_list and tracks it.
+         Returns its Future.
+
+        Parameters:
+            object_id_list: list of ePortfolio object identifiers
+            destination (optional): see track_export
+            callback (optional): see track_export
+            options (optional): include_* flags of
+             service.start_ep_export_task
+        """
+        result = d2l_service.start_ep_export_task(
+            self.uc, object_id_list, ver=self.ver,
+            **dict(self._kwargs(), **options))
+        return self.track_export(task_id_of(result), destination, callback)
+
+    def start_export_all(self, destination=None, callback=None):
+        """
+        Starts an export task for the user's whole ePortfolio and tracks it.
+         Returns its Future.
+
+        Parameters:
+            destination (optional): see track_export
+            callback (optional): see track_export
+        """
+        result = d2l_service.start_ep_export_all_task(self.uc, self.ver,
+                                                      **self._kwargs())
+        return self.track_export(task_id_of(result), destination, callback)
+
+    def start_import(self, ep_import_package, user_id_list=None,
+                     import_with_details=False, callback=None):
+        """
+        Starts an import task and tracks it. Returns its Future.
+
+        Parameters:
+            ep_import_package: d2lvalence.data.D2LFile of the package
+            user_id_list (optional): list of users to import for
+            import_with_details (optional): see service.start_ep_import_task
+            callback (optional): see track_import
+        """
+        result = d2l_service.start_ep_import_task(
+            self.uc, ep_import_package, user_id_list, import_with_details,
+            self.ver, **self._kwargs())
+        return self.track_import(task_id_of(result), callback)
+
+    def track_export(self, task_id, destination=None, callback=None):
+        """
+        Tracks an export task and returns a Future. It completes with the path
+         the package was written to if destination is given, and with the
+         task's final status otherwise.
+
+        Parameters:
+            task_id: export task identifier
+            destination (optional): path of the file to stream the package
+             to, or of an existing directory to write '<task_id>.zip' in
+            callback (optional): called with the Future once it completes
+        """
+        return self._track(TASK_T['export'], task_id, destination, callback)
+
+    def track_import(self, task_id, callback=None):
+        """
+        Tracks an import task and returns a Future that completes with the
+         task's final status.
+
+        Parameters:
+            task_id: import task identifier
+            callback (optional): called with the Future once it completes
+        """
+        return self._track(TASK_T['import'], task_id, None, callback)
+
+    def pending(self):
+        """Returns the number of tasks that have not finished yet."""
+        with self._condition:
+            return self._active
+
+    def close(self, wait=True):
+        """
+        Stops polling. The futures of tasks that have not finished are
+         cancelled; cancelling a future also stops its task being polled.
+
+        Parameters:
+            wait (optional): wait for requests in progress to finish
+        """
+        with self._condition:
+            self._closed = True
+            queued = [task for (due, order, task) in self._queue]
+            self._queue = []
+            self._condition.notify_all()
+        for task in queued:
+            self._cancel(task)
+        self._scheduler.join()
+        self._pool.shutdown(wait)
+
+    def _kwargs(self):
+        kwargs = eportfolio._copy_kwargs(self.kwargs)
+        if kwargs.get('headers') is not None:
+            kwargs['headers'] = dict(kwargs['headers'])
+        return kwargs
+
+    def _track(self, kind, task_id, destination, callback):
+        deadline = time.time() + self.timeout if self.timeout else None
+        task = _epTask(kind, task_id, destination, self.min_interval,
+                       deadline)
+        if callback is not None:
+            task.future.add_done_callback(callback)
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Task tracker is closed')
+            self._active += 1
+        self._schedule(task, self.min_interval)
+        return task.future
+
+    def _schedule(self, task, delay):
+        with self._condition:
+            if not self._closed:
+                heapq.heappush(self._queue, (time.time() + delay,
+                                             next(self._order), task))
+                self._condition.notify()
+                return
+        self._cancel(task)
+
+    def _run(self):
+        # the scheduler thread: hands each task to the pool when it is due
+        with self._condition:
+            while not self._closed:
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                wait = self._queue[0][0] - time.time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                task = heapq.heappop(self._queue)[2]
+                self._pool.submit(self._poll, task)
+
+    def _poll(self, task):
+        if task.future.cancelled():
+            self._cancel(task)
+            return
+        # nothing reads the pool's futures, so an error escaping here would
+        # leave the task's future unresolved for good
+        try:
+            self._poll_task(task)
+        except Exception as e:
+            self._fail(task, 'Task {0} could not be polled: {1}'.format(
+                task.task_id, e))
+
+    def _poll_task(self, task):
+        try:
+            if task.kind == TASK_T['export']:
+                status = d2l_service.get_ep_export_task_status(
+                    self.uc, task.task_id, self.ver, **self._kwargs())
+            else:
+                status = d2l_service.get_ep_import_task_status(
+                    self.uc, task.task_id, self.ver, **self._kwargs())
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # a ValueError is a status body that is not JSON, such as a
+            # proxy's error page, so is retried like a failed request
+            task.errors += 1
+            if task.errors >= self.max_errors:
+                self._fail(task, 'Task {0} could not be polled: {1}'.format(
+                    task.task_id, e))
+            else:
+                self._retry(task)
+            return
+        task.errors = 0
+        task.status = status
+        state = task_state(status, self.statuses)
+        if state == 'complete':
+            if task.destination is None:
+                self._finish(task, status)
+            else:
+                self._download(task)
+        elif state == 'failed':
+            self._fail(task, 'Task {0} failed'.format(task.task_id))
+        elif task.deadline is not None and time.time() >= task.deadline:
+            self._fail(task, 'Task {0} timed out'.format(task.task_id))
+        else:
+            self._retry(task)
+
+    def _retry(self, task):
+        delay = task.interval
+        task.interval = min(task.interval * self.backoff, self.max_interval)
+        self._schedule(task, delay)
+
+    def _download(self, task):
+        path = task.destination
+        if os.path.isdir(path):
+            path = os.path.join(path, '{0}.zip'.format(task.task_id))
+        try:
+            response = d2l_service.get_ep_export_task_package_stream(
+                self.uc, task.task_id, self.ver, **self._kwargs())
+            try:
+                # written under a temporary name so a partial package never
+                # appears at path
+                (fd, temp) = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(path)))
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                    os.replace(temp, path)
+                except BaseException:
+                    os.remove(temp)
+                    raise
+            finally:
+                response.close()
+        except (requests.exceptions.RequestException, OSError) as e:
+            self._fail(task, 'Package of task {0} could not be saved: '
+                       '{1}'.format(task.task_id, e))
+            return
+        self._finish(task, path)
+
+    def _settle(self, task):
+        # True the first time a task finishes, fails or is cancelled only
+        with self._condition:
+            if task.settled:
+                return False
+            task.settled = True
+            self._active -= 1
+            return True
+
+    def _finish(self, task, result):
+        if not self._settle(task):
+            return
+        # False if the caller cancelled the future in the meantime
+        if task.future.set_running_or_notify_cancel():
+            task.future.set_result(result)
+
+    def _fail(self, task, message):
+        if not self._settle(task):
+            return
+        if task.future.set_running_or_notify_cancel():
+            task.future.set_exception(epTaskError(message, task.task_id,
+                                                  task.status))
+
+    def _cancel(self, task):
+        if not self._settle(task):
+            return
+        task.future.cancel()
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, gradebook module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.gradebook
+:synopsis: Provides export of whole gradebooks and bulk writes of grade values.
+
+The points of every grade value in an org unit are gathered into a dense
+matrix with one row per user and one column per grade object, with the user
+and grade object identifiers in vectors aligned with its rows and columns.
+The matrix is a NumPy array when NumPy is installed, and a list of
+`array.array` rows otherwise.
+
+Grade values are written in bulk by `GradeWriter`, which sends only the last
+of several writes to the same cell and reports the outcome of each cell.
+"""
+import array
+import csv
+import json
+import math
+import os
+import sys
+
+import requests
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.service as d2lservice
+
+MISSING = float('nan')
+COLUMNS_META = 'gradebook.json'
+
+
+class Gradebook(object):
+    """The grade values of one org unit.
+
+    `user_ids` and `grade_object_ids` are `array.array('q')` vectors;
+    `points[i][j]` holds the PointsNumerator of user `user_ids[i]` for grade
+    object `grade_object_ids[j]`, or NaN where there is none, and
+    `displayed[i][j]` the DisplayedGrade, or None.
+    """
+    def __init__(self, org_unit_id, grade_objects, user_ids):
+        self.org_unit_id = org_unit_id
+        self.grade_objects = grade_objects
+        self.grade_object_ids = array.array('q', [g.Id for g in grade_objects])
+        self.user_ids = array.array('q', user_ids)
+        self.column_of = dict((g, j) for (j, g) in
+                              enumerate(self.grade_object_ids))
+        self.row_of = dict((u, i) for (i, u) in enumerate(self.user_ids))
+        shape = (len(self.user_ids), len(self.grade_object_ids))
+        if numpy is not None:
+            self.points = numpy.full(shape, MISSING)
+        else:
+            self.points = [array.array('d', [MISSING] * shape[1])
+                           for i in range(shape[0])]
+        self.displayed = [[None] * shape[1] for i in range(shape[0])]
+        self.errors = {}
+
+    def set_values(self, user_id, grade_values):
+        """Place a user's grade values in the user's row."""
+        i = self.row_of[int(user_id)]
+        for gv in grade_values:
+            j = self.column_of.get(int(gv.GradeObjectIdentifier))
+            if j is None:
+                continue
+            numerator = gv.props.get('PointsNumerator')
+            if numerator is not None:
+                self.points[i][j] = numerator
+            self.displayed[i][j] = gv.props.get('DisplayedGrade')
+
+    def column(self, grade_object_id):
+        """Retrieve the points of one grade object, for every user."""
+        j = self.column_of[int(grade_object_id)]
+        if numpy is not None:
+            return self.points[:, j]
+        return array.array('d', (row[j] for row in self.points))
+
+    def to_csv(self, f, displayed=False):
+        """Write the gradebook to a text file as CSV: a header row of grade
+        object names, then a row per user headed by its UserId. Missing
+        values are written as empty cells.
+
+        :param f: Text file object, or path of the file to write.
+        :param displayed: Write the DisplayedGrade strings, not the points.
+        """
+        if isinstance(f, str):
+            with open(f, 'w', newline='', encoding='utf-8') as out:
+                return self.to_csv(out, displayed)
+        writer = csv.writer(f)
+        writer.writerow(['UserId'] + [g.Name for g in self.grade_objects])
+        for (i, user_id) in enumerate(self.user_ids):
+            if displayed:
+                cells = ['' if v is None else v for v in self.displayed[i]]
+            else:
+                cells = ['' if math.isnan(v) else repr(float(v))
+                         for v in self.points[i]]
+            writer.writerow([user_id] + cells)
+
+    def to_columns(self, directory):
+        """Write the gradebook as columnar files in a directory: the user
+        identifier vector, then one column of points per grade object, each
+        as raw little-endian 64-bit values, with a JSON file describing them.
+        """
+        os.makedirs(directory, exist_ok=True)
+        columns = [('user_ids', 'int64', 'UserId', self.user_ids)]
+        for g in self.grade_objects:
+            columns.append(('grade_{0}'.format(g.Id), 'float64', g.Name,
+                            self.column(g.Id)))
+        meta = {'OrgUnitId': self.org_unit_id,
+                'Rows': len(self.user_ids),
+                'Columns': []}
+        for (name, dtype, title, values) in columns:
+            path = os.path.join(directory, name + '.bin')
+            if numpy is not None:
+                numpy.asarray(values, dtype='<' + dtype[0] + '8').tofile(path)
+            else:
+                values = array.array(values.typecode, values)
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                with open(path, 'wb') as out:
+                    values.tofile(out)
+            meta['Columns'].append({'File': name + '.bin', 'Type': dtype,
+                                    'Name': title})
+        with open(os.path.join(directory, COLUMNS_META), 'w',
+                  encoding='utf-8') as out:
+            json.dump(meta, out, indent=1)
+
+
+class GradebookExporter(object):
+    """Fetches whole gradebooks, retrieving the grade values of an org unit's
+    users concurrently.
+    """
+    def __init__(self, uc, ver='1.0', max_workers=8, **kwargs):
+        """
+        :param uc: User context used for the export.
+        :param ver: Learning Environment API version as a string.
+        :param max_workers: Number of requests made at once for an org unit.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.kwargs = kwargs
+
+    def fetch(self, org_unit_id, user_ids=None):
+        """Retrieve the `Gradebook` of an org unit.
+
+        :param org_unit_id: Org unit to export.
+        :param user_ids:
+            Users to include; defaults to everyone in the org unit's
+            classlist.
+
+        Users whose grade values cannot be retrieved are left with empty
+        rows, and their errors kept in the gradebook's `errors` dict.
+        """
+        grade_objects = d2lservice.get_all_grade_objects_for_org(
+            self.uc, org_unit_id, ver=self.ver,
+            **d2lbulk.copy_kwargs(self.kwargs))
+        if user_ids is None:
+            user_ids = [int(u.Identifier) for u in d2lservice.get_classlist(
+                self.uc, org_unit_id, ver=self.ver,
+                **d2lbulk.copy_kwargs(self.kwargs))]
+        book = Gradebook(org_unit_id, grade_objects, user_ids)
+        for (user_id, values, exc) in d2lbulk.map_concurrently(
+                lambda u: self._values(org_unit_id, u), book.user_ids,
+                self.max_workers):
+            if exc is not None:
+                book.errors[user_id] = exc
+            else:
+                book.set_values(user_id, values)
+        return book
+
+    def export(self, org_unit_ids, directory, write_csv=True, columns=False,
+               org_units_at_once=2):
+        """Export the gradebooks of many org units into a directory, as
+        `<org unit id>.csv` files if `write_csv` is true and, if `columns` is
+        true, `<org unit id>` directories of columnar files.
+
+        Yields an `(org_unit_id, gradebook, exception)` tuple for each org
+        unit as its export finishes. Up to `org_units_at_once` org units are
+        exported at once, each making up to `max_workers` requests at once.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        def export_one(org_unit_id):
+            book = self.fetch(org_unit_id)
+            base = os.path.join(directory, str(org_unit_id))
+            if write_csv:
+                book.to_csv(base + '.csv')
+            if columns:
+                book.to_columns(base)
+            return book
+
+        for result in d2lbulk.map_concurrently(export_one, org_unit_ids,
+                                               org_units_at_once):
+            yield result
+
+    def _values(self, org_unit_id, user_id):
+        try:
+            return d2lservice.get_all_grade_values_for_user_in_org(
+                self.uc, org_unit_id, user_id, ver=self.ver,
+                **d2lbulk.copy_kwargs(self.kwargs))
+        except requests.exceptions.HTTPError as e:
+            # users with nothing to see in the gradebook are reported as
+            # not found
+            if e.response is not None and e.response.status_code == 404:
+                return []
+            raise
+
+
+class GradeWriteReport(object):
+    """Outcome of a `GradeWriter.write`.
+
+    `results` maps each `(org_unit_id, grade_object_id, user_id)` cell written
+    to None if the write succeeded, or to the exception it failed with;
+    `coalesced` counts the writes dropped because a later write to the same
+    cell replaced them; `recalculated` maps each org unit whose final grades
+    were recalculated to None, or to the exception the recalculation failed
+    with.
+    """
+    def __init__(self):
+        self.results = {}
+        self.coalesced = 0
+        self.recalculated = {}
+
+    @property
+    def succeeded(self):
+        return [cell for (cell, exc) in self.results.items() if exc is None]
+
+    @property
+    def failed(self):
+        return dict((cell, exc) for (cell, exc) in self.results.items()
+                    if exc is not None)
+
+
+class GradeWriter(object):
+    """Writes many grade values concurrently.
+
+    Writes to the same cell are coalesced so only the last is sent, and the
+    rate of requests can be limited across all the writer's threads.
+    """
+    def __init__(self, uc, ver='1.0', max_workers=8, rate=None, retries=2,
+                 **kwargs):
+        """
+        :param uc: User context used for the writes.
+        :param ver: Learning Environment API version as a string.
+        :param max_workers: Number of requests made at once.
+        :param rate: If given, the most requests made per second.
+        :param retries:
+            Number of times a write is retried after the service answers
+            429 (Too Many Requests) or 503 (Service Unavailable).
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.kwargs = kwargs
+
+    def write(self, cells, recalculate=False):
+        """Write grade values and return a `GradeWriteReport`.
+
+        :param cells:
+            Iterable of `(org_unit_id, grade_object_id, user_id, value)`
+            tuples, with each value a `d2lvalence.data.IncomingGradeValue`.
+        :param recalculate:
+            After the writes, recalculate the final grades of every org unit
+            with a successful write, once per org unit.
+        """
+        report = GradeWriteReport()
+        latest = {}
+        for (org_unit_id, grade_object_id, user_id, value) in cells:
+            cell = (int(org_unit_id), int(grade_object_id), int(user_id))
+            if cell in latest:
+                report.coalesced += 1
+            latest[cell] = value
+        for (cell, result, exc) in d2lbulk.map_concurrently(
+                lambda c: self._call(
+                    d2lservice.update_grade_value_for_user_in_org,
+                    c[0], c[1], c[2], latest[c]),
+                latest, self.max_workers):
+            report.results[cell] = exc
+        if recalculate:
+            org_unit_ids = set(cell[0] for cell in report.succeeded)
+            for (org_unit_id, result, exc) in d2lbulk.map_concurrently(
+                    lambda o: self._call(
+                        d2lservice.recalculate_all_final_grade_values_for_org,
+                        o),
+                    org_unit_ids, self.max_workers):
+                report.recalculated[org_unit_id] = exc
+        return report
+
+    def _call(self, fn, *args):
+        return d2lbulk.call(fn, self.uc, *args, ver=self.ver,
+                            limiter=self.limiter, retries=self.retries,
+                            **self.kwargs)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, gradestats module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.gradestats
+:synopsis: Provides statistics over batches of grade values and grade scheme mapping.
+
+Grade values are gathered, per grade object, into vectors of percentages, and
+statistics, histograms and grade scheme symbols are computed over whole
+vectors at once: with NumPy when it is installed, and with sorting and binary
+search otherwise. A percentage is mapped to a scheme symbol by a binary search
+over the scheme's sorted range starts.
+"""
+import array
+import bisect
+import collections
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SchemeMapper(object):
+    """Maps percentages to the symbols of a grade scheme.
+
+    Each of the scheme's ranges starts at its PercentStart and runs up to the
+    next range's start; percentages below the lowest start map to None.
+    """
+    def __init__(self, scheme):
+        """
+        :param scheme: `d2lvalence.data.GradeScheme` to map to.
+        """
+        ranges = sorted(scheme.Ranges, key=lambda r: r['PercentStart'])
+        self.scheme = scheme
+        self.starts = [float(r['PercentStart']) for r in ranges]
+        self.symbols = [r['Symbol'] for r in ranges]
+        self.values = [r.get('AssignedValue') for r in ranges]
+
+    def index(self, percent):
+        """Retrieve the index of the range a percentage falls in, or -1."""
+        if percent is None or math.isnan(percent):
+            return -1
+        return bisect.bisect_right(self.starts, percent) - 1
+
+    def indices(self, percents):
+        """Retrieve the range index of every percentage in a vector, with -1
+        for those in no range and for missing (NaN) values.
+        """
+        if numpy is not None:
+            p = numpy.asarray(percents, dtype=float)
+            idx = numpy.searchsorted(self.starts, p, side='right') - 1
+            idx[numpy.isnan(p)] = -1
+            return idx
+        return array.array('l', (self.index(p) for p in percents))
+
+    def symbol(self, percent):
+        """Retrieve the symbol a percentage maps to, or None."""
+        i = self.index(percent)
+        return self.symbols[i] if i >= 0 else None
+
+    def map(self, percents):
+        """Retrieve the list of symbols a vector of percentages maps to."""
+        return [self.symbols[i] if i >= 0 else None
+                for i in self.indices(percents)]
+
+    def counts(self, percents):
+        """Retrieve a dict of the number of percentages mapping to each
+        symbol, in the order of the scheme's ranges.
+        """
+        tally = [0] * len(self.symbols)
+        if numpy is not None:
+            idx = self.indices(percents)
+            tally = numpy.bincount(idx[idx >= 0],
+                                   minlength=len(self.symbols)).tolist()
+        else:
+            for i in self.indices(percents):
+                if i >= 0:
+                    tally[i] += 1
+        return collections.OrderedDict(zip(self.symbols, tally))
+
+
+def percents_by_grade_object(grade_values):
+    """Gather grade values into vectors of percentages.
+
+    :param grade_values:
+        Iterable of `GradeValueComputable` (or other `GradeValue`, which are
+        skipped as they have no points), such as a user's grade values from
+        `d2lvalence.service.get_all_grade_values_for_user_in_org`.
+
+    Returns a dict mapping each GradeObjectIdentifier, as an int, to an
+    `array.array('d')` of PointsNumerator / PointsDenominator * 100.
+    """
+    result = collections.defaultdict(lambda: array.array('d'))
+    for gv in grade_values:
+        numerator = gv.props.get('PointsNumerator')
+        denominator = gv.props.get('PointsDenominator')
+        if numerator is None or not denominator:
+            continue
+        result[int(gv.GradeObjectIdentifier)].append(
+            100.0 * numerator / denominator)
+    return dict(result)
+
+
+def percents_from_gradebook(book):
+    """Gather the points of a `d2lvalence.gradebook.Gradebook` into vectors
+    of percentages of each grade object's MaxPoints.
+
+    Returns a dict mapping each grade object identifier with a MaxPoints to
+    an `array.array('d')` of the percentages of the users graded.
+    """
+    result = {}
+    for g in book.grade_objects:
+        max_points = g.props.get('MaxPoints')
+        if not max_points:
+            continue
+        column = book.column(g.Id)
+        result[g.Id] = array.array('d', (100.0 * p / max_points
+                                         for p in column if not math.isnan(p)))
+    return result
+
+
+def statistics(values):
+    """Retrieve the Count, Mean, StdDev (population), Min, Median and Max of a
+    vector of values, in a dict; all but Count are None for an empty vector.
+    """
+    n = len(values)
+    if n == 0:
+        return {'Count': 0, 'Mean': None, 'StdDev': None, 'Min': None,
+                'Median': None, 'Max': None}
+    if numpy is not None:
+        v = numpy.asarray(values, dtype=float)
+        return {'Count': n,
+                'Mean': float(v.mean()),
+                'StdDev': float(v.std()),
+                'Min': float(v.min()),
+                'Median': float(numpy.median(v)),
+                'Max': float(v.max())}
+    v = sorted(values)
+    mean = math.fsum(v) / n
+    middle = n // 2
+    median = v[middle] if n % 2 else (v[middle - 1] + v[middle]) / 2.0
+    return {'Count': n,
+            'Mean': mean,
+            'StdDev': math.sqrt(math.fsum((x - mean) ** 2 for x in v) / n),
+            'Min': v[0],
+            'Median': median,
+            'Max': v[-1]}
+
+
+def histogram(values, edges=None):
+    """Retrieve the number of values in each bin between sorted edges.
+
+    :param values: Vector of values.
+    :param edges:
+        Sorted bin edges; defaults to ten bins of 10 from 0 to 100. Each bin
+        holds the values from its lower edge up to, but not including, its
+        upper edge, except the last, which includes its upper edge. Values
+        outside the edges are not counted.
+
+    Returns a list of counts, one fewer than the edges.
+    """
+    if edges is None:
+        edges = [10.0 * i for i in range(11)]
+    if numpy is not None:
+        return numpy.histogram(numpy.asarray(values, dtype=float),
+                               bins=edges)[0].tolist()
+    counts = [0] * (len(edges) - 1)
+    v = sorted(values)
+    # the count of each bin is the distance between the insertion points of
+    # its edges in the sorted values
+    points = [bisect.bisect_left(v, e) for e in edges[:-1]]
+    points.append(bisect.bisect_right(v, edges[-1]))
+    for i in range(len(counts)):
+        counts[i] = points[i + 1] - points[i]
+    return counts
+
+
+def summarize(percents, schemes=None, edges=None):
+    """Compute the statistics, histogram and scheme symbol counts of each
+    grade object.
+
+    :param percents:
+        Dict mapping grade object identifiers to vectors of percentages, as
+        from `percents_by_grade_object` or `percents_from_gradebook`.
+    :param schemes:
+        Dict mapping grade object identifiers to the `GradeScheme` (or
+        `SchemeMapper`) to count symbols with; objects missing from it get
+        no symbol counts.
+    :param edges: Histogram bin edges; see `histogram`.
+
+    Returns a dict mapping each grade object identifier to the dict of its
+    `statistics`, with its 'Histogram' and, where it has a scheme, its
+    'Symbols' counts added.
+    """
+    schemes = schemes or {}
+    mappers = {}
+    result = {}
+    for (grade_object_id, values) in percents.items():
+        summary = statistics(values)
+        summary['Histogram'] = histogram(values, edges)
+        scheme = schemes.get(grade_object_id)
+        if scheme is not None:
+            if not isinstance(scheme, SchemeMapper):
+                # schemes are usually shared by many grade objects
+                if id(scheme) not in mappers:
+                    mappers[id(scheme)] = SchemeMapper(scheme)
+                scheme = mappers[id(scheme)]
+            summary['Symbols'] = scheme.counts(values)
+        result[grade_object_id] = summary
+    return result
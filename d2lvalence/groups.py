@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, groups module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.groups
+:synopsis: Provides an index of group membership and bulk membership changes.
+
+Groups are identified throughout by `(org_unit_id, group_category_id,
+group_id)` tuples, and membership changes by `(org_unit_id,
+group_category_id, group_id, user_id)` tuples.
+"""
+import collections
+import threading
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.service as d2lservice
+
+
+class MembershipReport(object):
+    """Outcome of bulk membership changes: `added` and `removed` map each
+    change to None if it succeeded, or to the exception it failed with.
+    """
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+
+    @property
+    def failed(self):
+        return dict((change, exc) for results in (self.added, self.removed)
+                    for (change, exc) in results.items() if exc is not None)
+
+
+class GroupIndex(object):
+    """Index of the groups of many org units, mapping users to groups and
+    groups to members, and kept up to date with the membership changes made
+    through it.
+    """
+    def __init__(self, uc, ver='1.0', max_workers=8, rate=None, retries=2,
+                 **kwargs):
+        """
+        :param uc: User context used for the index.
+        :param ver: Learning Platform API version as a string.
+        :param max_workers: Number of requests made at once.
+        :param rate: If given, the most membership changes made per second.
+        :param retries: Number of times a request is retried while the
+            service reports it is busy; see `d2lvalence.bulk.call`.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self.categories = {}
+        self.groups = {}
+        self._members = collections.defaultdict(set)
+        self._groups_of = collections.defaultdict(set)
+
+    def _call(self, fn, *args, limiter=None):
+        # only membership changes are rate limited
+        return d2lbulk.call(fn, self.uc, *args, ver=self.ver,
+                            limiter=limiter, retries=self.retries,
+                            **self.kwargs)
+
+    def load(self, org_unit_ids):
+        """Index the groups of org units, fetching their group categories,
+        then the groups of every category, concurrently. Org units indexed
+        before are indexed afresh.
+        """
+        org_unit_ids = set(int(o) for o in org_unit_ids)
+        categories = []
+        for (org_unit_id, fetched, exc) in d2lbulk.map_concurrently(
+                lambda o: self._call(
+                    d2lservice.get_group_categories_for_orgunit, o),
+                org_unit_ids, self.max_workers):
+            if exc is not None:
+                raise exc
+            categories.extend((org_unit_id, c) for c in fetched)
+        loaded = []
+        for ((org_unit_id, category), groups, exc) in \
+                d2lbulk.map_concurrently(
+                    lambda oc: self._call(
+                        d2lservice.get_groups_for_orgunit_category, oc[0],
+                        oc[1].GroupCategoryId),
+                    categories, self.max_workers):
+            if exc is not None:
+                raise exc
+            loaded.append((org_unit_id, category, groups))
+        with self._lock:
+            for key in [k for k in self.groups if k[0] in org_unit_ids]:
+                self._unindex_group(key)
+            for key in [k for k in self.categories if k[0] in org_unit_ids]:
+                del self.categories[key]
+            for (org_unit_id, category, groups) in loaded:
+                self.categories[(org_unit_id, category.GroupCategoryId)] = \
+                    category
+                for group in groups:
+                    key = (org_unit_id, category.GroupCategoryId,
+                           group.GroupId)
+                    self.groups[key] = group
+                    for user_id in group.props.get('Enrollments') or []:
+                        self._index(key, int(user_id))
+        return len(loaded)
+
+    def _index(self, key, user_id):
+        self._members[key].add(user_id)
+        self._groups_of[user_id].add(key)
+
+    def _unindex(self, key, user_id):
+        self._members[key].discard(user_id)
+        self._groups_of[user_id].discard(key)
+
+    def _unindex_group(self, key):
+        for user_id in self._members.pop(key, ()):
+            self._groups_of[user_id].discard(key)
+        del self.groups[key]
+
+    def members(self, org_unit_id, group_category_id, group_id):
+        """Retrieve the set of UserIds in a group."""
+        with self._lock:
+            return set(self._members.get(
+                (int(org_unit_id), int(group_category_id), int(group_id)),
+                ()))
+
+    def groups_of(self, user_id, org_unit_id=None, group_category_id=None):
+        """Retrieve the set of groups a user is in, optionally only those of
+        one org unit and of one group category.
+        """
+        with self._lock:
+            keys = set(self._groups_of.get(int(user_id), ()))
+        if org_unit_id is not None:
+            keys = set(k for k in keys if k[0] == int(org_unit_id))
+        if group_category_id is not None:
+            keys = set(k for k in keys if k[1] == int(group_category_id))
+        return keys
+
+    def category_groups(self, org_unit_id, group_category_id):
+        """Retrieve the set of groups in a group category."""
+        with self._lock:
+            return set(k for k in self.groups
+                       if k[:2] == (int(org_unit_id), int(group_category_id)))
+
+    def apply(self, adds=(), removes=()):
+        """Make membership changes concurrently, removals first, so a user
+        moved between groups of a category that allows one group per user
+        can join the new one. Returns a `MembershipReport`.
+
+        :param adds: Iterable of `(org_unit_id, group_category_id, group_id,
+            user_id)` memberships to add.
+        :param removes: Iterable of memberships to remove, likewise.
+        """
+        report = MembershipReport()
+        removes = set(tuple(int(x) for x in r) for r in removes)
+        adds = set(tuple(int(x) for x in a) for a in adds)
+        for (change, result, exc) in d2lbulk.map_concurrently(
+                lambda c: self._call(d2lservice.delete_user_from_group, *c,
+                                     limiter=self.limiter),
+                removes, self.max_workers):
+            report.removed[change] = exc
+            if exc is None:
+                with self._lock:
+                    self._unindex(change[:3], change[3])
+        for (change, result, exc) in d2lbulk.map_concurrently(
+                lambda c: self._call(d2lservice.enroll_user_in_group, *c,
+                                     limiter=self.limiter),
+                adds, self.max_workers):
+            report.added[change] = exc
+            if exc is None:
+                with self._lock:
+                    self._index(change[:3], change[3])
+        return report
+
+    def remove_users(self, user_ids, org_unit_id=None, group_category_id=None):
+        """Remove users from every indexed group they are in, optionally only
+        those of one org unit and group category. Returns a
+        `MembershipReport`.
+        """
+        removes = [k + (int(u),) for u in user_ids
+                   for k in self.groups_of(u, org_unit_id, group_category_id)]
+        return self.apply(removes=removes)
+
+    def reshuffle(self, org_unit_id, group_category_id, assignment):
+        """Bring the membership of a group category in line with an
+        assignment, making only the changes needed. Returns a
+        `MembershipReport`.
+
+        :param assignment:
+            Dict mapping UserIds to the GroupId, or iterable of GroupIds,
+            they should be in; users of the category missing from it are
+            left alone, and users mapped to None or an empty iterable are
+            removed from the category's groups.
+        """
+        org_unit_id = int(org_unit_id)
+        group_category_id = int(group_category_id)
+        adds = []
+        removes = []
+        for (user_id, wanted) in assignment.items():
+            if wanted is None:
+                wanted = ()
+            elif not isinstance(wanted, (list, tuple, set, frozenset)):
+                wanted = (wanted,)
+            wanted = set((org_unit_id, group_category_id, int(g))
+                         for g in wanted)
+            current = self.groups_of(user_id, org_unit_id, group_category_id)
+            adds.extend(k + (int(user_id),) for k in wanted - current)
+            removes.extend(k + (int(user_id),) for k in current - wanted)
+        return self.apply(adds, removes)
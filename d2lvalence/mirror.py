@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, mirror module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.mirror
+:synopsis: Provides a local SQLite mirror of users, org units and enrollments.
+
+The mirror is loaded through the paged user and enrollment routes, one
+*scope* at a time: the whole user list, the enrollments of one org unit, or
+the enrollments of one user. Each scope records when it was last loaded, so
+`Mirror.refresh` only re-loads the scopes that have gone stale. Queries are
+answered from indexed tables and return the same structures as the matching
+service functions.
+"""
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.data as d2ldata
+import d2lvalence.service as d2lservice
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    UserId INTEGER PRIMARY KEY,
+    OrgDefinedId TEXT,
+    UserName TEXT COLLATE NOCASE,
+    Json TEXT NOT NULL,
+    Loaded REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS users_orgdefinedid ON users (OrgDefinedId);
+CREATE INDEX IF NOT EXISTS users_username ON users (UserName);
+CREATE TABLE IF NOT EXISTS orgunits (
+    OrgUnitId INTEGER PRIMARY KEY,
+    TypeId INTEGER,
+    Json TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS enrollments (
+    OrgUnitId INTEGER NOT NULL,
+    UserId INTEGER NOT NULL,
+    RoleId INTEGER,
+    Loaded REAL NOT NULL,
+    PRIMARY KEY (OrgUnitId, UserId));
+CREATE INDEX IF NOT EXISTS enrollments_orgunitid ON enrollments (OrgUnitId, RoleId);
+CREATE INDEX IF NOT EXISTS enrollments_userid ON enrollments (UserId, RoleId);
+CREATE INDEX IF NOT EXISTS enrollments_roleid ON enrollments (RoleId);
+CREATE TABLE IF NOT EXISTS scopes (
+    Scope TEXT PRIMARY KEY,
+    Loaded REAL NOT NULL);
+"""
+
+USERS_SCOPE = 'users'
+ORGUNIT_SCOPE = 'orgunit:{0}'
+USER_SCOPE = 'user:{0}'
+
+
+class Mirror(object):
+    """Local SQLite mirror of users and enrollments.
+
+    The mirror can be shared between threads; loads fetch their pages without
+    holding the database, and write each scope in a single transaction.
+    """
+    def __init__(self, uc, path=':memory:', ver='1.0', **kwargs):
+        """Open, creating if need be, a mirror database.
+
+        :param uc: User context used to load the mirror.
+        :param path: Path of the SQLite database file.
+        :param ver: Learning Platform API version as a string.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.kwargs = kwargs
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # Loading
+    def load_users(self):
+        """Load every user through the paged `get_users` route.
+
+        Users no longer listed are removed from the mirror. Returns the number
+        of users loaded.
+        """
+        stamp = time.time()
+        count = 0
+        batch = []
+        for item in d2lbulk.iter_paged(d2lservice.get_users, self.uc,
+                                       ver=self.ver, **self.kwargs):
+            batch.append(item)
+            if len(batch) >= 1000:
+                count += self._put_users(batch, stamp)
+                batch = []
+        count += self._put_users(batch, stamp)
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM users WHERE Loaded < ?', (stamp,))
+            self._set_scope(USERS_SCOPE, stamp)
+        return count
+
+    def load_user(self, user_id):
+        """Load one user through `get_user`, and return its `UserData`."""
+        user = d2lservice.get_user(self.uc, user_id, ver=self.ver,
+                                   **d2lbulk.copy_kwargs(self.kwargs))
+        self._put_users([user.props], time.time())
+        return user
+
+    def load_orgunit(self, org_unit_id):
+        """Load the enrollments of an org unit through the paged
+        `get_enrolled_users_for_orgunit` route, replacing those mirrored
+        before. Returns the number of enrollments loaded.
+        """
+        stamp = time.time()
+        rows = [(int(org_unit_id), int(item['User']['Identifier']),
+                 item['Role']['Id'], stamp)
+                for item in d2lbulk.iter_paged(
+                    d2lservice.get_enrolled_users_for_orgunit, self.uc,
+                    org_unit_id, ver=self.ver, **self.kwargs)]
+        with self._lock, self._db:
+            self._put_enrollments(rows)
+            self._db.execute('DELETE FROM enrollments WHERE OrgUnitId = ? '
+                             'AND Loaded < ?', (int(org_unit_id), stamp))
+            self._set_scope(ORGUNIT_SCOPE.format(int(org_unit_id)), stamp)
+        return len(rows)
+
+    def load_user_enrollments(self, user_id):
+        """Load the enrollments of a user, and the org units they are in,
+        through the paged `get_all_enrollments_for_user` route, replacing
+        those mirrored before. Returns the number of enrollments loaded.
+        """
+        stamp = time.time()
+        items = list(d2lbulk.iter_paged(
+            d2lservice.get_all_enrollments_for_user, self.uc, user_id,
+            ver=self.ver, **self.kwargs))
+        rows = [(item['OrgUnit']['Id'], int(user_id), item['Role']['Id'],
+                 stamp) for item in items]
+        units = [(item['OrgUnit']['Id'], item['OrgUnit']['Type']['Id'],
+                  json.dumps(item['OrgUnit'])) for item in items]
+        with self._lock, self._db:
+            self._put_enrollments(rows)
+            self._db.executemany('INSERT OR REPLACE INTO orgunits '
+                                 '(OrgUnitId, TypeId, Json) VALUES (?, ?, ?)',
+                                 units)
+            self._db.execute('DELETE FROM enrollments WHERE UserId = ? '
+                             'AND Loaded < ?', (int(user_id), stamp))
+            self._set_scope(USER_SCOPE.format(int(user_id)), stamp)
+        return len(rows)
+
+    def load(self, org_unit_ids=(), user_ids=(), users=True, max_workers=8):
+        """Load the user list and the enrollments of the given org units and
+        users, fetching up to `max_workers` scopes at once.
+        """
+        jobs = []
+        if users:
+            jobs.append((self.load_users,))
+        jobs.extend((self.load_orgunit, i) for i in org_unit_ids)
+        jobs.extend((self.load_user_enrollments, i) for i in user_ids)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(*job) for job in jobs]
+        return [f.result() for f in futures]
+
+    def refresh(self, max_age, max_workers=8):
+        """Re-load every scope loaded more than `max_age` seconds ago.
+
+        Returns the list of scopes re-loaded.
+        """
+        with self._lock:
+            stale = [r[0] for r in self._db.execute(
+                'SELECT Scope FROM scopes WHERE Loaded < ?',
+                (time.time() - max_age,))]
+        org_unit_ids = [int(s.split(':')[1]) for s in stale
+                        if s.startswith('orgunit:')]
+        user_ids = [int(s.split(':')[1]) for s in stale
+                    if s.startswith('user:')]
+        self.load(org_unit_ids, user_ids, USERS_SCOPE in stale, max_workers)
+        return stale
+
+    def loaded(self, scope):
+        """Retrieve the time a scope was last loaded, or None."""
+        with self._lock:
+            row = self._db.execute('SELECT Loaded FROM scopes WHERE Scope = ?',
+                                   (scope,)).fetchone()
+        return row[0] if row else None
+
+    def _put_users(self, items, stamp):
+        rows = [(int(i['UserId']), i.get('OrgDefinedId'), i.get('UserName'),
+                 json.dumps(i), stamp) for i in items]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO users (UserId, '
+                                 'OrgDefinedId, UserName, Json, Loaded) '
+                                 'VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def _put_enrollments(self, rows):
+        self._db.executemany('INSERT OR REPLACE INTO enrollments (OrgUnitId, '
+                             'UserId, RoleId, Loaded) VALUES (?, ?, ?, ?)',
+                             rows)
+
+    def _set_scope(self, scope, stamp):
+        self._db.execute('INSERT OR REPLACE INTO scopes (Scope, Loaded) '
+                         'VALUES (?, ?)', (scope, stamp))
+
+    # Queries
+    def _query(self, sql, args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def get_user(self, user_id):
+        """Retrieve the mirrored `UserData` of a user, or None."""
+        rows = self._query('SELECT Json FROM users WHERE UserId = ?',
+                           (int(user_id),))
+        return d2ldata.UserData(json.loads(rows[0][0])) if rows else None
+
+    def get_users(self, org_defined_id=None, user_name=None):
+        """Retrieve mirrored users, in the shapes `service.get_users` does.
+
+        With `org_defined_id`, a list of the matching `UserData`; with
+        `user_name` (matched without regard to case), the matching `UserData`
+        or None; otherwise a list of every mirrored `UserData`.
+        """
+        if org_defined_id:
+            rows = self._query('SELECT Json FROM users WHERE OrgDefinedId = ?',
+                               (str(org_defined_id),))
+        elif user_name:
+            rows = self._query('SELECT Json FROM users WHERE UserName = ?',
+                               (str(user_name),))
+            return d2ldata.UserData(json.loads(rows[0][0])) if rows else None
+        else:
+            rows = self._query('SELECT Json FROM users ORDER BY UserId', ())
+        return [d2ldata.UserData(json.loads(r[0])) for r in rows]
+
+    def get_orgunit(self, org_unit_id):
+        """Retrieve the mirrored `OrgUnitInfo` of an org unit, or None."""
+        rows = self._query('SELECT Json FROM orgunits WHERE OrgUnitId = ?',
+                           (int(org_unit_id),))
+        return d2ldata.OrgUnitInfo(json.loads(rows[0][0])) if rows else None
+
+    def get_enrolled_users_for_orgunit(self, org_unit_id, role_id=None):
+        """Retrieve the mirrored enrollments of an org unit as a list of
+        `EnrollmentData`, optionally only those in one role.
+        """
+        sql = 'SELECT OrgUnitId, UserId, RoleId FROM enrollments ' \
+              'WHERE OrgUnitId = ?'
+        args = [int(org_unit_id)]
+        if role_id:
+            sql += ' AND RoleId = ?'
+            args.append(int(role_id))
+        return [_enrollment(r) for r in self._query(sql + ' ORDER BY UserId',
+                                                    args)]
+
+    def get_all_enrollments_for_user(self, user_id, org_unit_type_id=None,
+                                     role_id=None):
+        """Retrieve the mirrored enrollments of a user as a list of
+        `EnrollmentData`, optionally only those in one role or in org units
+        of one type.
+        """
+        sql = 'SELECT e.OrgUnitId, e.UserId, e.RoleId FROM enrollments e'
+        args = []
+        if org_unit_type_id:
+            sql += ' JOIN orgunits o ON o.OrgUnitId = e.OrgUnitId ' \
+                   'AND o.TypeId = ?'
+            args.append(int(org_unit_type_id))
+        sql += ' WHERE e.UserId = ?'
+        args.append(int(user_id))
+        if role_id:
+            sql += ' AND e.RoleId = ?'
+            args.append(int(role_id))
+        return [_enrollment(r) for r in self._query(sql + ' ORDER BY '
+                                                    'e.OrgUnitId', args)]
+
+    def get_enrolled_user_in_orgunit(self, org_unit_id, user_id):
+        """Retrieve the mirrored `EnrollmentData` of a user in an org unit, or
+        None.
+        """
+        rows = self._query('SELECT OrgUnitId, UserId, RoleId FROM enrollments '
+                           'WHERE OrgUnitId = ? AND UserId = ?',
+                           (int(org_unit_id), int(user_id)))
+        return _enrollment(rows[0]) if rows else None
+
+
+def _enrollment(row):
+    return d2ldata.EnrollmentData({'OrgUnitId': row[0],
+                                   'UserId': row[1],
+                                   'RoleId': row[2]})
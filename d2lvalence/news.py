@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, news module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.news
+:synopsis: Provides incremental polling of, and posting to, news across many
+    org units.
+
+Each org unit polled keeps a `since` watermark, so a poll only asks for the
+news posted or changed since the last one, and the fingerprints of the items
+it has seen lately, so items returned again unchanged are not delivered twice.
+Both are kept between runs in a JSON file per org unit, which is only
+rewritten when a poll of the org unit returns something.
+
+A news item posted to many org units is encoded, with its attachments, only
+once; each request sends the same body and differs only in its signed URL.
+"""
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.data as d2ldata
+import d2lvalence.service as d2lservice
+
+NEW = 'new'
+CHANGED = 'changed'
+
+# State key of the current user's feed
+FEED = 'feed'
+
+
+def fingerprint(item):
+    """Retrieve a digest of a news item's properties, which changes when the
+    item is edited.
+    """
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+class NewsState(object):
+    """Watermarks and fingerprints of polled org units.
+
+    Each org unit's are kept in its own file, `<org_unit_id>.json` in a
+    directory, as `{'Since': <UTCDateTime>, 'Seen': {Id: [fingerprint,
+    time.time() it was last returned]}}`, and read the first time the org
+    unit is polled.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: Path of the state directory; it is created if need be.
+            The state is only kept in memory if None.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.units = {}
+        self._dirty = set()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, '{0}.json'.format(key))
+
+    def get(self, key):
+        key = str(key)
+        with self._lock:
+            unit = self.units.get(key)
+        if unit is None and self.path and os.path.exists(self._file(key)):
+            # each org unit is polled by one worker at a time, so its file is
+            # read outside the lock
+            with open(self._file(key), 'r', encoding='utf-8') as f:
+                unit = json.load(f)
+            with self._lock:
+                unit = self.units.setdefault(key, unit)
+        return (unit['Since'], dict(unit['Seen'])) if unit else (None, {})
+
+    def set(self, key, since, seen):
+        with self._lock:
+            self.units[str(key)] = {'Since': since, 'Seen': seen}
+            self._dirty.add(str(key))
+
+    def save(self):
+        """Write the files of the org units set since the last save."""
+        with self._lock:
+            if not self.path:
+                self._dirty.clear()
+                return
+            changed = [(k, json.dumps(self.units[k])) for k in self._dirty]
+            self._dirty.clear()
+        for (key, data) in changed:
+            (fd, temp) = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp, self._file(key))
+
+
+class NewsPoller(object):
+    """Polls the news of many org units concurrently, delivering only items
+    that are new or changed since they were last delivered.
+
+    Items are delivered to a sink: a callable taking `(org_unit_id,
+    news_item, change)`, or a queue whose `put` is given that tuple, with
+    `news_item` a `d2lvalence.data.NewsItem` and `change` `NEW` or `CHANGED`.
+    """
+    def __init__(self, uc, sink, state=None, ver='1.0', max_workers=16,
+                 overlap=60, retention=30 * 86400, rate=None, retries=2,
+                 **kwargs):
+        """
+        :param uc: User context used to poll.
+        :param sink: Callable or queue to deliver items to.
+        :param state: `NewsState`, or path of its directory; kept in memory
+            only if None.
+        :param ver: Learning Environment API version as a string.
+        :param max_workers: Number of org units polled at once.
+        :param overlap: Seconds each poll reaches back before the time the
+            last one started, so items are not missed through clock skew;
+            items seen again are not delivered again.
+        :param retention: Seconds the fingerprint of an item is kept after a
+            poll last returned it; an item edited after that is delivered as
+            `NEW` rather than `CHANGED`.
+        :param rate: If given, the most polls made per second.
+        :param retries: Number of times a poll is retried while the service
+            reports it is busy; see `d2lvalence.bulk.call`.
+
+        Other keyword arguments are passed to each service call.
+        """
+        if not isinstance(state, NewsState):
+            state = NewsState(state)
+        self.uc = uc
+        self.sink = sink
+        self.state = state
+        self.ver = ver
+        self.max_workers = max_workers
+        self.overlap = overlap
+        self.retention = retention
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.kwargs = kwargs
+        self.errors = {}
+
+    def poll(self, org_unit_ids):
+        """Poll the news of org units once, deliver the items that are new
+        or changed, and save the state of the org units that returned any.
+        Returns the number of items
+        delivered; org units whose poll failed keep their watermark, and
+        their errors are kept in `errors`.
+        """
+        self.errors = {}
+        delivered = 0
+        for (org_unit_id, result, exc) in d2lbulk.map_concurrently(
+                self._poll_one, org_unit_ids, self.max_workers):
+            if exc is not None:
+                self.errors[org_unit_id] = exc
+            else:
+                delivered += self._deliver(org_unit_id, *result)
+        self.state.save()
+        return delivered
+
+    def poll_feed(self, ver='1.0'):
+        """Poll the current user's feed once, as `poll` does an org unit's
+        news; items are delivered, as dicts, with the org unit `FEED`.
+
+        :param ver: Learning Platform API version as a string.
+        """
+        self.errors = {}
+        try:
+            result = self._poll_one(FEED, ver)
+        except Exception as e:
+            self.errors[FEED] = e
+            return 0
+        delivered = self._deliver(FEED, *result)
+        self.state.save()
+        return delivered
+
+    def run(self, org_unit_ids, interval=60, stop=None):
+        """Poll the org units every `interval` seconds until the
+        `threading.Event` `stop` is set.
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            self.poll(org_unit_ids)
+            stop.wait(interval)
+
+    def _poll_one(self, key, feed_ver=None):
+        (since, seen) = self.state.get(key)
+        started = datetime.datetime.utcnow()
+        now = time.time()
+        if key == FEED:
+            items = d2lbulk.call(d2lservice.get_my_feed, self.uc, since=since,
+                                 ver=feed_ver, limiter=self.limiter,
+                                 retries=self.retries, **self.kwargs)
+        else:
+            items = d2lbulk.call(d2lservice.get_news_for_orgunit, self.uc,
+                                 key, since=since, ver=self.ver,
+                                 limiter=self.limiter, retries=self.retries,
+                                 **self.kwargs)
+        fresh = {}
+        changes = []
+        for item in items or []:
+            digest = fingerprint(item)
+            item_id = str(item.get('Id', digest))
+            if item_id in fresh:
+                continue
+            fresh[item_id] = digest
+            if item_id not in seen:
+                changes.append((item, NEW))
+            elif seen[item_id][0] != digest:
+                changes.append((item, CHANGED))
+        if not fresh:
+            # nothing since the watermark, so it still holds, and the state
+            # need not be written
+            return ([], None, None)
+        # an item that drops out of a poll and is edited later should come
+        # back as changed, so fingerprints are kept for the retention period
+        # after they were last returned
+        seen.update((i, [d, now]) for (i, d) in fresh.items())
+        seen = dict((i, v) for (i, v) in seen.items()
+                    if v[1] >= now - self.retention)
+        watermark = d2lbulk.to_utc_string(
+            started - datetime.timedelta(seconds=self.overlap))
+        return (changes, watermark, seen)
+
+    def _deliver(self, key, changes, watermark, seen):
+        for (item, change) in changes:
+            # feed items are not all news items, so are left as dicts
+            news_item = item if key == FEED else d2ldata.NewsItem(item)
+            if hasattr(self.sink, 'put'):
+                self.sink.put((key, news_item, change))
+            else:
+                self.sink(key, news_item, change)
+        # the watermark only moves once everything is delivered, so a sink
+        # that fails leaves the items to be polled again
+        if watermark is not None:
+            self.state.set(key, watermark, seen)
+        return len(changes)
+
+
+class BroadcastReport(object):
+    """Outcome of posting a news item to many org units: `results` maps each
+    org unit to the `d2lvalence.data.NewsItem` created in it, or to the
+    exception its post failed with.
+    """
+    def __init__(self):
+        self.results = {}
+
+    @property
+    def created(self):
+        return dict((o, r) for (o, r) in self.results.items()
+                    if not isinstance(r, Exception))
+
+    @property
+    def failed(self):
+        return dict((o, r) for (o, r) in self.results.items()
+                    if isinstance(r, Exception))
+
+
+class NewsBroadcaster(object):
+    """Posts news items to many org units concurrently."""
+    def __init__(self, uc, ver='1.0', max_workers=8, rate=None, retries=2,
+                 **kwargs):
+        """
+        :param uc: User context used to post.
+        :param ver: Learning Environment API version as a string.
+        :param max_workers: Number of posts made at once.
+        :param rate: If given, the most posts made per second.
+        :param retries: Number of times a post is retried while the service
+            reports it is busy; see `d2lvalence.bulk.call`.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.kwargs = kwargs
+
+    def broadcast(self, news_item_data, org_unit_ids, d2l_file_list=None):
+        """Post a news item to org units, and return a `BroadcastReport`.
+
+        :param news_item_data: `d2lvalence.data.NewsItemData` to post.
+        :param org_unit_ids: Org units to post it to.
+        :param d2l_file_list: List of `d2lvalence.data.D2LNewsAttachment`s
+            attached to the item; their streams are read once.
+        """
+        (payload, content_type) = d2lservice.encode_news_item(news_item_data,
+                                                              d2l_file_list)
+        report = BroadcastReport()
+        for (org_unit_id, result, exc) in d2lbulk.map_concurrently(
+                lambda o: d2lbulk.call(
+                    d2lservice.create_encoded_news_item_for_orgunit, self.uc,
+                    o, payload, content_type, ver=self.ver,
+                    limiter=self.limiter, retries=self.retries,
+                    **self.kwargs),
+                org_unit_ids, self.max_workers):
+            report.results[org_unit_id] = exc if exc is not None else \
+                d2ldata.NewsItem(result)
+        return report
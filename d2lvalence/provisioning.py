@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, provisioning module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.provisioning
+:synopsis: Provides bulk provisioning of users and course offerings.
+
+User records to provision are validated up front, matched with existing
+users, compared with them so that updates changing nothing are skipped, and
+written concurrently, with the result of each record yielded as soon as it
+is known.
+
+Course offerings are validated against course templates, the course schema
+and org unit types fetched once and cached, then created concurrently, with
+any follow-up updates sent in batches and a running throughput report.
+"""
+import csv
+import re
+import threading
+import time
+
+import requests
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.data as d2ldata
+import d2lvalence.resolver as d2lresolver
+import d2lvalence.service as d2lservice
+
+CREATE = 'create'
+UPDATE = 'update'
+SKIP = 'skip'
+INVALID = 'invalid'
+ERROR = 'error'
+
+# Fields compared to tell whether an update changes a user
+USER_FIELDS = ('OrgDefinedId', 'FirstName', 'MiddleName', 'LastName',
+               'ExternalEmail', 'UserName')
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+TRUE_STRINGS = ('1', 'true', 'yes', 'y')
+
+
+class UserJob(object):
+    """One user record to provision.
+
+    `data` is a `CreateUserData` or an `UpdateUserData`. An update is applied
+    to the user with `user_id` or, if that is None, to the user with the
+    record's UserName.
+    """
+    def __init__(self, data, user_id=None, reset_password=False, key=None):
+        """
+        :param data: `CreateUserData` or `UpdateUserData`.
+        :param user_id: User to update, if known.
+        :param reset_password: Send the user a password reset email once the
+            record is written.
+        :param key: Identifies the record in results, such as its line in a
+            CSV file; defaults to its UserName.
+        """
+        self.data = data
+        self.user_id = user_id
+        self.reset_password = reset_password
+        self.key = key if key is not None else data.props.get('UserName')
+
+
+class UserResult(object):
+    """Result of provisioning one `UserJob`: its `action` (`CREATE`,
+    `UPDATE`, `SKIP`, `INVALID` or `ERROR`), the `user` written or found, and
+    the `errors` that kept it from being written.
+    """
+    def __init__(self, job, action, user=None, errors=None):
+        self.job = job
+        self.action = action
+        self.user = user
+        self.errors = errors or []
+
+    def __repr__(self):
+        return str({'Key': self.job.key, 'Action': self.action,
+                    'Errors': [str(e) for e in self.errors]})
+
+
+def _bool(s):
+    return str(s).strip().lower() in TRUE_STRINGS
+
+
+def read_users_csv(f):
+    """Read user records from a CSV file, and yield them as `UserJob`.
+
+    :param f: Text file object, or path of the file to read.
+
+    The header row names the columns: OrgDefinedId, FirstName, MiddleName,
+    LastName, ExternalEmail, UserName, RoleId, IsActive and SendCreationEmail
+    as in `CreateUserData`, with, optionally, UserId, Action ('create' or
+    'update') and ResetPassword. Rows with a UserId, or with the action
+    'update', become updates, and other rows creates.
+    """
+    if isinstance(f, str):
+        with open(f, 'r', newline='', encoding='utf-8') as fin:
+            for job in read_users_csv(fin):
+                yield job
+        return
+    reader = csv.DictReader(f)
+    for row in reader:
+        row = dict((k, (v or '').strip()) for (k, v) in row.items() if k)
+        line = reader.line_num
+        user_id = int(row['UserId']) if row.get('UserId') else None
+        if user_id is not None or row.get('Action', '').lower() == UPDATE:
+            data = d2ldata.UpdateUserData.fashion_UpdateUserData(
+                row.get('OrgDefinedId', ''), row.get('FirstName', ''),
+                row.get('MiddleName', ''), row.get('LastName', ''),
+                row.get('ExternalEmail') or None, row.get('UserName', ''),
+                _bool(row.get('IsActive', '')))
+        else:
+            data = d2ldata.CreateUserData.fashion_CreateUserData(
+                row.get('OrgDefinedId', ''), row.get('FirstName', ''),
+                row.get('MiddleName', ''), row.get('LastName', ''),
+                row.get('ExternalEmail') or None, row.get('UserName', ''),
+                row.get('RoleId', ''), _bool(row.get('IsActive', '')),
+                _bool(row.get('SendCreationEmail', '')))
+        yield UserJob(data, user_id, _bool(row.get('ResetPassword', '')),
+                      line)
+
+
+def validate_user(data):
+    """Retrieve the list of problems with a `CreateUserData` or
+    `UpdateUserData`; it is empty if there are none.
+    """
+    errors = []
+    if not isinstance(data, (d2ldata.CreateUserData,
+                             d2ldata.UpdateUserData)):
+        return ['Record must be CreateUserData or UpdateUserData']
+    p = data.props
+    for field in ('UserName', 'FirstName', 'LastName'):
+        if not str(p.get(field) or '').strip():
+            errors.append('{0} is required'.format(field))
+    if p.get('ExternalEmail') and not EMAIL_RE.match(p['ExternalEmail']):
+        errors.append('ExternalEmail is not an email address: {0}'.format(
+            p['ExternalEmail']))
+    if isinstance(data, d2ldata.CreateUserData):
+        try:
+            int(p.get('RoleId'))
+        except (TypeError, ValueError):
+            errors.append('RoleId must be a number: {0}'.format(
+                p.get('RoleId')))
+    return errors
+
+
+def user_changes(data, user):
+    """Retrieve the names of the fields an `UpdateUserData` would change in
+    a `UserData`, with 'Activation' included if it changes whether the user
+    is active.
+    """
+    changed = [f for f in USER_FIELDS
+               if (data.props.get(f) or None) != (user.props.get(f) or None)]
+    if bool(data.props['Activation']['IsActive']) != bool(user.IsActive):
+        changed.append('Activation')
+    return changed
+
+
+class UserProvisioner(object):
+    """Provisions users in bulk."""
+    def __init__(self, uc, ver='1.0', max_workers=8, rate=None, retries=2,
+                 resolver=None, **kwargs):
+        """
+        :param uc: User context used for provisioning.
+        :param ver: Learning Platform API version as a string.
+        :param max_workers: Number of requests made at once.
+        :param rate: If given, the most records written per second.
+        :param retries: Number of times a request is retried while the
+            service reports it is busy; see `d2lvalence.bulk.call`.
+        :param resolver: `d2lvalence.resolver.UserResolver` used to find
+            existing users by UserName; one is made if not given.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.resolver = resolver or d2lresolver.UserResolver(
+            uc, ver, max_workers, **kwargs)
+        self.kwargs = kwargs
+
+    def provision(self, records, upsert=False, strict=False):
+        """Provision user records, yielding a `UserResult` for each as soon
+        as it is known; the results of invalid records come first.
+
+        :param records:
+            Iterable of `UserJob`, or of `CreateUserData` and
+            `UpdateUserData`, such as from `read_users_csv`.
+        :param upsert:
+            Treat a create whose UserName already exists as an update of
+            that user, rather than letting the service reject it.
+        :param strict:
+            Write nothing, and raise ValueError listing the problems, if any
+            record is invalid.
+        """
+        jobs = []
+        invalid = []
+        names = set()
+        for record in records:
+            job = record if isinstance(record, UserJob) else UserJob(record)
+            errors = validate_user(job.data)
+            name = str(job.data.props.get('UserName') or '').lower()
+            if name and name in names:
+                errors.append('UserName appears more than once: {0}'.format(
+                    job.data.props.get('UserName')))
+            names.add(name)
+            if errors:
+                invalid.append(UserResult(job, INVALID, errors=errors))
+            else:
+                jobs.append(job)
+        if strict and invalid:
+            raise ValueError('Invalid user records: {0}'.format(invalid))
+        for result in invalid:
+            yield result
+        # existing users are found in one concurrent batch rather than by
+        # each worker
+        lookup = [j.data.props['UserName'] for j in jobs
+                  if j.user_id is None and
+                  (upsert or isinstance(j.data, d2ldata.UpdateUserData))]
+        existing = self.resolver.resolve_user_names(lookup) if lookup else {}
+        for (job, result, exc) in d2lbulk.map_concurrently(
+                lambda j: self._provision(j, existing, upsert), jobs,
+                self.max_workers):
+            yield result if exc is None else UserResult(job, ERROR,
+                                                        errors=[exc])
+
+    def _call(self, fn, *args):
+        return d2lbulk.call(fn, self.uc, *args, ver=self.ver,
+                            limiter=self.limiter, retries=self.retries,
+                            **self.kwargs)
+
+    def _provision(self, job, existing, upsert):
+        data = job.data
+        user = None
+        if job.user_id is not None:
+            user = self._call(d2lservice.get_user, job.user_id)
+        elif isinstance(data, d2ldata.UpdateUserData) or upsert:
+            user = existing.get(data.props['UserName'])
+            if user is None and isinstance(data, d2ldata.UpdateUserData):
+                return UserResult(job, ERROR, errors=[
+                    'No user with UserName {0}'.format(data.UserName)])
+        if user is None:
+            user = self._call(d2lservice.create_user, data)
+            action = CREATE
+        else:
+            if isinstance(data, d2ldata.CreateUserData):
+                data = _as_update(data)
+            changed = user_changes(data, user)
+            if not changed:
+                return UserResult(job, SKIP, user)
+            activation = d2ldata.UserActivationData(data.Activation)
+            if changed == ['Activation']:
+                self._call(d2lservice.update_user_activation, user.UserId,
+                           activation)
+                user.props['Activation'] = activation.as_dict()
+            else:
+                previous = user
+                user = self._call(d2lservice.update_user, user.UserId, data)
+                # identifiers the update changed no longer match the user
+                for kind in (d2lresolver.ORG_DEFINED_ID,
+                             d2lresolver.USER_NAME):
+                    old = previous.props.get(kind)
+                    if old and str(old).lower() != \
+                            str(user.props.get(kind)).lower():
+                        self.resolver.forget(kind, old)
+            action = UPDATE
+        # so later runs resolve the user as written, not as it was found
+        self.resolver.remember(user)
+        if job.reset_password:
+            self._call(d2lservice.send_password_reset_email_for_user,
+                       user.UserId)
+        return UserResult(job, action, user)
+
+
+def _as_update(data):
+    p = data.props
+    return d2ldata.UpdateUserData.fashion_UpdateUserData(
+        p.get('OrgDefinedId'), p.get('FirstName'), p.get('MiddleName'),
+        p.get('LastName'), p.get('ExternalEmail'), p.get('UserName'),
+        p.get('IsActive'))
+
+
+class CourseJob(object):
+    """One course offering to create, with an optional follow-up update.
+
+    `update` is a dict of `CourseOfferingInfo` properties (Name, Code,
+    StartDate, EndDate, IsActive) to set once the offering exists, such as
+    IsActive, which the create route does not take.
+    """
+    def __init__(self, data, update=None, key=None):
+        """
+        :param data: `CreateCourseOffering` to create.
+        :param update: Dict of `CourseOfferingInfo` properties to update.
+        :param key: Identifies the record in results; defaults to its Code.
+        """
+        self.data = data
+        self.update = update
+        self.key = key if key is not None else data.props.get('Code')
+
+
+class CourseResult(object):
+    """Result of provisioning one `CourseJob`: its `action` (`CREATE`,
+    `UPDATE` once its follow-up update is also done, `INVALID` or `ERROR`),
+    the `course` offering created, and the `errors` that stopped it.
+    """
+    def __init__(self, job, action, course=None, errors=None):
+        self.job = job
+        self.action = action
+        self.course = course
+        self.errors = errors or []
+
+    def __repr__(self):
+        return str({'Key': self.job.key, 'Action': self.action,
+                    'Errors': [str(e) for e in self.errors]})
+
+
+class ProvisionReport(object):
+    """Running counts of a provisioning run, by action, with its throughput
+    in records finished per second.
+    """
+    def __init__(self, total=None):
+        self.total = total
+        self.counts = dict((a, 0) for a in (CREATE, UPDATE, INVALID, ERROR))
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, action):
+        with self._lock:
+            self.counts[action] = self.counts.get(action, 0) + 1
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return '{0}/{1} done in {2:.1f}s ({3:.1f}/s) {4}'.format(
+            self.done, '?' if self.total is None else self.total,
+            self.elapsed, self.rate, self.counts)
+
+
+class CourseProvisioner(object):
+    """Creates course offerings in bulk.
+
+    Course templates, the course schema and the org unit types it names are
+    fetched once, the first time they are needed, and kept for the life of
+    the provisioner.
+    """
+    def __init__(self, uc, ver='1.0', max_workers=8, rate=None, retries=2,
+                 batch_size=100, **kwargs):
+        """
+        :param uc: User context used for provisioning.
+        :param ver: Learning Platform API version as a string.
+        :param max_workers: Number of requests made at once.
+        :param rate: If given, the most requests made per second.
+        :param retries: Number of times a request is retried while the
+            service reports it is busy; see `d2lvalence.bulk.call`.
+        :param batch_size: Number of follow-up updates gathered before they
+            are sent together.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._templates = {}
+        self._schema = None
+
+    def _call(self, fn, *args):
+        return d2lbulk.call(fn, self.uc, *args, ver=self.ver,
+                            limiter=self.limiter, retries=self.retries,
+                            **self.kwargs)
+
+    def _send(self, fn, *args):
+        # the course offering create and update routes do not set the
+        # content type of the JSON they send
+        kwargs = d2lbulk.copy_kwargs(self.kwargs)
+        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                 **{'Content-Type': 'application/json'})
+        return d2lbulk.call(fn, self.uc, *args, ver=self.ver,
+                            limiter=self.limiter, retries=self.retries,
+                            **kwargs)
+
+    def template(self, template_id):
+        """Retrieve a course template, or None if there is no such
+        template.
+        """
+        template_id = int(template_id)
+        with self._lock:
+            if template_id in self._templates:
+                return self._templates[template_id]
+        try:
+            template = self._call(d2lservice.get_course_template, template_id)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            template = None
+        with self._lock:
+            self._templates[template_id] = template
+        return template
+
+    def schema(self):
+        """Retrieve the course schema as a list of `(OrgUnitType,
+        CourseSchemaElement)` pairs.
+        """
+        with self._lock:
+            if self._schema is not None:
+                return self._schema
+        elements = self._call(d2lservice.get_course_schemas)
+        type_ids = set(int(e.Type['Id']) for e in elements)
+        outypes = dict((i, t) for (i, t, exc) in d2lbulk.map_concurrently(
+            lambda i: self._call(d2lservice.get_outype, i), type_ids,
+            self.max_workers) if exc is None)
+        schema = [(outypes.get(int(e.Type['Id']),
+                   d2ldata.OrgUnitType(e.Type)), e) for e in elements]
+        with self._lock:
+            self._schema = schema
+        return schema
+
+    def preload(self, jobs):
+        """Fetch the schema and every course template the jobs use, at once,
+        so validating them makes no further requests.
+        """
+        template_ids = set(int(j.data.props['CourseTemplateId']) for j in jobs
+                           if _is_id(j.data.props.get('CourseTemplateId')))
+        for (template_id, template, exc) in d2lbulk.map_concurrently(
+                self.template, template_ids, self.max_workers):
+            if exc is not None:
+                raise exc
+        self.schema()
+
+    def validate(self, data):
+        """Retrieve the list of problems with a `CreateCourseOffering`; it is
+        empty if there are none.
+        """
+        if not isinstance(data, d2ldata.CreateCourseOffering):
+            return ['Record must be CreateCourseOffering']
+        p = data.props
+        errors = []
+        for field in ('Name', 'Code'):
+            if not str(p.get(field) or '').strip():
+                errors.append('{0} is required'.format(field))
+        if not _is_id(p.get('CourseTemplateId')):
+            errors.append('CourseTemplateId is required')
+        elif self.template(p['CourseTemplateId']) is None:
+            errors.append('No course template {0}'.format(
+                p['CourseTemplateId']))
+        if p.get('StartDate') and p.get('EndDate') and \
+                p['StartDate'] > p['EndDate']:
+            errors.append('StartDate is after EndDate')
+        for (outype, element) in self.schema():
+            # the only parent a course offering names other than its
+            # template is its semester
+            if outype.props.get('Code', '').lower() != 'semester':
+                continue
+            if element.IsRequired and not _is_id(p.get('SemesterId')):
+                errors.append('SemesterId is required by the course schema')
+            if element.IsNotAllowed and _is_id(p.get('SemesterId')):
+                errors.append('SemesterId is not allowed by the course schema')
+        return errors
+
+    def provision(self, records, progress=None, progress_every=100):
+        """Create course offerings, yielding a `CourseResult` for each as
+        soon as it is known; the results of invalid records come first.
+
+        :param records: Iterable of `CourseJob` or `CreateCourseOffering`.
+        :param progress: Called with the `ProvisionReport` every
+            `progress_every` results, and once at the end.
+
+        The report is also kept as the provisioner's `report`.
+        """
+        jobs = [r if isinstance(r, CourseJob) else CourseJob(r)
+                for r in records]
+        report = self.report = ProvisionReport(len(jobs))
+        self.preload(jobs)
+        valid = []
+        codes = set()
+        invalid = []
+        for job in jobs:
+            errors = self.validate(job.data)
+            code = str(job.data.props.get('Code') or '').lower()
+            if code and code in codes:
+                errors.append('Code appears more than once: {0}'.format(
+                    job.data.props.get('Code')))
+            codes.add(code)
+            if errors:
+                invalid.append(CourseResult(job, INVALID, errors=errors))
+            else:
+                valid.append(job)
+
+        def finish(result):
+            report.add(result.action)
+            if progress is not None and report.done % progress_every == 0:
+                progress(report)
+            return result
+
+        for result in invalid:
+            yield finish(result)
+        batch = []
+        for (job, course, exc) in d2lbulk.map_concurrently(
+                lambda j: self._send(d2lservice.create_course_offering,
+                                     j.data), valid, self.max_workers):
+            if exc is not None:
+                yield finish(CourseResult(job, ERROR, errors=[exc]))
+            elif job.update:
+                batch.append(CourseResult(job, CREATE, course))
+                if len(batch) >= self.batch_size:
+                    for result in self._update_batch(batch):
+                        yield finish(result)
+                    batch = []
+            else:
+                yield finish(CourseResult(job, CREATE, course))
+        for result in self._update_batch(batch):
+            yield finish(result)
+        if progress is not None:
+            progress(report)
+
+    def update(self, updates):
+        """Update many course offerings concurrently.
+
+        :param updates: Iterable of `(org_unit_id, properties)` pairs, with
+            the properties a `CourseOfferingInfo` or a dict of some of its
+            properties; those for the same org unit are merged, later ones
+            winning, and the rest of each offering's properties are fetched.
+
+        Yields an `(org_unit_id, course_offering, exception)` tuple for each
+        org unit as its update finishes.
+        """
+        merged = {}
+        for (org_unit_id, props) in updates:
+            if isinstance(props, d2ldata.D2LStructure):
+                props = props.props
+            merged.setdefault(int(org_unit_id), {}).update(props)
+
+        def update_one(org_unit_id):
+            current = self._call(d2lservice.get_course_offering, org_unit_id)
+            return self._send(d2lservice.update_course_offering, org_unit_id,
+                              _offering_info(current, merged[org_unit_id]))
+
+        for result in d2lbulk.map_concurrently(update_one, merged,
+                                               self.max_workers):
+            yield result
+
+    def _update_batch(self, results):
+        # the offerings were just created, so their current properties are
+        # already known
+        def update_one(result):
+            return self._send(d2lservice.update_course_offering,
+                              int(result.course.Identifier),
+                              _offering_info(result.course,
+                                             result.job.update))
+
+        for (result, course, exc) in d2lbulk.map_concurrently(
+                update_one, results, self.max_workers):
+            if exc is not None:
+                result.errors.append(exc)
+                result.action = ERROR
+            else:
+                result.course = course
+                result.action = UPDATE
+            yield result
+
+
+def _is_id(value):
+    try:
+        return int(value) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+def _offering_info(course, update):
+    p = course.props
+    info = d2ldata.CourseOfferingInfo.fashion_CourseOfferingInfo(
+        p.get('Name'), p.get('Code'), p.get('StartDate'), p.get('EndDate'),
+        p.get('IsActive', False))
+    info.props.update(update)
+    return info
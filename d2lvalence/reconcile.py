@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, reconcile module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.reconcile
+:synopsis: Provides reconciliation of org unit enrollments with a desired state.
+
+The desired enrollments are given as `(org_unit_id, user_id, role_id)`
+tuples. The actual enrollments of every org unit involved are fetched
+concurrently, the smallest set of changes turning one into the other is
+worked out with set operations, and the changes are applied concurrently.
+
+A reconciliation can be checkpointed to a file: the plan is saved there
+before any change is applied, and each change applied is appended to it, so
+a reconciliation that is interrupted resumes where it stopped without
+fetching the enrollments again.
+"""
+import json
+import os
+import threading
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.data as d2ldata
+import d2lvalence.service as d2lservice
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+class EnrollmentPlan(object):
+    """The changes reconciling actual enrollments with desired ones.
+
+    `creates` and `updates` hold `(org_unit_id, user_id, role_id)` tuples of
+    enrollments to add and of enrollments whose role changes; `deletes` holds
+    `(org_unit_id, user_id, role_id)` tuples of enrollments to remove, with
+    the role they have now.
+    """
+    def __init__(self, creates=(), updates=(), deletes=(), unchanged=0):
+        self.creates = sorted(creates)
+        self.updates = sorted(updates)
+        self.deletes = sorted(deletes)
+        self.unchanged = unchanged
+
+    @staticmethod
+    def diff(desired, actual, delete=True):
+        """Work out the plan turning a set of actual enrollments into a set
+        of desired ones, both of `(org_unit_id, user_id, role_id)` tuples.
+        Enrollments only in `actual` are deleted if `delete` is true.
+        """
+        desired_roles = dict(((ou, u), r) for (ou, u, r) in desired)
+        actual_roles = dict(((ou, u), r) for (ou, u, r) in actual)
+        wanted = set(desired_roles)
+        present = set(actual_roles)
+        creates = [k + (desired_roles[k],) for k in wanted - present]
+        updates = [k + (desired_roles[k],) for k in wanted & present
+                   if desired_roles[k] != actual_roles[k]]
+        deletes = [k + (actual_roles[k],) for k in present - wanted] \
+            if delete else []
+        return EnrollmentPlan(creates, updates, deletes,
+                              len(wanted & present) - len(updates))
+
+    def operations(self):
+        """Retrieve every change as an `(action, org_unit_id, user_id,
+        role_id)` tuple.
+        """
+        return [(CREATE,) + e for e in self.creates] + \
+            [(UPDATE,) + e for e in self.updates] + \
+            [(DELETE,) + e for e in self.deletes]
+
+    def stats(self):
+        """Retrieve a dict of the number of changes of each kind, and of
+        enrollments left unchanged.
+        """
+        return {'Create': len(self.creates),
+                'Update': len(self.updates),
+                'Delete': len(self.deletes),
+                'Unchanged': self.unchanged}
+
+    def as_dict(self):
+        return {'Create': self.creates, 'Update': self.updates,
+                'Delete': self.deletes, 'Unchanged': self.unchanged}
+
+    @staticmethod
+    def from_dict(d):
+        return EnrollmentPlan([tuple(e) for e in d['Create']],
+                              [tuple(e) for e in d['Update']],
+                              [tuple(e) for e in d['Delete']],
+                              d['Unchanged'])
+
+
+class ReconcileReport(object):
+    """Outcome of a reconciliation: its `plan`, and `results` mapping each
+    change applied, as an `(action, org_unit_id, user_id, role_id)` tuple, to
+    None if it succeeded or to the exception it failed with. `resumed`
+    counts the changes applied by an earlier, interrupted, run.
+    """
+    def __init__(self, plan):
+        self.plan = plan
+        self.results = {}
+        self.resumed = 0
+
+    @property
+    def failed(self):
+        return dict((op, exc) for (op, exc) in self.results.items()
+                    if exc is not None)
+
+
+class _Checkpoint(object):
+    # the plan, as JSON, on the first line; then one JSON line for each
+    # change applied
+    def __init__(self, path):
+        self.path = path
+        self.plan = None
+        self.done = set()
+        self._lock = threading.Lock()
+        self._f = None
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+            if lines:
+                self.plan = EnrollmentPlan.from_dict(json.loads(lines[0]))
+                # a last line cut short by the interruption is ignored
+                for line in lines[1:]:
+                    try:
+                        self.done.add(tuple(json.loads(line)))
+                    except ValueError:
+                        pass
+
+    def start(self, plan):
+        self.plan = plan
+        self._f = open(self.path, 'w', encoding='utf-8')
+        self._f.write(json.dumps(plan.as_dict()) + '\n')
+        self._f.flush()
+
+    def resume(self):
+        self._f = open(self.path, 'a', encoding='utf-8')
+        # ends any line cut short by the interruption
+        self._f.write('\n')
+
+    def record(self, op):
+        with self._lock:
+            self._f.write(json.dumps(list(op)) + '\n')
+            self._f.flush()
+
+    def close(self, finished):
+        if self._f is not None:
+            self._f.close()
+        if finished:
+            os.remove(self.path)
+
+
+class EnrollmentReconciler(object):
+    """Reconciles the enrollments of org units with a desired state."""
+    def __init__(self, uc, ver='1.0', max_workers=8, rate=None, retries=2,
+                 **kwargs):
+        """
+        :param uc: User context used for the reconciliation.
+        :param ver: Learning Platform API version as a string.
+        :param max_workers: Number of requests made at once.
+        :param rate: If given, the most changes applied per second.
+        :param retries: Number of times a request is retried while the
+            service reports it is busy; see `d2lvalence.bulk.call`.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.limiter = d2lbulk.RateLimiter(rate, max_workers) if rate else None
+        self.retries = retries
+        self.kwargs = kwargs
+
+    def actual(self, org_unit_ids):
+        """Fetch the enrollments of org units concurrently, and retrieve
+        them as a set of `(org_unit_id, user_id, role_id)` tuples.
+        """
+        enrollments = set()
+        for (org_unit_id, items, exc) in d2lbulk.map_concurrently(
+                self._fetch, set(org_unit_ids), self.max_workers):
+            if exc is not None:
+                raise exc
+            enrollments.update(items)
+        return enrollments
+
+    def plan(self, desired, org_unit_ids=(), delete=True):
+        """Work out the `EnrollmentPlan` reconciling the org units with the
+        desired enrollments, without applying it.
+
+        :param desired: Iterable of `(org_unit_id, user_id, role_id)` tuples.
+        :param org_unit_ids:
+            Further org units to reconcile; every org unit appearing in
+            `desired` is reconciled, and these are too, so that an org unit
+            whose enrollments should all go can be included.
+        :param delete: Remove enrollments that are not desired.
+        """
+        desired = set((int(ou), int(u), int(r)) for (ou, u, r) in desired)
+        scope = set(e[0] for e in desired) | set(int(o) for o in org_unit_ids)
+        return EnrollmentPlan.diff(desired, self.actual(scope), delete)
+
+    def reconcile(self, desired, org_unit_ids=(), delete=True, dry_run=False,
+                  checkpoint=None):
+        """Reconcile the org units with the desired enrollments, and return a
+        `ReconcileReport`.
+
+        :param desired: See `plan`.
+        :param org_unit_ids: See `plan`.
+        :param delete: See `plan`.
+        :param dry_run: Work out the plan, but apply none of it.
+        :param checkpoint:
+            Path of a checkpoint file. If it holds the checkpoint of an
+            interrupted reconciliation, its plan is resumed instead of
+            working out a new one. It is removed once every change has
+            succeeded, and kept otherwise, so that running again retries the
+            changes that failed.
+        """
+        state = _Checkpoint(checkpoint) if checkpoint else None
+        if state is not None and state.plan is not None:
+            plan = state.plan
+        else:
+            plan = self.plan(desired, org_unit_ids, delete)
+        report = ReconcileReport(plan)
+        if dry_run:
+            return report
+        ops = plan.operations()
+        if state is not None:
+            if state.plan is plan:
+                state.resume()
+                report.resumed = len(state.done)
+                ops = [op for op in ops if op not in state.done]
+            else:
+                state.start(plan)
+        try:
+            for (op, result, exc) in d2lbulk.map_concurrently(
+                    self._apply, ops, self.max_workers):
+                report.results[op] = exc
+                if exc is None and state is not None:
+                    state.record(op)
+        finally:
+            if state is not None:
+                state.close(len(report.results) == len(ops) and
+                            not report.failed)
+        return report
+
+    def _fetch(self, org_unit_id):
+        return [(org_unit_id, int(item['User']['Identifier']),
+                 int(item['Role']['Id']))
+                for item in d2lbulk.iter_paged(
+                    d2lservice.get_enrolled_users_for_orgunit, self.uc,
+                    org_unit_id, ver=self.ver, **self.kwargs)]
+
+    def _apply(self, op):
+        (action, org_unit_id, user_id, role_id) = op
+        if action == DELETE:
+            return d2lbulk.call(d2lservice.delete_user_enrollment_in_orgunit,
+                                self.uc, org_unit_id, user_id, ver=self.ver,
+                                limiter=self.limiter, retries=self.retries,
+                                **self.kwargs)
+        # creating an enrollment that exists replaces its role
+        enrollment = d2ldata.CreateEnrollmentData.fashion_CreateEnrollmentData(
+            org_unit_id, user_id, role_id)
+        kwargs = d2lbulk.copy_kwargs(self.kwargs)
+        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                 **{'Content-Type': 'application/json'})
+        return d2lbulk.call(d2lservice.create_enrollment_for_user, self.uc,
+                            enrollment, ver=self.ver, limiter=self.limiter,
+                            retries=self.retries, **kwargs)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# D2LValence package, resolver module.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the license at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+:module: d2lvalence.resolver
+:synopsis: Provides batch resolution of OrgDefinedIds and user names to users.
+"""
+import threading
+import time
+
+import requests
+
+import d2lvalence.bulk as d2lbulk
+import d2lvalence.data as d2ldata
+import d2lvalence.service as d2lservice
+
+ORG_DEFINED_ID = 'OrgDefinedId'
+USER_NAME = 'UserName'
+
+
+class UserResolver(object):
+    """Resolves OrgDefinedIds and user names to `UserData`, remembering the
+    results.
+
+    Users found are remembered for `ttl` seconds and identifiers that match
+    no user for `negative_ttl` seconds. Lookups of identifiers not remembered
+    are made concurrently, and a lookup already in progress is shared by every
+    caller asking for the same identifier.
+    """
+    def __init__(self, uc, ver='1.0', max_workers=8, ttl=3600.0,
+                 negative_ttl=300.0, **kwargs):
+        """
+        :param uc: User context used for the lookups.
+        :param ver: Learning Platform API version as a string.
+        :param max_workers: Number of lookups made at once.
+        :param ttl: Seconds a user found is remembered for.
+        :param negative_ttl: Seconds an identifier matching no user is
+            remembered for.
+
+        Other keyword arguments are passed to each service call.
+        """
+        self.uc = uc
+        self.ver = ver
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._inflight = {}
+        # time until which the cache holds every user, after a warm
+        self._complete_until = 0.0
+
+    def resolve(self, org_defined_ids, warm_threshold=None):
+        """Resolve OrgDefinedIds to users.
+
+        :param org_defined_ids: Iterable of OrgDefinedIds.
+        :param warm_threshold:
+            If given, and more than this many of the identifiers are not
+            remembered, the cache is warmed with a walk of the whole user
+            list instead of looking them up one by one.
+
+        Returns a dict mapping each OrgDefinedId to its `UserData`, or to None
+        if it matches no user. Where an OrgDefinedId matches more than one
+        user, the first listed is used.
+        """
+        return self._resolve(ORG_DEFINED_ID, org_defined_ids, warm_threshold)
+
+    def resolve_user_names(self, user_names, warm_threshold=None):
+        """Resolve user names to users; as `resolve`, but user names are
+        matched without regard to case.
+        """
+        return self._resolve(USER_NAME, user_names, warm_threshold)
+
+    def warm(self):
+        """Remember every user, from a walk of the paged `get_users` route.
+
+        Until the users found expire, identifiers not found are resolved to
+        None without a lookup. Returns the number of users remembered.
+        """
+        count = 0
+        # an identifier shared by several users resolves to the first listed,
+        # as a lookup does
+        walked = set()
+        for item in d2lbulk.iter_paged(d2lservice.get_users, self.uc,
+                                       ver=self.ver, **self.kwargs):
+            user = d2ldata.UserData(item)
+            for kind in (ORG_DEFINED_ID, USER_NAME):
+                value = item.get(kind)
+                if value and _key(kind, value) not in walked:
+                    walked.add(_key(kind, value))
+                    self._remember(kind, value, user, self.ttl)
+            count += 1
+        with self._lock:
+            self._complete_until = time.time() + self.ttl
+        return count
+
+    def remember(self, user):
+        """Remember a `UserData` under its OrgDefinedId and user name, as for
+        `ttl` seconds; callers creating or updating users use this to keep
+        the results of later lookups current.
+        """
+        self._remember(ORG_DEFINED_ID, user.props.get(ORG_DEFINED_ID), user,
+                       self.ttl)
+        self._remember(USER_NAME, user.props.get(USER_NAME), user, self.ttl)
+
+    def forget(self, kind=None, value=None):
+        """Forget remembered results: all of them, those of one kind
+        (`ORG_DEFINED_ID` or `USER_NAME`), or one identifier.
+        """
+        with self._lock:
+            if kind is None:
+                self._cache.clear()
+            elif value is None:
+                for key in [k for k in self._cache if k[0] == kind]:
+                    del self._cache[key]
+            else:
+                self._cache.pop(_key(kind, value), None)
+            self._complete_until = 0.0
+
+    def _resolve(self, kind, values, warm_threshold):
+        values = list(values)
+        result = {}
+        missing = []
+        for v in values:
+            found, user = self._cached(kind, v)
+            if found:
+                result[v] = user
+            else:
+                missing.append(v)
+        if missing and warm_threshold is not None and \
+                len(set(missing)) > warm_threshold:
+            self.warm()
+            for v in missing:
+                result[v] = self._cached(kind, v)[1]
+            return result
+        for (v, user, exc) in d2lbulk.map_concurrently(
+                lambda v: self._lookup(kind, v), set(missing),
+                self.max_workers):
+            if exc is not None:
+                raise exc
+            result[v] = user
+        return result
+
+    def _cached(self, kind, value):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(_key(kind, value))
+            if entry is not None and entry[0] > now:
+                return (True, entry[1])
+            if now < self._complete_until:
+                return (True, None)
+        return (False, None)
+
+    def _remember(self, kind, value, user, ttl):
+        if value:
+            with self._lock:
+                self._cache[_key(kind, value)] = (time.time() + ttl, user)
+
+    def _lookup(self, kind, value):
+        key = _key(kind, value)
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+        if not owner:
+            event.wait()
+            found, user = self._cached(kind, value)
+            if found:
+                return user
+            return self._lookup(kind, value)
+        try:
+            user = self._fetch(kind, value)
+            self._remember(kind, value, user,
+                           self.ttl if user is not None else self.negative_ttl)
+            return user
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def _fetch(self, kind, value):
+        kwargs = d2lbulk.copy_kwargs(self.kwargs)
+        if kind == ORG_DEFINED_ID:
+            users = d2lservice.get_users(self.uc, org_defined_id=value,
+                                         ver=self.ver, **kwargs)
+            return users[0] if users else None
+        try:
+            return d2lservice.get_users(self.uc, user_name=value,
+                                        ver=self.ver, **kwargs)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+
+def _key(kind, value):
+    value = str(value)
+    return (kind, value.lower() if kind == USER_NAME else value)
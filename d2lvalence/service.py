@@ -85,6 +85,33 @@ def _get(route,uc,**kwargs):
     r = requests.get(uc.scheme + '://' + uc.host + route, **kwargs)
     return _fetch_content(r,debug=d)
 
+def _get_stream(route,uc,**kwargs):
+    # like _get, but hands back the streaming response object so that callers
+    # can pull large bodies down in chunks; callers must close the response
+    if uc.anonymous:
+        raise ValueError('User context cannot be anonymous.').with_traceback(sys.exc_info()[2])
+    kwargs.setdefault('params', None)
+    kwargs.setdefault('data', None)
+    kwargs.setdefault('headers', None)
+    kwargs.setdefault('auth', uc)
+    kwargs['stream'] = True
+    d = None
+    if 'd2ldebug' in kwargs:
+        d = kwargs['d2ldebug']
+        del kwargs['d2ldebug']
+    if d and not isinstance(d, d2ldata.D2LDebugInfo):
+        raise TypeError('If not None, debug info object must implement d2lvalence.data.D2LDebugInfo')
+    r = requests.get(uc.scheme + '://' + uc.host + route, **kwargs)
+    if d:
+        d.add_response(r)
+    try:
+        r.raise_for_status()
+    except requests.exceptions.HTTPError:
+        # nobody else gets the chance to close an error response
+        r.close()
+        raise
+    return r
+
 def _post(route,uc,**kwargs):
     if uc.anonymous:
         raise ValueError('User context cannot be anonymous.').with_traceback(sys.exc_info()[2])
@@ -496,6 +523,25 @@ def get_group_categories_for_orgunit(uc,org_unit_id,ver='1.0',**kwargs):
         result.append( d2ldata.GroupCategoryDataFetch(r[i]))
     return result
 
+def get_groups_for_orgunit_category(uc,org_unit_id,group_category_id,ver='1.0',**kwargs):
+    route = '/d2l/api/lp/{0}/{1}/groupcategories/{2}/groups/'.format(ver,org_unit_id,group_category_id)
+    r = _get(route,uc,**kwargs)
+    result = []
+    for i in range(len(r)):
+        result.append( d2ldata.GroupData(r[i]))
+    return result
+
+def get_group_for_orgunit_category(uc,org_unit_id,group_category_id,group_id,ver='1.0',**kwargs):
+    route = '/d2l/api/lp/{0}/{1}/groupcategories/{2}/groups/{3}'.format(ver,org_unit_id,group_category_id,group_id)
+    return d2ldata.GroupData(_get(route,uc,**kwargs))
+
+def enroll_user_in_group(uc,org_unit_id,group_category_id,group_id,user_id,ver='1.0',**kwargs):
+    route = '/d2l/api/lp/{0}/{1}/groupcategories/{2}/groups/{3}/enrollments/'.format(ver,org_unit_id,group_category_id,group_id)
+    kwargs.setdefault('data',json.dumps({'UserId':user_id}))
+    kwargs.setdefault('headers',{})
+    kwargs['headers'].update({'Content-Type':'application/json'})
+    return _post(route,uc,**kwargs)
+
 ## Course offerings
 def delete_course_offering(uc,org_unit_id,ver='1.0',**kwargs):
     route = '/d2l/api/lp/{0}/courses/{1}'.format(ver,org_unit_id)
@@ -1246,28 +1292,36 @@ def restore_news_item_for_orgunit(uc,org_unit_id,news_item_id,ver='1.0',**kwargs
     kwargs['headers'].update({'Content-Length':'0'})
     return _post(route,uc,**kwargs)
 
-def create_news_item_for_orgunit(uc,org_unit_id,news_item_data,d2l_file_list=None,ver='1.0',**kwargs):
+def encode_news_item(news_item_data,d2l_file_list=None):
+    """Encode a news item and its attachments as a multipart body.
+
+    Returns a (body, content type) tuple; the body is immutable, so one
+    encoding can be posted to many org units with
+    create_encoded_news_item_for_orgunit.
+    """
     if not isinstance(news_item_data, d2ldata.NewsItemData):
         raise TypeError('New news item must implement d2lvalence.data.NewsItemData').with_traceback(sys.exc_info()[2])
-    route = '/d2l/api/le/{0}/{1}/news/'.format(ver,org_unit_id)
-
     boundary = uuid.uuid4().hex
-    pdescr = '--{0}\r\nContent-Type: application/json\r\n\r\n{1}\r\n'.format(boundary,news_item_data.as_json()).encode(encoding='utf-8')
-    pbotbound = '\r\n--{0}--'.format(boundary).encode(encoding='utf-8')
-    if not d2l_file_list:
-        payload = pdescr + pbotbound
-    else:
-        pfileparts = b''
-        for i in range(len(d2l_file_list)):
-            f = d2l_file_list[i]
-            if isinstance(f, d2ldata.D2LFile):
-                f.Stream.seek(0)
-                fdata = f.Stream.read()
-                f.Stream.seek(0)
-                pfileparts = pfileparts + '\r\n--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\nContent-Type: {3}\r\n\r\n'.format(boundary,'file '+str(i),f.Name,f.ContentType).encode(encoding='utf-8') + fdata
-        payload = pdescr + pfileparts + pbotbound
+    parts = ['--{0}\r\nContent-Type: application/json\r\n\r\n{1}\r\n'.format(boundary,news_item_data.as_json()).encode(encoding='utf-8')]
+    for i in range(len(d2l_file_list or [])):
+        f = d2l_file_list[i]
+        if isinstance(f, d2ldata.D2LFile):
+            f.Stream.seek(0)
+            fdata = f.Stream.read()
+            f.Stream.seek(0)
+            parts.append('\r\n--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\nContent-Type: {3}\r\n\r\n'.format(boundary,'file '+str(i),f.Name,f.ContentType).encode(encoding='utf-8'))
+            parts.append(fdata)
+    parts.append('\r\n--{0}--'.format(boundary).encode(encoding='utf-8'))
+    return (b''.join(parts), 'multipart/mixed;boundary='+boundary)
 
-    ctype_header = {'Content-Type':'multipart/mixed;boundary='+boundary}
+def create_news_item_for_orgunit(uc,org_unit_id,news_item_data,d2l_file_list=None,ver='1.0',**kwargs):
+    payload, ctype = encode_news_item(news_item_data,d2l_file_list)
+    return create_encoded_news_item_for_orgunit(uc,org_unit_id,payload,ctype,ver=ver,**kwargs)
+
+def create_encoded_news_item_for_orgunit(uc,org_unit_id,payload,content_type,ver='1.0',**kwargs):
+    route = '/d2l/api/le/{0}/{1}/news/'.format(ver,org_unit_id)
+
+    ctype_header = {'Content-Type':content_type}
 
     # populate the default state of the passed in kwargs that we care about
     kwargs.setdefault('auth',uc)
@@ -1662,3 +1716,8 @@ def get_ep_export_task_status(uc,export_task_id,ver='2.0',**kwargs):
 def get_ep_export_task_package(uc,export_task_id,ver='2.0',**kwargs):
     route = '/d2l/api/eP/{0}/export/{1}/package'.format(ver,export_task_id)
     return _get(route,uc,**kwargs)
+
+def get_ep_export_task_package_stream(uc,export_task_id,ver='2.0',**kwargs):
+    # streaming response for large export packages; callers must close it
+    route = '/d2l/api/eP/{0}/export/{1}/package'.format(ver,export_task_id)
+    return _get_stream(route,uc,**kwargs)